@@ -3,13 +3,20 @@
 # 对 API 索引执行 BM25 检索，用于 Prompt 注入与人工检索。
 
 import argparse
+import hashlib
 import heapq
 import json
 import math
+import pickle
 import re
-from dataclasses import dataclass
+import sys
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, Iterable, List, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+# Bump when tokenization / record_text / cache layout changes.
+CACHE_VERSION = 2
 
 
 CH2EN_HINTS = {
@@ -116,97 +123,233 @@ class BM25:
         return float(score)
 
 
-def build_bm25(index_path: Path) -> Tuple[BM25, int]:
+def result_record(rec: dict) -> dict:
+    return {
+        "symbol_id": rec.get("symbol_id", ""),
+        "owner": rec.get("owner", ""),
+        "name": rec.get("name", ""),
+        "kind": rec.get("kind", ""),
+        "signature": rec.get("signature", ""),
+        "tags": rec.get("tags", []),
+    }
+
+
+@dataclass
+class QueryIndex:
+    """BM25 model plus per-doc term frequencies and postings, built in one pass."""
+
+    bm25: BM25
+    records: List[dict] = field(default_factory=list)
+    doc_tfs: List[Dict[str, int]] = field(default_factory=list)
+    doc_lens: List[int] = field(default_factory=list)
+    postings: Dict[str, List[int]] = field(default_factory=dict)
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.records)
+
+    def to_state(self) -> dict:
+        """Plain dicts/lists for the on-disk cache (no class references, so the pickle
+        loads the same whether this module ran as a script or was imported)."""
+        return {
+            "bm25": {"idf": self.bm25.idf, "avgdl": self.bm25.avgdl, "k1": self.bm25.k1, "b": self.bm25.b},
+            "records": self.records,
+            "doc_tfs": self.doc_tfs,
+            "doc_lens": self.doc_lens,
+            "postings": self.postings,
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> "QueryIndex":
+        return cls(
+            bm25=BM25(**state["bm25"]),
+            records=state["records"],
+            doc_tfs=state["doc_tfs"],
+            doc_lens=state["doc_lens"],
+            postings=state["postings"],
+        )
+
+    def search(self, query: str, top_k: int) -> List[dict]:
+        if self.n_docs == 0:
+            return []
+
+        q_tokens = expand_query_tokens(query)
+        if not q_tokens:
+            return []
+
+        # Only docs that contain at least one query token can score > 0.
+        candidates = set()
+        for t in q_tokens:
+            candidates.update(self.postings.get(t, ()))
+
+        scored: List[Tuple[float, int]] = []
+        for i in candidates:
+            s = self.bm25.score(q_tokens, self.doc_tfs[i], self.doc_lens[i])
+            if s > 0:
+                scored.append((s, i))
+
+        out: List[dict] = []
+        for s, i in heapq.nsmallest(top_k, scored, key=lambda x: (-x[0], x[1])):
+            item = dict(self.records[i])
+            item["score"] = round(float(s), 6)
+            out.append(item)
+        return out
+
+
+def build_bm25(index_path: Path) -> QueryIndex:
     df: Dict[str, int] = {}
-    total_dl = 0
-    n_docs = 0
+    index = QueryIndex(bm25=BM25(idf={}, avgdl=1.0))
 
     for rec in iter_jsonl(index_path):
         tokens = tokenize(record_text(rec))
         if not tokens:
             continue
-        n_docs += 1
-        total_dl += len(tokens)
-        for t in set(tokens):
+        doc_id = len(index.records)
+        tf: Dict[str, int] = {}
+        for t in tokens:
+            tf[t] = tf.get(t, 0) + 1
+        for t in tf:
             df[t] = df.get(t, 0) + 1
+            index.postings.setdefault(t, []).append(doc_id)
+        index.records.append(result_record(rec))
+        index.doc_tfs.append(tf)
+        index.doc_lens.append(len(tokens))
 
+    n_docs = index.n_docs
     if n_docs == 0:
-        return BM25(idf={}, avgdl=1.0), 0
+        return index
 
-    avgdl = total_dl / n_docs
     idf: Dict[str, float] = {}
     for t, c in df.items():
         # BM25+ style idf (always positive)
         idf[t] = math.log((n_docs - c + 0.5) / (c + 0.5) + 1.0)
 
-    return BM25(idf=idf, avgdl=avgdl), n_docs
+    index.bm25 = BM25(idf=idf, avgdl=sum(index.doc_lens) / n_docs)
+    return index
+
+
+def default_cache_path(index_path: Path) -> Path:
+    return index_path.with_name(index_path.name + ".query_cache.pkl")
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def save_cache(cache_path: Path, key: dict, state: dict) -> None:
+    """Atomically write the query cache (key + QueryIndex.to_state()); failures only warn."""
+    try:
+        tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+        with tmp_path.open("wb") as f:
+            pickle.dump({"key": key, "index": state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path.replace(cache_path)
+    except OSError as e:
+        print(f"[warn] failed to write query cache {cache_path}: {e}", file=sys.stderr)
+
+
+def load_index(index_path: Path, cache_path: Optional[Path]) -> QueryIndex:
+    """Load the query index from cache when it matches the JSONL, else rebuild (and persist)."""
+    if cache_path is None:
+        return build_bm25(index_path)
+
+    st = index_path.stat()
+    sha256: Optional[str] = None
+    try:
+        with cache_path.open("rb") as f:
+            cached = pickle.load(f)
+        key = cached["key"]
+        if key["version"] == CACHE_VERSION and key["size"] == st.st_size:
+            # Fast path on mtime; fall back to content hash (e.g. file was touched or copied).
+            if key["mtime_ns"] == st.st_mtime_ns:
+                return QueryIndex.from_state(cached["index"])
+            sha256 = file_sha256(index_path)
+            if key["sha256"] == sha256:
+                index = QueryIndex.from_state(cached["index"])
+                # Same content, new mtime: store it so later loads take the fast path again.
+                save_cache(cache_path, dict(key, mtime_ns=st.st_mtime_ns), cached["index"])
+                return index
+    # AttributeError/ImportError: caches from older layouts pickled the dataclasses themselves.
+    except (OSError, EOFError, KeyError, TypeError, AttributeError, ImportError, pickle.UnpicklingError):
+        pass
+
+    index = build_bm25(index_path)
+    key = {
+        "version": CACHE_VERSION,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "sha256": sha256 or file_sha256(index_path),
+    }
+    save_cache(cache_path, key, index.to_state())
+    return index
 
 
 def topk_search(index_path: Path, query: str, top_k: int) -> List[dict]:
-    bm25, n_docs = build_bm25(index_path)
-    if n_docs == 0:
-        return []
+    return load_index(index_path, None).search(query, top_k)
 
-    q_tokens = expand_query_tokens(query)
-    if not q_tokens:
-        return []
 
-    heap: List[Tuple[float, int, dict]] = []
-    seq = 0
+def dump_results(results, pretty: bool) -> None:
+    if pretty:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print(json.dumps(results, ensure_ascii=False))
+
 
-    for rec in iter_jsonl(index_path):
-        text = record_text(rec)
-        tokens = tokenize(text)
-        if not tokens:
-            continue
-        tf: Dict[str, int] = {}
-        for t in tokens:
-            tf[t] = tf.get(t, 0) + 1
-        s = bm25.score(q_tokens, tf, len(tokens))
-        if s <= 0:
-            continue
-        seq += 1
-        item = (s, seq, rec)
-        if len(heap) < top_k:
-            heapq.heappush(heap, item)
-        else:
-            if s > heap[0][0]:
-                heapq.heapreplace(heap, item)
-
-    heap.sort(key=lambda x: x[0], reverse=True)
-    out: List[dict] = []
-    for s, _, rec in heap:
-        out.append(
-            {
-                "symbol_id": rec.get("symbol_id", ""),
-                "owner": rec.get("owner", ""),
-                "name": rec.get("name", ""),
-                "kind": rec.get("kind", ""),
-                "signature": rec.get("signature", ""),
-                "tags": rec.get("tags", []),
-                "score": round(float(s), 6),
-            }
-        )
-    return out
+def run_queries_file(index: QueryIndex, path: Path, top_k: int) -> None:
+    # One query per line; blank lines are skipped. Output is JSONL aligned with input queries.
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            query = line.strip()
+            if not query:
+                continue
+            print(json.dumps({"query": query, "results": index.search(query, top_k)}, ensure_ascii=False))
+
+
+def run_interactive(index: QueryIndex, top_k: int, pretty: bool) -> None:
+    print(f"Loaded {index.n_docs} APIs. Enter a query (empty line or Ctrl-D to quit).", file=sys.stderr)
+    while True:
+        try:
+            query = input("query> ").strip()
+        except (EOFError, KeyboardInterrupt):
+            print(file=sys.stderr)
+            break
+        if not query:
+            break
+        dump_results(index.search(query, top_k), pretty)
 
 
 def main() -> None:
     ap = argparse.ArgumentParser()
     ap.add_argument("--index", required=True, help="Path to API index JSONL (e.g. data/api_index/phaser_api.jsonl)")
-    ap.add_argument("--text", required=True, help="Query text")
+    ap.add_argument("--text", help="Query text")
+    ap.add_argument("--queries-file", help="Batch mode: one query per line, prints one JSON line per query")
+    ap.add_argument("--interactive", action="store_true", help="REPL mode: read queries from stdin")
     ap.add_argument("--top-k", type=int, default=20)
     ap.add_argument("--pretty", action="store_true")
+    ap.add_argument("--cache", help="Path to the persisted query index cache (default: <index>.query_cache.pkl)")
+    ap.add_argument("--no-cache", action="store_true", help="Do not read or write the query index cache")
     args = ap.parse_args()
 
+    if not (args.text or args.queries_file or args.interactive):
+        ap.error("one of --text, --queries-file, --interactive is required")
+
     index_path = Path(args.index)
     if not index_path.exists():
         raise SystemExit(f"Index not found: {index_path}")
 
-    results = topk_search(index_path, args.text, max(1, int(args.top_k)))
-    if args.pretty:
-        print(json.dumps(results, ensure_ascii=False, indent=2))
-    else:
-        print(json.dumps(results, ensure_ascii=False))
+    cache_path = None if args.no_cache else Path(args.cache) if args.cache else default_cache_path(index_path)
+    index = load_index(index_path, cache_path)
+    top_k = max(1, int(args.top_k))
+
+    if args.text:
+        dump_results(index.search(args.text, top_k), args.pretty)
+    if args.queries_file:
+        run_queries_file(index, Path(args.queries_file), top_k)
+    if args.interactive:
+        run_interactive(index, top_k, args.pretty)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,215 @@
+#!/usr/bin/env node
+// 运行时验证基准：对比一次性子进程（冷启动）与预热 worker 池的单样本耗时，并探测 V8 启动快照是否可用。
+/* eslint-disable no-console */
+
+const fs = require("fs");
+const os = require("os");
+const path = require("path");
+const { execFileSync, spawnSync, fork } = require("child_process");
+
+const { runHeadless } = require("../src/run_headless");
+const { RuntimePool } = require("../src/runtime_pool");
+
+const validatorRoot = path.resolve(__dirname, "..");
+
+// Used when no --code-dir is given: an empty game, a scene with a tween, and a sample without a game.
+const BUILTIN_SAMPLES = {
+  "empty_game.js": "new Phaser.Game({ type: Phaser.HEADLESS, width: 320, height: 240 });\n",
+  "tween_scene.js": [
+    "class Main extends Phaser.Scene {",
+    "  create() {",
+    "    const r = this.add.rectangle(10, 10, 20, 20, 0xff0000);",
+    "    this.tweens.add({ targets: r, x: 300, duration: 500, yoyo: true, repeat: -1 });",
+    "  }",
+    "}",
+    "new Phaser.Game({ type: Phaser.HEADLESS, width: 320, height: 240, scene: Main });",
+    "",
+  ].join("\n"),
+  "no_game.js": "const box = { x: 0 };\nbox.x += 1;\n",
+};
+
+function parseArgs(argv) {
+  const args = {};
+  for (let i = 2; i < argv.length; i++) {
+    const t = argv[i];
+    if (!t.startsWith("--")) continue;
+    const k = t.slice(2);
+    const v = argv[i + 1];
+    if (v == null || v.startsWith("--")) {
+      args[k] = true;
+    } else {
+      args[k] = v;
+      i++;
+    }
+  }
+  return args;
+}
+
+function now() {
+  return Number(process.hrtime.bigint()) / 1e6;
+}
+
+function summarize(values) {
+  if (!values.length) return { n: 0 };
+  const sorted = [...values].sort((a, b) => a - b);
+  const pick = (q) => sorted[Math.min(sorted.length - 1, Math.floor(q * sorted.length))];
+  const round = (x) => Math.round(x * 10) / 10;
+  return {
+    n: values.length,
+    mean_ms: round(values.reduce((a, b) => a + b, 0) / values.length),
+    p50_ms: round(pick(0.5)),
+    p95_ms: round(pick(0.95)),
+    max_ms: round(sorted[sorted.length - 1]),
+  };
+}
+
+function loadSamples(args) {
+  const limit = args.limit ? Number(args.limit) : 20;
+  if (typeof args["code-dir"] === "string") {
+    return fs
+      .readdirSync(args["code-dir"])
+      .filter((f) => f.endsWith(".js"))
+      .sort()
+      .slice(0, limit)
+      .map((f) => path.join(args["code-dir"], f));
+  }
+  const dir = fs.mkdtempSync(path.join(os.tmpdir(), "runtime-bench-"));
+  return Object.entries(BUILTIN_SAMPLES).map(([name, code]) => {
+    const file = path.join(dir, name);
+    fs.writeFileSync(file, code, "utf8");
+    return file;
+  });
+}
+
+/** Bare `node -e 0` start-up: the floor of any per-sample process. */
+function benchNodeBoot(repeat) {
+  const times = [];
+  for (let i = 0; i < repeat; i++) {
+    const t0 = now();
+    execFileSync(process.execPath, ["-e", "0"]);
+    times.push(now() - t0);
+  }
+  return summarize(times);
+}
+
+/** Fork a worker and time it until "ready": node start + JSDOM + require("phaser"). */
+async function benchWorkerSetup(repeat) {
+  const times = [];
+  for (let i = 0; i < repeat; i++) {
+    const t0 = now();
+    const child = fork(path.join(validatorRoot, "src", "runtime_child.js"), ["--worker"], {
+      stdio: ["ignore", "ignore", "ignore", "ipc"],
+    });
+    await new Promise((resolve) => {
+      child.on("message", (msg) => {
+        if (msg && msg.type === "ready") resolve();
+      });
+      child.on("exit", resolve);
+    });
+    times.push(now() - t0);
+    child.kill();
+  }
+  return summarize(times);
+}
+
+async function benchCold(files, frames, rounds) {
+  const times = [];
+  for (let r = 0; r < rounds; r++) {
+    for (const codeFile of files) {
+      const t0 = now();
+      await runHeadless({ codeFile, frames, timeoutMs: 30000 });
+      times.push(now() - t0);
+    }
+  }
+  return summarize(times);
+}
+
+async function benchWarm(files, frames, rounds, poolOptions) {
+  const pool = new RuntimePool(poolOptions);
+  const sources = files.map((f) => [f, fs.readFileSync(f, "utf8")]);
+  const t0 = now();
+  pool.warm();
+  // The first run waits for the worker to become ready; report it separately.
+  const [firstFile, firstCode] = sources[0];
+  await runHeadless({ code: firstCode, codeFile: firstFile, frames, timeoutMs: 30000, pool });
+  const first = now() - t0;
+
+  const times = [];
+  for (let r = 0; r < rounds; r++) {
+    for (const [codeFile, code] of sources) {
+      const t1 = now();
+      await runHeadless({ code, codeFile, frames, timeoutMs: 30000, pool });
+      times.push(now() - t1);
+    }
+  }
+  const stats = { ...pool.stats };
+  pool.close();
+  return { first_run_ms: Math.round(first), steady: summarize(times), pool: stats };
+}
+
+/**
+ * Try to build a Node user-land startup snapshot (`--build-snapshot`) holding the JSDOM
+ * window and Phaser, which is what a snapshot-based runtime child would need.
+ */
+function probeSnapshot() {
+  const dir = fs.mkdtempSync(path.join(os.tmpdir(), "runtime-snapshot-"));
+  const entry = path.join(dir, "entry.js");
+  const blob = path.join(dir, "snapshot.blob");
+  const requireFrom = JSON.stringify(path.join(validatorRoot, "src", "runtime_child.js"));
+  fs.writeFileSync(
+    entry,
+    [
+      `const load = require("module").createRequire(${requireFrom});`,
+      "const { JSDOM } = load(\"jsdom\");",
+      "const dom = new JSDOM(\"<!doctype html><html><body></body></html>\", { pretendToBeVisual: true });",
+      "globalThis.window = dom.window;",
+      "globalThis.document = dom.window.document;",
+      "globalThis.Phaser = load(\"phaser\");",
+      "",
+    ].join("\n"),
+    "utf8"
+  );
+  const t0 = now();
+  const res = spawnSync(process.execPath, ["--snapshot-blob", blob, "--build-snapshot", entry], { encoding: "utf8" });
+  const ms = Math.round(now() - t0);
+  const built = res.status === 0 && fs.existsSync(blob);
+  const lines = String(res.stderr || "").split("\n");
+  const error = lines.find((l) => /^\w*Error\b/.test(l)) || lines.filter((l) => l.trim()).pop() || `exit ${res.status}`;
+  fs.rmSync(dir, { recursive: true, force: true });
+  return { node: process.version, built, ms, error: built ? null : error };
+}
+
+async function main() {
+  const args = parseArgs(process.argv);
+  const frames = args.frames ? Number(args.frames) : 60;
+  const rounds = args.rounds ? Number(args.rounds) : 1;
+  const repeat = args.repeat ? Number(args.repeat) : 5;
+  const files = loadSamples(args);
+
+  const report = {
+    frames,
+    samples: files.length,
+    rounds,
+    node_boot: benchNodeBoot(repeat),
+    worker_setup: await benchWorkerSetup(repeat),
+  };
+  if (!args["skip-cold"]) report.cold = await benchCold(files, frames, rounds);
+  report.warm = await benchWarm(files, frames, rounds, {
+    size: 1,
+    maxRuns: args["max-runs"] ? Number(args["max-runs"]) : 100,
+  });
+  if (report.cold && report.cold.n) {
+    report.warm_saving_ms = Math.round((report.cold.mean_ms - report.warm.steady.mean_ms) * 10) / 10;
+    report.speedup = Math.round((report.cold.mean_ms / report.warm.steady.mean_ms) * 100) / 100;
+  }
+  if (!args["skip-snapshot"]) report.snapshot = probeSnapshot();
+
+  const out = JSON.stringify(report, null, 2);
+  if (typeof args.out === "string") fs.writeFileSync(args.out, out + "\n", "utf8");
+  console.log(out);
+}
+
+main().catch((e) => {
+  console.error(String(e && e.stack ? e.stack : e));
+  process.exitCode = 1;
+});
@@ -1,7 +1,66 @@
 // 加载 API 索引 JSONL，构建 symbol_id 的集合用于命中/缺失判定。
 const fs = require("fs");
+const path = require("path");
 const readline = require("readline");
 
+// Must match stage1/scripts/api_index_compiled.py
+const COMPILED_MAGIC = "PAPIIDX1";
+const COMPILED_FORMAT_VERSION = 1;
+
+function compiledPathFor(indexPath) {
+  const ext = path.extname(indexPath);
+  return (ext ? indexPath.slice(0, -ext.length) : indexPath) + ".bin";
+}
+
+function readExact(fd, length, position) {
+  const buf = Buffer.alloc(length);
+  const n = fs.readSync(fd, buf, 0, length, position);
+  if (n !== length) throw new Error("truncated compiled index");
+  return buf;
+}
+
+function isCompiledFresh(header, indexPath) {
+  if (header.format_version !== COMPILED_FORMAT_VERSION) return false;
+  let meta = {};
+  try {
+    meta = JSON.parse(fs.readFileSync(path.join(path.dirname(indexPath), "meta.json"), "utf8"));
+  } catch {
+    meta = {};
+  }
+  const st = fs.statSync(indexPath, { bigint: true });
+  return (
+    header.phaser_version === (meta.phaser_version || "") &&
+    header.build_time === (meta.build_time || "") &&
+    header.source_size === Number(st.size) &&
+    header.source_mtime_ns === st.mtimeNs.toString()
+  );
+}
+
+// Read only the symbols section of the compiled index; null if missing or stale.
+function loadCompiledSymbols(indexPath) {
+  const compiledPath = compiledPathFor(indexPath);
+  if (!fs.existsSync(compiledPath)) return null;
+
+  let fd;
+  try {
+    fd = fs.openSync(compiledPath, "r");
+    const prefix = readExact(fd, COMPILED_MAGIC.length + 4, 0);
+    if (prefix.toString("latin1", 0, COMPILED_MAGIC.length) !== COMPILED_MAGIC) return null;
+    const headerLen = prefix.readUInt32LE(COMPILED_MAGIC.length);
+    const header = JSON.parse(readExact(fd, headerLen, prefix.length).toString("utf8"));
+    if (!isCompiledFresh(header, indexPath)) return null;
+
+    const [offset, length] = header.sections.symbols;
+    const raw = length ? readExact(fd, length, prefix.length + headerLen + offset).toString("utf8") : "";
+    const symbolIds = new Set(raw ? raw.split("\n") : []);
+    return { ok: true, symbolIds, stats: header.stats, error: null, source: "compiled" };
+  } catch {
+    return null;
+  } finally {
+    if (fd !== undefined) fs.closeSync(fd);
+  }
+}
+
 async function loadApiIndex(indexPath) {
   const symbolIds = new Set();
   const stats = { total_lines: 0, parsed: 0, skipped: 0 };
@@ -10,6 +69,9 @@ async function loadApiIndex(indexPath) {
     return { ok: false, symbolIds, stats, error: "api_index_not_found" };
   }
 
+  const compiled = loadCompiledSymbols(indexPath);
+  if (compiled) return compiled;
+
   const rl = readline.createInterface({
     input: fs.createReadStream(indexPath, { encoding: "utf8" }),
     crlfDelay: Infinity,
@@ -32,7 +94,7 @@ async function loadApiIndex(indexPath) {
     }
   }
 
-  return { ok: true, symbolIds, stats, error: null };
+  return { ok: true, symbolIds, stats, error: null, source: "jsonl" };
 }
 
-module.exports = { loadApiIndex };
+module.exports = { loadApiIndex, compiledPathFor };
@@ -3,12 +3,18 @@
 /* eslint-disable no-console */
 
 const fs = require("fs");
+const os = require("os");
 const path = require("path");
+const readline = require("readline");
 
 const { parseAndCheck } = require("./ast_check");
 const { runEslint } = require("./eslint_check");
 const { loadApiIndex } = require("./api_index");
 const { runHeadless } = require("./run_headless");
+const { RuntimePool } = require("./runtime_pool");
+
+// Validation stages in default order. "ast" always runs first; see resolveStageOrder.
+const STAGES = ["ast", "eslint", "api", "runtime"];
 
 function parseArgs(argv) {
   const args = {};
@@ -35,17 +41,8 @@ function safeJsonParse(s, fallback) {
   }
 }
 
-async function main() {
-  const args = parseArgs(process.argv);
-  const codeFile = args["code-file"];
-  const apiIndexPath = args["api-index"];
-  const promptJson = args["prompt-json"] || "{}";
-  const timeoutMs = args["timeout-ms"] ? Number(args["timeout-ms"]) : 1500;
-  const frames = args.frames ? Number(args.frames) : 60;
-  const skipEslint = Boolean(args["skip-eslint"]);
-  const skipRuntime = Boolean(args["skip-runtime"]);
-
-  const result = {
+function emptyResult() {
+  return {
     parse_ok: false,
     lint_ok: false,
     api_ok: false,
@@ -55,40 +52,121 @@ async function main() {
     api_usage: { hits: [], misses: [], must_use_hits: [], must_use_misses: [] },
     runtime: { ms: 0, crashed: false, logs: [], errors: [], signals: {} },
     signals: {},
+    stages: [],
+    skipped_stages: [],
   };
+}
 
-  if (!codeFile) {
-    result.errors.push({ code: "missing_arg", message: "Missing --code-file" });
-    process.stdout.write(JSON.stringify(result));
-    return;
-  }
+function crashResult(e) {
+  const result = emptyResult();
+  result.errors.push({ code: "validator_crash", message: String(e && e.message ? e.message : e) });
+  result.runtime.crashed = true;
+  return result;
+}
 
-  let code;
-  try {
-    code = fs.readFileSync(codeFile, "utf8");
-  } catch (e) {
-    result.errors.push({ code: "read_failed", message: String(e && e.message ? e.message : e) });
-    process.stdout.write(JSON.stringify(result));
-    return;
+function optionsFromArgs(args) {
+  return {
+    apiIndexPath: args["api-index"] || null,
+    timeoutMs: args["timeout-ms"] ? Number(args["timeout-ms"]) : 1500,
+    frames: args.frames ? Number(args.frames) : 60,
+    skipEslint: Boolean(args["skip-eslint"]),
+    skipRuntime: Boolean(args["skip-runtime"]),
+    failFast: Boolean(args["fail-fast"]),
+    stageOrder: typeof args["stage-order"] === "string" ? args["stage-order"] : null,
+  };
+}
+
+/**
+ * Runtime worker pool settings for serve/manifest modes.
+ * `--runtime-workers 0` falls back to one child process per sample.
+ */
+function poolOptionsFromArgs(args) {
+  return {
+    size: args["runtime-workers"] != null ? Number(args["runtime-workers"]) : 1,
+    maxRuns: args["runtime-max-runs"] ? Number(args["runtime-max-runs"]) : 100,
+    maxRssGrowthMb: args["runtime-max-rss-mb"] ? Number(args["runtime-max-rss-mb"]) : 256,
+  };
+}
+
+/**
+ * Long-lived state shared across validations in one process.
+ * API indexes are cached per path so serve/batch modes pay the load once; with poolOptions,
+ * runtime checks go to warm workers that keep JSDOM and Phaser loaded (created on first use).
+ */
+function createContext(poolOptions) {
+  const apiIndexes = new Map();
+  let runtimePool = null;
+  return {
+    getApiIndex(indexPath) {
+      if (!apiIndexes.has(indexPath)) apiIndexes.set(indexPath, loadApiIndex(indexPath));
+      return apiIndexes.get(indexPath);
+    },
+    getRuntimePool() {
+      if (!poolOptions || !(poolOptions.size > 0)) return null;
+      if (!runtimePool) runtimePool = new RuntimePool(poolOptions);
+      return runtimePool;
+    },
+    close() {
+      if (runtimePool) runtimePool.close();
+    },
+  };
+}
+
+/**
+ * Resolve a stage order (comma-separated string or array) into the full stage list.
+ * "ast" always runs first because every other stage reads its output; stages not listed
+ * keep their default relative order after the listed ones.
+ */
+function resolveStageOrder(value) {
+  const listed = Array.isArray(value)
+    ? value
+    : typeof value === "string" && value.trim()
+      ? value.split(",")
+      : [];
+  const order = [];
+  const unknown = [];
+  for (const raw of listed) {
+    const name = String(raw).trim();
+    if (!name || name === "ast") continue;
+    if (!STAGES.includes(name)) unknown.push(name);
+    else if (!order.includes(name)) order.push(name);
+  }
+  for (const name of STAGES) {
+    if (name !== "ast" && !order.includes(name)) order.push(name);
   }
+  return { order: ["ast", ...order], unknown };
+}
 
-  const promptObj = safeJsonParse(promptJson, {});
-  const mustUseApis = Array.isArray(promptObj.must_use_apis) ? promptObj.must_use_apis : [];
+async function validateCode({ code, codeFile, promptObj, options }, ctx) {
+  const { apiIndexPath, timeoutMs, frames, skipEslint, skipRuntime, failFast, stageOrder } = options;
+  const result = emptyResult();
 
-  const astRes = parseAndCheck(code, { mustUseApis });
-  result.parse_ok = Boolean(astRes.parse_ok);
-  result.signals = astRes.signals || {};
+  const mustUseApis = Array.isArray(promptObj && promptObj.must_use_apis) ? promptObj.must_use_apis : [];
+  let astRes = null;
 
-  for (const e of astRes.errors || []) result.errors.push(e);
-  if (Array.isArray(astRes.banned) && astRes.banned.length) {
-    for (const b of astRes.banned) result.errors.push(b);
+  // AST stage
+  function runAst() {
+    astRes = parseAndCheck(code, { mustUseApis });
+    result.parse_ok = Boolean(astRes.parse_ok);
+    result.signals = astRes.signals || {};
+
+    for (const e of astRes.errors || []) result.errors.push(e);
+    if (Array.isArray(astRes.banned) && astRes.banned.length) {
+      for (const b of astRes.banned) result.errors.push(b);
+    }
+    return result.parse_ok;
   }
 
   // ESLint stage
-  if (skipEslint) {
-    result.lint_ok = true;
-  } else {
-    const lint = await runEslint(code, codeFile);
+  function runLint() {
+    // Babel accepts a superset of what espree parses: if Babel already failed, espree would only
+    // add a duplicate fatal parse error, so skip linting (lint_ok stays false).
+    const parseFailed = (astRes.errors || []).some((e) => e.code === "parse_error");
+    if (parseFailed) {
+      result.lint_ok = false;
+      return false;
+    }
+    const lint = runEslint(code);
     result.lint_ok = Boolean(lint.ok);
     const msgs = Array.isArray(lint.messages) ? lint.messages : [];
     for (const m of msgs) {
@@ -102,78 +180,80 @@ async function main() {
       if (m.severity === 2) result.errors.push(payload);
       else result.warnings.push(payload);
     }
+    return result.lint_ok;
   }
 
   // API index stage
-  let apiIndex = null;
-  if (apiIndexPath) {
-    apiIndex = await loadApiIndex(apiIndexPath);
-    if (!apiIndex.ok) {
-      result.warnings.push({ code: "api_index_missing", message: `API index not found: ${apiIndexPath}` });
-    } else {
-      result.warnings.push({
-        code: "api_index_loaded",
-        message: `API index loaded: ${apiIndex.stats.parsed} symbols`,
-      });
-    }
-  } else {
-    result.warnings.push({ code: "api_index_missing", message: "No --api-index provided" });
-  }
-
-  if (apiIndex && apiIndex.ok) {
-    const hits = [];
-    const misses = [];
-    const seen = new Set();
-    for (const c of astRes.api_candidates || []) {
-      if (!c || typeof c.symbol_id !== "string") continue;
-      const sid = c.symbol_id;
-      if (seen.has(sid)) continue;
-      seen.add(sid);
-      if (apiIndex.symbolIds.has(sid)) hits.push(c);
-      else misses.push(c);
-    }
-    result.api_usage.hits = hits;
-    result.api_usage.misses = misses;
-  } else {
-    // Without index, only enforce must-use check (best-effort string/AST match).
-    result.api_usage.hits = [];
-    result.api_usage.misses = [];
-  }
-
-  // Must-use checks:
-  // - If must_use item looks like a symbol id (contains '#'), require it to appear in api_usage.hits.
-  // - Otherwise, require it to appear in member strings or as a raw substring.
-  {
-    const mustHits = [];
-    const mustMisses = [];
-    const memberStrings = astRes.member_strings || new Set();
-    const hitIds = new Set((result.api_usage.hits || []).map((h) => h.symbol_id));
-    for (const must of mustUseApis) {
-      if (typeof must !== "string" || !must.trim()) continue;
-      const m = must.trim();
-      if (m.includes("#")) {
-        if (hitIds.has(m)) mustHits.push(m);
-        else mustMisses.push(m);
+  async function runApi() {
+    let apiIndex = null;
+    if (apiIndexPath) {
+      apiIndex = await ctx.getApiIndex(apiIndexPath);
+      if (!apiIndex.ok) {
+        result.warnings.push({ code: "api_index_missing", message: `API index not found: ${apiIndexPath}` });
       } else {
-        if (memberStrings.has(m) || code.includes(m)) mustHits.push(m);
-        else mustMisses.push(m);
+        result.warnings.push({
+          code: "api_index_loaded",
+          message: `API index loaded: ${apiIndex.stats.parsed} symbols`,
+        });
       }
+    } else {
+      result.warnings.push({ code: "api_index_missing", message: "No --api-index provided" });
+    }
+
+    if (apiIndex && apiIndex.ok) {
+      const hits = [];
+      const misses = [];
+      const seen = new Set();
+      for (const c of astRes.api_candidates || []) {
+        if (!c || typeof c.symbol_id !== "string") continue;
+        const sid = c.symbol_id;
+        if (seen.has(sid)) continue;
+        seen.add(sid);
+        if (apiIndex.symbolIds.has(sid)) hits.push(c);
+        else misses.push(c);
+      }
+      result.api_usage.hits = hits;
+      result.api_usage.misses = misses;
+    } else {
+      // Without index, only enforce must-use check (best-effort string/AST match).
+      result.api_usage.hits = [];
+      result.api_usage.misses = [];
+    }
+
+    // Must-use checks:
+    // - If must_use item looks like a symbol id (contains '#'), require it to appear in api_usage.hits.
+    // - Otherwise, require it to appear in member strings or as a raw substring.
+    {
+      const mustHits = [];
+      const mustMisses = [];
+      const memberStrings = astRes.member_strings || new Set();
+      const hitIds = new Set((result.api_usage.hits || []).map((h) => h.symbol_id));
+      for (const must of mustUseApis) {
+        if (typeof must !== "string" || !must.trim()) continue;
+        const m = must.trim();
+        if (m.includes("#")) {
+          if (hitIds.has(m)) mustHits.push(m);
+          else mustMisses.push(m);
+        } else {
+          if (memberStrings.has(m) || code.includes(m)) mustHits.push(m);
+          else mustMisses.push(m);
+        }
+      }
+      result.api_usage.must_use_hits = mustHits;
+      result.api_usage.must_use_misses = mustMisses;
     }
-    result.api_usage.must_use_hits = mustHits;
-    result.api_usage.must_use_misses = mustMisses;
-  }
 
-  // api_ok gate combines API existence (if index available) + must-use checks.
-  if (apiIndex && apiIndex.ok) {
-    result.api_ok = (result.api_usage.misses || []).length === 0 && (result.api_usage.must_use_misses || []).length === 0;
-  } else {
-    result.api_ok = (result.api_usage.must_use_misses || []).length === 0;
+    // api_ok gate combines API existence (if index available) + must-use checks.
+    if (apiIndex && apiIndex.ok) {
+      result.api_ok = (result.api_usage.misses || []).length === 0 && (result.api_usage.must_use_misses || []).length === 0;
+    } else {
+      result.api_ok = (result.api_usage.must_use_misses || []).length === 0;
+    }
+    return result.api_ok;
   }
 
   // Runtime stage (optional; best-effort)
-  if (skipRuntime) {
-    result.runtime_ok = true;
-  } else {
+  async function runRuntime() {
     // If AST stage already found unsafe patterns, do not execute.
     const hasUnsafe = (astRes.banned || []).length > 0;
     if (hasUnsafe) {
@@ -186,11 +266,29 @@ async function main() {
         signals: {},
       };
     } else {
-      const runtime = await runHeadless({
-        codeFile: path.resolve(codeFile),
-        frames,
-        timeoutMs,
-      });
+      const pool = ctx.getRuntimePool();
+      let runtime;
+      if (pool) {
+        runtime = await runHeadless({ code, codeFile, frames, timeoutMs, pool });
+      } else {
+        // Inline code (serve/batch requests) has no file on disk; the runtime child needs one.
+        let runFile = codeFile ? path.resolve(codeFile) : null;
+        let tmpDir = null;
+        if (!runFile) {
+          tmpDir = fs.mkdtempSync(path.join(os.tmpdir(), "validator-"));
+          runFile = path.join(tmpDir, "generated.js");
+          fs.writeFileSync(runFile, code, "utf8");
+        }
+        try {
+          runtime = await runHeadless({
+            codeFile: runFile,
+            frames,
+            timeoutMs,
+          });
+        } finally {
+          if (tmpDir) fs.rmSync(tmpDir, { recursive: true, force: true });
+        }
+      }
       result.runtime_ok = Boolean(runtime.ok);
       result.runtime = {
         ms: runtime.ms || 0,
@@ -203,23 +301,198 @@ async function main() {
         result.warnings.push({ code: "runtime_failed", message: (result.runtime.errors || []).join(" | ") });
       }
     }
+    return result.runtime_ok;
+  }
+
+  // Stages run in order; skipEslint/skipRuntime disable a stage and count it as passed.
+  // With failFast, the first stage that fails stops the run and later stages are listed in
+  // skipped_stages (their *_ok flags stay false).
+  const runners = { ast: runAst, eslint: runLint, api: runApi, runtime: runRuntime };
+  const disabled = { eslint: skipEslint, runtime: skipRuntime };
+  const { order, unknown } = resolveStageOrder(stageOrder);
+  if (unknown.length) {
+    result.warnings.push({ code: "unknown_stage", message: `Unknown stages ignored: ${unknown.join(", ")}` });
+  }
+
+  let stopped = false;
+  for (const name of order) {
+    if (disabled[name]) {
+      if (name === "eslint") result.lint_ok = true;
+      if (name === "runtime") result.runtime_ok = true;
+      continue;
+    }
+    if (stopped) {
+      result.skipped_stages.push(name);
+      continue;
+    }
+    const t0 = process.hrtime.bigint();
+    const ok = Boolean(await runners[name]());
+    const ms = Number(process.hrtime.bigint() - t0) / 1e6;
+    result.stages.push({ name, ok, ms: Math.round(ms * 100) / 100 });
+    if (failFast && !ok) stopped = true;
+  }
+
+  return result;
+}
+
+/**
+ * Resolve one serve/batch request item into validateCode inputs.
+ * Item shape: { id, code | code_file, prompt | prompt_json, ...per-item option overrides }.
+ */
+function resolveItem(item, defaults) {
+  let code = typeof item.code === "string" ? item.code : null;
+  const codeFile = typeof item.code_file === "string" && item.code_file ? item.code_file : null;
+  if (code == null) {
+    if (!codeFile) {
+      const result = emptyResult();
+      result.errors.push({ code: "missing_arg", message: "Missing code or code_file" });
+      return { error: result };
+    }
+    try {
+      code = fs.readFileSync(codeFile, "utf8");
+    } catch (e) {
+      const result = emptyResult();
+      result.errors.push({ code: "read_failed", message: String(e && e.message ? e.message : e) });
+      return { error: result };
+    }
+  }
+
+  let promptObj = item.prompt;
+  if (!promptObj || typeof promptObj !== "object") {
+    promptObj = safeJsonParse(typeof item.prompt_json === "string" ? item.prompt_json : "{}", {});
+  }
+
+  const options = { ...defaults };
+  if (item.api_index !== undefined) options.apiIndexPath = item.api_index || null;
+  if (item.timeout_ms !== undefined) options.timeoutMs = Number(item.timeout_ms);
+  if (item.frames !== undefined) options.frames = Number(item.frames);
+  if (item.skip_eslint !== undefined) options.skipEslint = Boolean(item.skip_eslint);
+  if (item.skip_runtime !== undefined) options.skipRuntime = Boolean(item.skip_runtime);
+  if (item.fail_fast !== undefined) options.failFast = Boolean(item.fail_fast);
+  if (item.stage_order !== undefined) options.stageOrder = item.stage_order;
+
+  return { code, codeFile, promptObj, options };
+}
+
+async function validateItem(item, defaults, ctx) {
+  const resolved = resolveItem(item, defaults);
+  if (resolved.error) return resolved.error;
+  try {
+    return await validateCode(resolved, ctx);
+  } catch (e) {
+    return crashResult(e);
+  }
+}
+
+async function runSingle(args, ctx) {
+  const codeFile = args["code-file"];
+  const promptJson = args["prompt-json"] || "{}";
+
+  if (!codeFile) {
+    const result = emptyResult();
+    result.errors.push({ code: "missing_arg", message: "Missing --code-file" });
+    process.stdout.write(JSON.stringify(result));
+    return;
   }
 
+  let code;
+  try {
+    code = fs.readFileSync(codeFile, "utf8");
+  } catch (e) {
+    const result = emptyResult();
+    result.errors.push({ code: "read_failed", message: String(e && e.message ? e.message : e) });
+    process.stdout.write(JSON.stringify(result));
+    return;
+  }
+
+  const promptObj = safeJsonParse(promptJson, {});
+  const result = await validateCode({ code, codeFile, promptObj, options: optionsFromArgs(args) }, ctx);
   process.stdout.write(JSON.stringify(result));
 }
 
+/**
+ * Validate newline-delimited JSON request items from a stream, writing one
+ * { id, result } line per item in input order.
+ */
+async function processLines(input, defaults, ctx) {
+  const rl = readline.createInterface({ input, crlfDelay: Infinity });
+  for await (const line of rl) {
+    const s = line.trim();
+    if (!s) continue;
+    const item = safeJsonParse(s, null);
+    let out;
+    if (!item || typeof item !== "object") {
+      const result = emptyResult();
+      result.errors.push({ code: "bad_request", message: "Request line is not a JSON object" });
+      out = { id: null, result };
+    } else {
+      out = { id: item.id != null ? item.id : null, result: await validateItem(item, defaults, ctx) };
+    }
+    process.stdout.write(JSON.stringify(out) + "\n");
+  }
+}
+
+/**
+ * Start runtime workers while the first requests are read, unless runtime is skipped by default
+ * (per-item skip_runtime: false still starts them on first use).
+ */
+function warmRuntime(defaults, ctx) {
+  if (defaults.skipRuntime) return;
+  const pool = ctx.getRuntimePool();
+  if (pool) pool.warm();
+}
+
+/**
+ * Serve mode: newline-delimited JSON over stdin/stdout.
+ * Each input line is one request item; each output line is { id, result }.
+ * Requests are handled sequentially; run several processes for parallelism.
+ */
+async function runServe(args, ctx) {
+  const defaults = optionsFromArgs(args);
+  if (defaults.apiIndexPath) await ctx.getApiIndex(defaults.apiIndexPath);
+  warmRuntime(defaults, ctx);
+  await processLines(process.stdin, defaults, ctx);
+}
+
+/**
+ * Manifest mode: validate every item of a JSONL manifest in one process and
+ * stream results to stdout (same line format as serve mode).
+ */
+async function runManifest(args, ctx) {
+  const manifestPath = args.manifest;
+  if (typeof manifestPath !== "string" || !fs.existsSync(manifestPath)) {
+    const result = emptyResult();
+    result.errors.push({ code: "read_failed", message: `Manifest not found: ${manifestPath}` });
+    process.stdout.write(JSON.stringify({ id: null, result }) + "\n");
+    process.exitCode = 1;
+    return;
+  }
+  const defaults = optionsFromArgs(args);
+  if (defaults.apiIndexPath) await ctx.getApiIndex(defaults.apiIndexPath);
+  warmRuntime(defaults, ctx);
+  await processLines(fs.createReadStream(manifestPath, { encoding: "utf8" }), defaults, ctx);
+}
+
+async function main() {
+  const args = parseArgs(process.argv);
+  // A single validation gains nothing from a warm worker; keep the one-shot child there.
+  const ctx = createContext(args.serve || args.manifest ? poolOptionsFromArgs(args) : null);
+  try {
+    if (args.serve) {
+      await runServe(args, ctx);
+      return;
+    }
+    if (args.manifest) {
+      await runManifest(args, ctx);
+      return;
+    }
+    await runSingle(args, ctx);
+  } finally {
+    ctx.close();
+  }
+}
+
 main().catch((e) => {
-  const result = {
-    parse_ok: false,
-    lint_ok: false,
-    api_ok: false,
-    runtime_ok: false,
-    errors: [{ code: "validator_crash", message: String(e && e.message ? e.message : e) }],
-    warnings: [],
-    api_usage: { hits: [], misses: [], must_use_hits: [], must_use_misses: [] },
-    runtime: { ms: 0, crashed: true, logs: [], errors: [], signals: {} },
-    signals: {},
-  };
-  process.stdout.write(JSON.stringify(result));
+  process.stdout.write(JSON.stringify(crashResult(e)));
   process.exitCode = 1;
 });
@@ -9,62 +9,69 @@ function requireOptional(name) {
   }
 }
 
-async function runEslint(code, filePath) {
+const validatorRoot = path.resolve(__dirname, "..");
+const configPath = path.join(validatorRoot, "eslint.config.js");
+// NOTE: ESLint flat config can ignore files outside cwd ("outside of base path").
+// We lint the provided code string and force a virtual file path under validatorRoot.
+const virtualPath = path.join(validatorRoot, "__generated__.js");
+
+function failure(ruleId, message) {
+  return {
+    ok: false,
+    error_count: 1,
+    warning_count: 0,
+    messages: [{ ruleId, message }],
+  };
+}
+
+let linterState = null;
+
+/**
+ * Process-wide Linter with the flat config resolved once.
+ *
+ * The ESLint class re-resolves config and touches the file system on every lintText call;
+ * Linter.verify is a pure in-memory call, so serve/batch modes only pay setup on the first file.
+ * The config array is passed as-is and Linter adds the same built-in defaults ESLint would.
+ *
+ * The Babel AST from ast_check cannot be handed over: ESLint rules and scope analysis expect
+ * an ESTree/espree AST (Literal vs StringLiteral, Property vs ObjectProperty, ranges, tokens,
+ * comments), so ESLint still parses the source itself with espree.
+ */
+function getLinter() {
+  if (linterState) return linterState;
   const eslintMod = requireOptional("eslint");
-  if (!eslintMod || !eslintMod.ESLint) {
-    return {
-      ok: false,
-      error_count: 1,
-      warning_count: 0,
-      messages: [
-        {
-          ruleId: "missing_deps",
-          message: "Missing validator dep: eslint (run `npm i` inside validator/)",
-        },
-      ],
+  if (!eslintMod || !eslintMod.Linter) {
+    linterState = { error: failure("missing_deps", "Missing validator dep: eslint (run `npm i` inside validator/)") };
+    return linterState;
+  }
+  try {
+    linterState = {
+      linter: new eslintMod.Linter({ cwd: validatorRoot, configType: "flat" }),
+      config: require(configPath),
     };
+  } catch (e) {
+    linterState = { error: failure("eslint_failed", String(e && e.message ? e.message : e)) };
   }
+  return linterState;
+}
 
-  const { ESLint } = eslintMod;
-  const validatorRoot = path.resolve(__dirname, "..");
-  const configPath = path.join(validatorRoot, "eslint.config.js");
+function runEslint(code) {
+  const { linter, config, error } = getLinter();
+  if (error) return error;
 
   try {
-    const eslint = new ESLint({
-      cwd: validatorRoot,
-      overrideConfigFile: configPath,
-    });
-    // NOTE: ESLint flat config can ignore files outside cwd ("outside of base path").
-    // We lint the provided code string and force a virtual file path under validatorRoot.
-    const virtualPath = path.join(validatorRoot, "__generated__.js");
-    const results = await eslint.lintText(code, { filePath: virtualPath });
-    const errorCount = results.reduce((s, r) => s + (r.errorCount || 0), 0);
-    const warningCount = results.reduce((s, r) => s + (r.warningCount || 0), 0);
-    const messages = [];
-    for (const r of results) {
-      for (const m of r.messages || []) {
-        messages.push({
-          ruleId: m.ruleId || "",
-          message: m.message || "",
-          severity: m.severity || 0,
-          line: m.line || 0,
-          column: m.column || 0,
-        });
-      }
-    }
+    const messages = linter.verify(code, config, { filename: virtualPath }).map((m) => ({
+      ruleId: m.ruleId || "",
+      message: m.message || "",
+      severity: m.severity || 0,
+      line: m.line || 0,
+      column: m.column || 0,
+    }));
+    const errorCount = messages.filter((m) => m.severity === 2).length;
+    const warningCount = messages.filter((m) => m.severity === 1).length;
     return { ok: errorCount === 0, error_count: errorCount, warning_count: warningCount, messages };
   } catch (e) {
-    return {
-      ok: false,
-      error_count: 1,
-      warning_count: 0,
-      messages: [
-        {
-          ruleId: "eslint_failed",
-          message: String(e && e.message ? e.message : e),
-        },
-      ],
-    };
+    return failure("eslint_failed", String(e && e.message ? e.message : e));
   }
 }
 
@@ -1,8 +1,50 @@
-// 启动子进程运行 runtime_child.js，提供受控的 HEADLESS 运行时验证。
+// 运行 runtime_child.js，提供受控的 HEADLESS 运行时验证（一次性子进程或预热 worker 池）。
+const fs = require("fs");
 const path = require("path");
 const { execFile } = require("child_process");
 
-function runHeadless({ codeFile, frames, timeoutMs }) {
+function toRuntimeResult(obj, ms) {
+  return {
+    ok: Boolean(obj.ok),
+    ms: obj.ms != null ? obj.ms : ms,
+    crashed: Boolean(obj.crashed),
+    logs: Array.isArray(obj.logs) ? obj.logs : [],
+    errors: Array.isArray(obj.errors) ? obj.errors : [],
+    signals: obj.signals || {},
+  };
+}
+
+/**
+ * Run one sample on a warm RuntimePool worker (see runtime_pool.js).
+ * Inline code is sent as-is, so no temp file is needed.
+ */
+async function runPooled({ pool, code, codeFile, frames, timeoutMs }) {
+  const start = Date.now();
+  let source = code;
+  if (source == null) {
+    try {
+      source = fs.readFileSync(codeFile, "utf8");
+    } catch (e) {
+      return {
+        ok: false,
+        ms: Date.now() - start,
+        crashed: true,
+        logs: [],
+        errors: ["read_code_failed", String(e && e.message ? e.message : e)],
+      };
+    }
+  }
+  const obj = await pool.run({
+    code: source,
+    filename: codeFile ? path.basename(codeFile) : "generated.js",
+    frames: frames || 60,
+    timeoutMs: timeoutMs || 1500,
+  });
+  return toRuntimeResult(obj, Date.now() - start);
+}
+
+function runHeadless({ codeFile, code, frames, timeoutMs, pool }) {
+  if (pool) return runPooled({ pool, code, codeFile, frames, timeoutMs });
   return new Promise((resolve) => {
     const start = Date.now();
     const childPath = path.join(__dirname, "runtime_child.js");
@@ -35,15 +77,7 @@ function runHeadless({ codeFile, frames, timeoutMs }) {
           return;
         }
         try {
-          const obj = JSON.parse(out);
-          resolve({
-            ok: Boolean(obj.ok),
-            ms: obj.ms != null ? obj.ms : ms,
-            crashed: Boolean(obj.crashed),
-            logs: Array.isArray(obj.logs) ? obj.logs : [],
-            errors: Array.isArray(obj.errors) ? obj.errors : [],
-            signals: obj.signals || {},
-          });
+          resolve(toRuntimeResult(JSON.parse(out), ms));
         } catch (e) {
           resolve({
             ok: false,
@@ -73,6 +73,8 @@ function setupDomIfAvailable() {
     global.navigator = dom.window.navigator || { userAgent: "node" };
     global.HTMLElement = dom.window.HTMLElement;
     global.HTMLCanvasElement = dom.window.HTMLCanvasElement;
+    global.HTMLImageElement = dom.window.HTMLImageElement;
+    global.HTMLVideoElement = dom.window.HTMLVideoElement;
     global.CanvasRenderingContext2D = dom.window.CanvasRenderingContext2D;
     global.WebGLRenderingContext = dom.window.WebGLRenderingContext || class {};
     global.requestAnimationFrame = dom.window.requestAnimationFrame || ((cb) => setTimeout(cb, 16));
@@ -130,6 +132,24 @@ function setupDomIfAvailable() {
       hasRealCanvas = true;
     } catch {
       // canvas not available - provide minimal mock for Phaser HEADLESS mode
+      // jsdom never loads <img> without node-canvas, so Phaser's built-in base64 textures
+      // would never fire onload and the game would never leave boot. Report data: URIs as
+      // loaded (nothing is decoded) and anything else as failed (no network in the sandbox).
+      const DomImage = dom.window.Image;
+      global.Image = function Image(width, height) {
+        const img = new DomImage(width, height);
+        let src = "";
+        Object.defineProperty(img, "src", {
+          configurable: true,
+          get: () => src,
+          set: (value) => {
+            src = String(value);
+            const type = src.startsWith("data:") ? "load" : "error";
+            setImmediate(() => img.dispatchEvent(new dom.window.Event(type)));
+          },
+        });
+        return img;
+      };
       const mockContext = {
         fillStyle: "",
         strokeStyle: "",
@@ -344,110 +364,462 @@ function setupDomIfAvailable() {
   }
 }
 
-async function main() {
-  const args = parseArgs(process.argv);
-  const codeFile = args["code-file"];
-  const frames = args.frames ? Number(args.frames) : 60;
-  const runMs = Math.min(2000, Math.max(50, Math.floor(frames * 16)));
 
-  const result = { ok: false, crashed: false, ms: 0, logs: [], errors: [], signals: {} };
-  const t0 = Date.now();
+/**
+ * Build the DOM environment and load Phaser once.
+ *
+ * One-shot mode does this per process; worker mode does it once and reuses the result for
+ * every sample. Phaser.Game is wrapped so each run can see the game its sample created.
+ */
+function loadRuntime() {
+  // IMPORTANT: Setup DOM environment BEFORE requiring Phaser
+  // Phaser checks for browser globals at load time
+  setupDomIfAvailable();
 
-  if (!codeFile) {
-    result.crashed = true;
-    result.errors.push("missing_code_file");
-    result.ms = Date.now() - t0;
-    process.stdout.write(JSON.stringify(result));
-    return;
+  const runtime = { Phaser: null, error: null, capturedGame: null, restoreRequire: setupRequireGuards() };
+  try {
+    runtime.Phaser = require("phaser");
+  } catch (e) {
+    runtime.error = ["missing_phaser", String(e && e.message ? e.message : e)];
+    return runtime;
   }
 
-  let code;
+  const Phaser = runtime.Phaser;
+  global.Phaser = Phaser;
   try {
-    code = fs.readFileSync(codeFile, "utf8");
-  } catch (e) {
-    result.crashed = true;
-    result.errors.push("read_code_failed", String(e && e.message ? e.message : e));
-    result.ms = Date.now() - t0;
-    process.stdout.write(JSON.stringify(result));
-    return;
+    const OriginalGame = Phaser.Game;
+    class CapturingGame extends OriginalGame {
+      constructor(config) {
+        super(config);
+        runtime.capturedGame = this;
+      }
+    }
+    // A fresh document boots the game from a DOMContentLoaded listener, where jsdom reports
+    // boot errors instead of throwing them. An already-loaded document (warm worker) boots
+    // inside the constructor; report those errors the same way so both modes agree.
+    CapturingGame.prototype.boot = function () {
+      try {
+        return OriginalGame.prototype.boot.call(this);
+      } catch (e) {
+        console.error(String(e && e.stack ? e.stack : e));
+        return undefined;
+      }
+    };
+    Phaser.Game = CapturingGame;
+    // Preserve a few expected static fields (best-effort).
+    Object.assign(Phaser.Game, OriginalGame);
+  } catch {
+    // ignore; still try to run
   }
+  return runtime;
+}
 
-  // IMPORTANT: Setup DOM environment BEFORE requiring Phaser
-  // Phaser checks for browser globals at load time
-  setupDomIfAvailable();
+// One virtual frame at 60 fps.
+const FRAME_MS = 1000 / 60;
+// Date.now() at virtual time 0, fixed so runs are reproducible (2024-01-01T00:00:00Z).
+const VIRTUAL_EPOCH_MS = Date.UTC(2024, 0, 1);
+// Frame callbacks that throw are recorded up to this many messages.
+const MAX_FRAME_ERRORS = 10;
 
-  const restoreRequire = setupRequireGuards();
-  try {
-    let Phaser;
+/**
+ * Deterministic clock for HEADLESS runs.
+ *
+ * requestAnimationFrame, timers, performance.now and Date read virtual time, which only moves
+ * when step() is called: each step runs the timers that became due (in due order, with the
+ * clock set to each timer's due time), then moves to the next frame time (FRAME_MS apart) and
+ * runs the animation-frame callbacks. Pending callbacks die with the clock, so nothing
+ * a sample scheduled can fire after its run.
+ */
+function createVirtualClock() {
+  let now = 0;
+  let nextId = 1;
+  let frameCallbacks = new Map();
+  const timers = new Map();
+  const errors = [];
+
+  function invoke(fn, args) {
     try {
-      Phaser = require("phaser");
+      fn(...args);
     } catch (e) {
-      result.crashed = true;
-      result.errors.push("missing_phaser", String(e && e.message ? e.message : e));
-      result.ms = Date.now() - t0;
-      process.stdout.write(JSON.stringify(result));
-      return;
+      if (errors.length < MAX_FRAME_ERRORS) errors.push(String(e && e.message ? e.message : e));
     }
+  }
 
-    global.Phaser = Phaser;
+  function schedule(fn, ms, args, repeat) {
+    if (typeof fn !== "function") throw new TypeError("Callback must be a function");
+    const id = nextId++;
+    // Delays are at least 1 ms so a callback that reschedules itself waits for the next step.
+    const delay = Math.max(1, Number(ms) || 0);
+    timers.set(id, { fn, args, delay, due: now + delay, repeat });
+    return id;
+  }
 
-    let capturedGame = null;
-    try {
-      const OriginalGame = Phaser.Game;
-      class CapturingGame extends OriginalGame {
-        constructor(config) {
-          super(config);
-          capturedGame = this;
+  function clear(id) {
+    timers.delete(id);
+  }
+
+  function VirtualDate(...args) {
+    if (!new.target) return new Date(VIRTUAL_EPOCH_MS + now).toString();
+    return args.length ? new Date(...args) : new Date(VIRTUAL_EPOCH_MS + now);
+  }
+  VirtualDate.prototype = Date.prototype;
+  VirtualDate.now = () => Math.floor(VIRTUAL_EPOCH_MS + now);
+  VirtualDate.parse = Date.parse;
+  VirtualDate.UTC = Date.UTC;
+
+  return {
+    errors,
+    frames: 0,
+    now: () => now,
+    Date: VirtualDate,
+    requestAnimationFrame(cb) {
+      const id = nextId++;
+      frameCallbacks.set(id, cb);
+      return id;
+    },
+    cancelAnimationFrame(id) {
+      frameCallbacks.delete(id);
+    },
+    setTimeout: (fn, ms, ...args) => schedule(fn, ms, args, false),
+    setInterval: (fn, ms, ...args) => schedule(fn, ms, args, true),
+    clearTimeout: clear,
+    clearInterval: clear,
+    hasPending() {
+      return frameCallbacks.size > 0 || timers.size > 0;
+    },
+    step() {
+      this.frames += 1;
+      // Frame time from the frame count (no drift); timers run at their own due time.
+      const frameTime = this.frames * FRAME_MS;
+      for (;;) {
+        let nextTimerId = null;
+        let next = null;
+        for (const [id, t] of timers) {
+          if (t.due <= frameTime && (!next || t.due < next.due)) {
+            nextTimerId = id;
+            next = t;
+          }
         }
+        if (!next) break;
+        now = Math.max(now, next.due);
+        if (next.repeat) next.due += next.delay;
+        else timers.delete(nextTimerId);
+        invoke(next.fn, next.args);
       }
-      Phaser.Game = CapturingGame;
-      // Preserve a few expected static fields (best-effort).
-      Object.assign(Phaser.Game, OriginalGame);
-    } catch {
-      // ignore; still try to run
+      now = frameTime;
+      const callbacks = frameCallbacks;
+      frameCallbacks = new Map();
+      for (const cb of callbacks.values()) invoke(cb, [now]);
+    },
+  };
+}
+
+/**
+ * Point the shared window's frame, timer and performance.now functions at `clock` for one run
+ * (Phaser's loop reads them from window). Returns a function that restores the originals.
+ */
+function installClock(clock) {
+  const win = global.window;
+  if (!win) return () => {};
+  const names = ["requestAnimationFrame", "cancelAnimationFrame", "setTimeout", "clearTimeout", "setInterval", "clearInterval"];
+  const saved = names.map((name) => [name, win[name]]);
+  for (const name of names) win[name] = clock[name];
+  const perf = win.performance;
+  const hadNow = perf && Object.prototype.hasOwnProperty.call(perf, "now");
+  const savedNow = hadNow ? perf.now : null;
+  if (perf) Object.defineProperty(perf, "now", { configurable: true, writable: true, value: clock.now });
+  return () => {
+    for (const [name, fn] of saved) win[name] = fn;
+    if (perf) {
+      if (hadNow) perf.now = savedNow;
+      else delete perf.now;
     }
+  };
+}
 
-    const sandbox = {
-      Phaser,
-      console,
-      setTimeout,
-      clearTimeout,
-      setInterval,
-      clearInterval,
-      window: global.window || global,
-      document: global.document || {},
-    };
-    sandbox.globalThis = sandbox;
+// How far snapshotRealm follows data properties from each root (e.g. Phaser.Physics.Arcade.Sprite is 3).
+const REALM_ROOT_DEPTHS = [
+  ["Phaser", 4],
+  ["window", 2],
+  ["global", 2],
+];
+
+function sameDescriptor(a, b) {
+  return (
+    Object.is(a.value, b.value) &&
+    a.get === b.get &&
+    a.set === b.set &&
+    a.writable === b.writable &&
+    a.enumerable === b.enumerable &&
+    a.configurable === b.configurable
+  );
+}
 
+/**
+ * Record the own properties of the shared objects a pooled sample can modify in place: the
+ * Phaser namespace with its classes and prototypes, the jsdom window (its DOM interfaces and
+ * their prototypes) and the host realm's global and built-in prototypes. Arrays and typed
+ * arrays are not recorded element by element. restoreRealm puts these objects back after
+ * each run, so e.g. `Phaser.Scene.prototype.update = ...` or `window.foo = 1` in one sample
+ * is not seen by the next.
+ */
+function snapshotRealm(runtime) {
+  const roots = { Phaser: runtime.Phaser, window: global.window, global };
+  // Element ids/names are live named properties of window; cleanupRun resets them with the body.
+  const named = new Set();
+  if (global.document && typeof global.document.querySelectorAll === "function") {
+    for (const el of global.document.querySelectorAll("[id], [name]")) {
+      if (el.id) named.add(el.id);
+      if (el.getAttribute("name")) named.add(el.getAttribute("name"));
+    }
+  }
+  const saved = new Map();
+  // Objects reachable along several paths are walked from the shallowest one.
+  const walked = new Map();
+  const visit = (obj, depth) => {
+    if (obj === null || (typeof obj !== "object" && typeof obj !== "function")) return;
+    if (Array.isArray(obj) || ArrayBuffer.isView(obj)) return;
+    if (walked.has(obj) && walked.get(obj) >= depth) return;
+    walked.set(obj, depth);
+    if (!saved.has(obj)) record(obj);
+    const entry = saved.get(obj);
+    if (!entry || depth <= 0) return;
+    for (const [key, d] of entry.descriptors) {
+      if (!("value" in d)) continue;
+      // A class's prototype is always recorded, but its methods are not walked.
+      if (typeof obj === "function" && key === "prototype") visit(d.value, 0);
+      else visit(d.value, depth - 1);
+    }
+  };
+  const record = (obj) => {
+    const descriptors = new Map();
+    const ignore = new Set(obj === global.window ? named : []);
     try {
-      vm.runInNewContext(code, sandbox, {
-        filename: path.basename(codeFile),
-        timeout: 500,
-      });
-    } catch (e) {
-      result.crashed = true;
-      result.errors.push("runtime_eval_failed", String(e && e.message ? e.message : e));
-      result.ms = Date.now() - t0;
-      process.stdout.write(JSON.stringify(result));
+      for (const key of Reflect.ownKeys(obj)) {
+        if (ignore.has(key)) continue;
+        const d = Reflect.getOwnPropertyDescriptor(obj, key);
+        // jsdom's window lists its own EventTarget methods without a descriptor.
+        if (d) descriptors.set(key, d);
+        else ignore.add(key);
+      }
+    } catch {
       return;
     }
+    saved.set(obj, { extensible: Object.isExtensible(obj), descriptors, ignore });
+  };
+  for (const [name, depth] of REALM_ROOT_DEPTHS) visit(roots[name], depth);
+  return saved;
+}
 
-    await new Promise((r) => setTimeout(r, runMs));
-
-    result.signals.game_created = Boolean(capturedGame);
-    if (capturedGame && typeof capturedGame.destroy === "function") {
-      try {
-        capturedGame.destroy(true);
-      } catch {
-        // ignore
+/**
+ * Put the objects recorded by snapshotRealm back: delete own properties added since, and
+ * redefine ones that were changed or removed. Returns false when that was not possible
+ * (non-configurable properties, objects made non-extensible), so the worker is replaced.
+ */
+function restoreRealm(snapshot) {
+  let ok = true;
+  for (const [obj, { extensible, descriptors, ignore }] of snapshot) {
+    try {
+      if (extensible && !Object.isExtensible(obj)) ok = false;
+      for (const key of Reflect.ownKeys(obj)) {
+        if (!descriptors.has(key) && !ignore.has(key) && !Reflect.deleteProperty(obj, key)) ok = false;
+      }
+      for (const [key, d] of descriptors) {
+        const current = Reflect.getOwnPropertyDescriptor(obj, key);
+        if (current && sameDescriptor(current, d)) continue;
+        if (!Reflect.defineProperty(obj, key, d)) ok = false;
       }
+    } catch {
+      ok = false;
+    }
+  }
+  return ok;
+}
+
+/**
+ * Tear down what a run left behind. Returns false when the shared state could not be
+ * reset, in which case a worker should be replaced rather than reused.
+ */
+function cleanupRun(runtime) {
+  let clean = true;
+  const game = runtime.capturedGame;
+  runtime.capturedGame = null;
+  if (game && typeof game.destroy === "function") {
+    try {
+      game.destroy(true);
+      // destroy() only flags the game; the loop tears it down on its next step.
+      // Do it now so the loop stops before the next sample starts.
+      if (game.isRunning && game.pendingDestroy) game.runDestroy();
+    } catch {
+      clean = false;
     }
+  }
+  try {
+    if (global.window) delete global.window.PHASER_GAME;
+    if (global.document && global.document.body) {
+      global.document.body.innerHTML = "<div id=\"game\"></div>";
+    }
+  } catch {
+    clean = false;
+  }
+  return clean;
+}
+
+/**
+ * Run one sample in a fresh vm context against a loaded runtime, stepping `frames` virtual
+ * frames (see createVirtualClock). Returns { result, clean }; see cleanupRun for `clean`.
+ */
+async function runSample(runtime, code, { filename, frames }) {
+  const steps = Math.max(1, Math.floor(frames || 60));
+  const result = { ok: false, crashed: false, ms: 0, logs: [], errors: [], signals: {} };
+  const t0 = Date.now();
 
-    result.ok = Boolean(capturedGame);
+  if (runtime.error) {
+    result.crashed = true;
+    result.errors.push(...runtime.error);
+    result.ms = Date.now() - t0;
+    return { result, clean: true };
+  }
+
+  runtime.capturedGame = null;
+  const clock = createVirtualClock();
+  const restoreClock = installClock(clock);
+  const sandbox = {
+    Phaser: runtime.Phaser,
+    console,
+    setTimeout: clock.setTimeout,
+    clearTimeout: clock.clearTimeout,
+    setInterval: clock.setInterval,
+    clearInterval: clock.clearInterval,
+    requestAnimationFrame: clock.requestAnimationFrame,
+    cancelAnimationFrame: clock.cancelAnimationFrame,
+    Date: clock.Date,
+    performance: (global.window && global.window.performance) || { now: clock.now },
+    window: global.window || global,
+    document: global.document || {},
+  };
+  sandbox.globalThis = sandbox;
+
+  try {
+    vm.runInNewContext(code, sandbox, { filename, timeout: 500 });
+  } catch (e) {
+    result.crashed = true;
+    result.errors.push("runtime_eval_failed", String(e && e.message ? e.message : e));
+  }
+
+  if (!result.crashed) {
+    // Boot (DOMContentLoaded on a fresh document, default texture loads) arrives as real
+    // events, so yield to the event loop before each step instead of waiting wall time.
+    for (let i = 0; i < steps; i++) {
+      await new Promise((r) => setImmediate(r));
+      clock.step();
+    }
+    const game = runtime.capturedGame;
+    result.signals.game_created = Boolean(game);
+    result.signals.loop_started = Boolean(game && game.isRunning);
+    result.signals.frames = clock.frames;
+    result.signals.virtual_ms = Math.round(clock.now() * 100) / 100;
+    // An uncaught exception in a sample timer used to kill the child; treat exceptions from
+    // any virtual callback (timers and frames) as a crash the same way.
+    if (clock.errors.length) {
+      result.crashed = true;
+      result.errors.push("runtime_frame_error", ...clock.errors);
+    }
+    result.ok = Boolean(game) && !result.crashed;
+  }
+
+  let clean = cleanupRun(runtime);
+  restoreClock();
+  if (runtime.realm && !restoreRealm(runtime.realm)) clean = false;
+  result.ms = Date.now() - t0;
+  return { result, clean };
+}
+
+/**
+ * Worker mode (`--worker`, forked by runtime_pool.js): load the runtime once and run
+ * every sample received over IPC, each in its own vm context.
+ *
+ * In:  { type: "run", id, code, filename, frames }
+ * Out: { type: "ready", rss } once loaded, then { type: "result", id, result, clean, rss } per run.
+ */
+function runWorker() {
+  const runtime = loadRuntime();
+  // Taken before the first run: every run starts from the state a fresh worker has.
+  if (!runtime.error) runtime.realm = snapshotRealm(runtime);
+  let currentId = null;
+
+  // Something the sample started failed outside the clock (e.g. an unhandled promise rejection):
+  // a one-shot child would exit non-zero here, so report the run as crashed and exit; the pool
+  // starts a replacement.
+  process.on("uncaughtException", (e) => {
+    if (currentId == null) process.exit(1);
+    const result = {
+      ok: false,
+      crashed: true,
+      ms: 0,
+      logs: [],
+      errors: ["runtime_exec_error", String(e && e.message ? e.message : e)],
+      signals: {},
+    };
+    process.send({ type: "result", id: currentId, result, clean: false, rss: process.memoryUsage().rss }, () =>
+      process.exit(1)
+    );
+    currentId = null;
+  });
+  process.on("disconnect", () => process.exit(0));
+
+  process.on("message", async (msg) => {
+    if (!msg || msg.type !== "run") return;
+    currentId = msg.id;
+    const { result, clean } = await runSample(runtime, String(msg.code || ""), {
+      filename: msg.filename || "generated.js",
+      frames: msg.frames,
+    });
+    if (currentId !== msg.id) return;
+    currentId = null;
+    process.send({ type: "result", id: msg.id, result, clean, rss: process.memoryUsage().rss });
+  });
+
+  process.send({ type: "ready", rss: process.memoryUsage().rss });
+}
+
+async function main() {
+  const args = parseArgs(process.argv);
+  if (args.worker) {
+    runWorker();
+    return;
+  }
+
+  const codeFile = args["code-file"];
+  const frames = args.frames ? Number(args.frames) : 60;
+  const t0 = Date.now();
+
+  if (!codeFile) {
+    const result = { ok: false, crashed: true, ms: 0, logs: [], errors: ["missing_code_file"], signals: {} };
+    result.ms = Date.now() - t0;
+    process.stdout.write(JSON.stringify(result));
+    return;
+  }
+
+  let code;
+  try {
+    code = fs.readFileSync(codeFile, "utf8");
+  } catch (e) {
+    const result = { ok: false, crashed: true, ms: 0, logs: [], errors: [], signals: {} };
+    result.errors.push("read_code_failed", String(e && e.message ? e.message : e));
+    result.ms = Date.now() - t0;
+    process.stdout.write(JSON.stringify(result));
+    return;
+  }
+
+  const runtime = loadRuntime();
+  try {
+    const { result } = await runSample(runtime, code, { filename: path.basename(codeFile), frames });
+    // One-shot timing includes DOM/Phaser setup, as before.
     result.ms = Date.now() - t0;
     process.stdout.write(JSON.stringify(result));
   } finally {
-    restoreRequire();
+    runtime.restoreRequire();
   }
 }
 
@@ -0,0 +1,209 @@
+// 预热的运行时 worker 池：复用已加载 JSDOM/Phaser 的子进程执行 HEADLESS 验证。
+const path = require("path");
+const { fork } = require("child_process");
+
+const MB = 1024 * 1024;
+// Keep only the tail of a worker's stderr (jsdom reports uncaught sample errors there).
+const STDERR_TAIL = 64 * 1024;
+// Consecutive workers that die before becoming ready before queued runs are failed.
+const MAX_START_FAILURES = 3;
+
+function failure(code, message, logs) {
+  return { ok: false, ms: 0, crashed: true, logs: logs || [], errors: [code, message], signals: {} };
+}
+
+/**
+ * Pool of `runtime_child.js --worker` processes.
+ *
+ * Each worker builds the JSDOM environment and loads Phaser once, then runs samples in a
+ * fresh vm context per run. A worker is replaced after `maxRuns` runs, when its RSS grew by
+ * more than `maxRssGrowthMb` since it became ready, when a run could not be cleaned up (e.g. a
+ * sample froze a shared object, so it could not be restored), and when it crashes or exceeds a
+ * run's timeout (it is killed). `timeoutMs` covers the run only;
+ * start-up is bounded separately by `startTimeoutMs`.
+ *
+ * Replacement after maxRuns / RSS growth is make-before-break: the worker keeps serving while
+ * its successor boots (~0.6 s) and is retired once the successor is ready, so that start-up
+ * stays off the critical path. Workers that crashed, timed out or could not clean up are
+ * dropped immediately.
+ */
+class RuntimePool {
+  constructor({ size = 1, maxRuns = 100, maxRssGrowthMb = 256, startTimeoutMs = 20000 } = {}) {
+    this.size = Math.max(1, Math.floor(size) || 1);
+    this.maxRuns = maxRuns > 0 ? maxRuns : Infinity;
+    this.maxRssGrowth = maxRssGrowthMb > 0 ? maxRssGrowthMb * MB : Infinity;
+    this.startTimeoutMs = startTimeoutMs;
+    this.childPath = path.join(__dirname, "runtime_child.js");
+    this.workers = new Set();
+    this.queue = [];
+    this.seq = 0;
+    this.startFailures = 0;
+    this.closed = false;
+    this.stats = { spawned: 0, recycled: 0, crashed: 0, timeouts: 0, runs: 0 };
+  }
+
+  /** Start workers up to `size` (not counting retiring ones) so runs do not pay the load. */
+  warm() {
+    let active = 0;
+    for (const worker of this.workers) if (!worker.retiring) active += 1;
+    for (; !this.closed && active < this.size; active++) this.spawn();
+  }
+
+  /** Run one sample; resolves to the runtime_child result object (never rejects). */
+  run({ code, filename, frames, timeoutMs }) {
+    return new Promise((resolve) => {
+      if (this.closed) {
+        resolve(failure("runtime_pool_closed", "Runtime pool is closed"));
+        return;
+      }
+      this.queue.push({
+        id: ++this.seq,
+        code,
+        filename: filename || "generated.js",
+        frames: frames || 60,
+        timeoutMs: timeoutMs || 1500,
+        resolve,
+      });
+      this.warm();
+      this.dispatch();
+    });
+  }
+
+  close() {
+    this.closed = true;
+    for (const worker of this.workers) {
+      clearTimeout(worker.timer);
+      worker.child.kill();
+    }
+    this.workers.clear();
+    for (const job of this.queue.splice(0)) {
+      job.resolve(failure("runtime_pool_closed", "Runtime pool is closed"));
+    }
+  }
+
+  spawn() {
+    const child = fork(this.childPath, ["--worker"], { stdio: ["ignore", "ignore", "pipe", "ipc"] });
+    const worker = { child, ready: false, retiring: false, runs: 0, baseRss: 0, job: null, timer: null, stderr: "" };
+    this.workers.add(worker);
+    this.stats.spawned += 1;
+
+    worker.timer = setTimeout(() => {
+      this.startFailures += 1;
+      this.remove(worker, "SIGKILL");
+    }, this.startTimeoutMs);
+    child.stderr.setEncoding("utf8");
+    child.stderr.on("data", (d) => {
+      worker.stderr = (worker.stderr + d).slice(-STDERR_TAIL);
+    });
+    child.on("message", (msg) => this.onMessage(worker, msg));
+    child.on("exit", (code, signal) => this.onExit(worker, code, signal));
+    child.on("error", (e) => this.remove(worker, "SIGKILL", String(e && e.message ? e.message : e)));
+  }
+
+  /** Idle workers that can be retired now because a non-retiring worker is ready. */
+  retireReplaced() {
+    let successorReady = false;
+    for (const worker of this.workers) if (worker.ready && !worker.retiring) successorReady = true;
+    if (!successorReady) return;
+    for (const worker of [...this.workers]) {
+      if (worker.retiring && !worker.job) this.remove(worker);
+    }
+  }
+
+  dispatch() {
+    // Prefer workers that are not about to be retired.
+    const idle = [...this.workers].filter((w) => w.ready && !w.job).sort((a, b) => a.retiring - b.retiring);
+    for (const worker of idle) {
+      if (!this.queue.length) return;
+      const job = this.queue.shift();
+      worker.job = job;
+      worker.stderr = "";
+      worker.timer = setTimeout(() => {
+        if (worker.job !== job) return;
+        worker.job = null;
+        this.stats.timeouts += 1;
+        job.resolve(failure("runtime_timeout", `Runtime run exceeded ${job.timeoutMs} ms`, this.logsOf(worker)));
+        this.remove(worker, "SIGKILL");
+      }, job.timeoutMs);
+      worker.child.send({ type: "run", id: job.id, code: job.code, filename: job.filename, frames: job.frames });
+    }
+  }
+
+  onMessage(worker, msg) {
+    if (!msg || !this.workers.has(worker)) return;
+    if (msg.type === "ready") {
+      clearTimeout(worker.timer);
+      worker.ready = true;
+      worker.baseRss = msg.rss || 0;
+      this.startFailures = 0;
+      this.retireReplaced();
+      this.dispatch();
+      return;
+    }
+    if (msg.type !== "result" || !worker.job || worker.job.id !== msg.id) return;
+
+    clearTimeout(worker.timer);
+    const job = worker.job;
+    worker.job = null;
+    worker.runs += 1;
+    this.stats.runs += 1;
+    job.resolve(msg.result || failure("empty_runtime_output", "Runtime worker sent no result"));
+
+    if (msg.clean === false) {
+      this.stats.recycled += 1;
+      this.remove(worker);
+      return;
+    }
+    const grown = (msg.rss || 0) - worker.baseRss > this.maxRssGrowth;
+    if (!worker.retiring && (worker.runs >= this.maxRuns || grown)) {
+      worker.retiring = true;
+      this.stats.recycled += 1;
+      this.warm();
+    }
+    this.retireReplaced();
+    this.dispatch();
+  }
+
+  onExit(worker, code, signal) {
+    if (!this.workers.has(worker)) return;
+    if (!worker.ready) this.startFailures += 1;
+    this.remove(worker, null, `Runtime worker exited (code=${code}, signal=${signal})`);
+  }
+
+  /**
+   * Drop a worker (killing it if still alive) and start a replacement.
+   * A run still assigned to it fails with runtime_exec_error.
+   */
+  remove(worker, signal, reason) {
+    if (!this.workers.has(worker)) return;
+    this.workers.delete(worker);
+    clearTimeout(worker.timer);
+    if (worker.child.exitCode == null && worker.child.signalCode == null) worker.child.kill(signal || "SIGTERM");
+    const job = worker.job;
+    worker.job = null;
+    if (job) {
+      this.stats.crashed += 1;
+      job.resolve(failure("runtime_exec_error", reason || "Runtime worker failed", this.logsOf(worker)));
+    }
+    if (this.closed) return;
+
+    if (this.startFailures >= MAX_START_FAILURES) {
+      // Workers cannot start (e.g. a broken install): fail what is queued instead of looping.
+      // The next run() tries again.
+      this.startFailures = 0;
+      const logs = this.logsOf(worker);
+      for (const job of this.queue.splice(0)) {
+        job.resolve(failure("runtime_worker_start_failed", "Runtime worker failed to start", logs));
+      }
+      return;
+    }
+    this.warm();
+    this.dispatch();
+  }
+
+  logsOf(worker) {
+    return worker.stderr ? [worker.stderr] : [];
+  }
+}
+
+module.exports = { RuntimePool };
@@ -4,16 +4,35 @@ API BM25 检索模块
 提供基于 BM25 算法的 Phaser3 API 检索功能，用于教师模型 Prompt 的上下文注入。
 """
 
+import heapq
+import json
 import math
 import re
+import threading
 from collections import Counter
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple, Union
 from pathlib import Path
 
-from common import read_jsonl, get_stage0_path, get_logger
+try:
+    import numpy as np
+    from scipy import sparse
+    HAS_SPARSE = True
+except ImportError:
+    np = None
+    sparse = None
+    HAS_SPARSE = False
+
+from common import read_jsonl, get_stage0_path, get_logger, LRUCache
+from api_index_compiled import (
+    CompiledIndex, CompiledPostings, LazyDocuments,
+    default_compiled_path, is_fresh, source_key, write_compiled
+)
 
 logger = get_logger(__name__)
 
+# 分词逻辑变更时递增，使旧的编译产物失效
+TOKENIZER_VERSION = 1
+
 
 class BM25Index:
     """
@@ -33,12 +52,16 @@ class BM25Index:
         self.min_token_len = min_token_len
 
         self.documents: List[dict] = []
-        self.doc_tokens: List[List[str]] = []
         self.doc_lens: List[int] = []
         self.avgdl: float = 0.0
         self.df: Counter = Counter()  # document frequency
         self.idf: Dict[str, float] = {}
         self.n_docs: int = 0
+        # 倒排表：term -> [(doc_id, tf), ...]，doc_id 升序；从编译产物加载时为 CompiledPostings
+        self.postings: Union[Dict[str, List[Tuple[int, int]]], CompiledPostings] = {}
+        # 批量检索用的 term x doc BM25 权重矩阵（CSR，按需构建）
+        self._term_ids: Dict[str, int] = {}
+        self._weights = None
 
     def _tokenize(self, text: str) -> List[str]:
         """
@@ -69,6 +92,14 @@ class BM25Index:
 
         return tokens
 
+    def query_key(self, query: str) -> Tuple[str, ...]:
+        """
+        查询的规范化键：分词结果的多重集合（排序后的 token 元组）
+
+        BM25 分数只依赖查询词及其出现次数，与词序无关。
+        """
+        return tuple(sorted(self._tokenize(query)))
+
     def _build_search_text(self, api: dict) -> str:
         """构建用于索引的文本"""
         parts = [
@@ -88,17 +119,20 @@ class BM25Index:
             apis: API 记录列表
         """
         self.documents = apis
-        self.doc_tokens = []
+        self._weights = None
         self.doc_lens = []
         self.df = Counter()
+        self.postings = {}
 
-        for api in apis:
+        for doc_idx, api in enumerate(apis):
             text = self._build_search_text(api)
             tokens = self._tokenize(text)
-            self.doc_tokens.append(tokens)
+            tf = Counter(tokens)
             self.doc_lens.append(len(tokens))
             # 计算 df（每个文档只计算一次）
-            self.df.update(set(tokens))
+            self.df.update(tf.keys())
+            for term, f in tf.items():
+                self.postings.setdefault(term, []).append((doc_idx, f))
 
         self.n_docs = len(apis)
         self.avgdl = sum(self.doc_lens) / self.n_docs if self.n_docs > 0 else 0
@@ -109,22 +143,53 @@ class BM25Index:
 
         logger.info(f"Built BM25 index with {self.n_docs} documents")
 
-    def _score(self, query_tokens: List[str], doc_idx: int) -> float:
-        """计算单个文档的 BM25 分数"""
-        doc_tokens = self.doc_tokens[doc_idx]
-        doc_len = self.doc_lens[doc_idx]
-        tf = Counter(doc_tokens)
+    def tokenizer_key(self) -> dict:
+        """编译产物中需要匹配的分词参数"""
+        return {'tokenizer': {'version': TOKENIZER_VERSION, 'min_token_len': self.min_token_len}}
+
+    @classmethod
+    def from_compiled(
+        cls,
+        compiled_path: Union[str, Path],
+        index_path: Union[str, Path],
+        k1: float = 1.5,
+        b: float = 0.75
+    ) -> 'BM25Index':
+        """
+        从编译产物加载索引（不解析 JSONL，原始记录按需读取）
 
-        score = 0.0
+        Args:
+            compiled_path: 编译产物路径
+            index_path: 源 JSONL 路径（用于按偏移读取记录）
+        """
+        compiled = CompiledIndex(compiled_path)
+        header = compiled.header
+
+        index = cls(k1=k1, b=b, min_token_len=header['tokenizer']['min_token_len'])
+        terms = compiled.strings('terms')
+        index.idf = dict(zip(terms, compiled.numbers('idf')))
+        index.postings = CompiledPostings(compiled, terms)
+        index.doc_lens = compiled.numbers('doc_lens')
+        index.documents = LazyDocuments(index_path, compiled.numbers('doc_offsets'))
+        index.n_docs = header['n_docs']
+        index.avgdl = header['avgdl']
+
+        logger.info(f"Loaded compiled BM25 index with {index.n_docs} documents from {compiled_path}")
+        return index
+
+    def _score_postings(self, query_tokens: List[str]) -> Dict[int, float]:
+        """基于倒排表计算命中文档的 BM25 分数（只访问包含查询词的文档）"""
+        scores: Dict[int, float] = {}
         for term in query_tokens:
-            if term not in self.idf:
+            idf = self.idf.get(term)
+            if idf is None:
                 continue
-            f = tf.get(term, 0)
-            numerator = f * (self.k1 + 1)
-            denominator = f + self.k1 * (1 - self.b + self.b * doc_len / self.avgdl)
-            score += self.idf[term] * numerator / denominator
-
-        return score
+            for doc_idx, f in self.postings.get(term, []):
+                doc_len = self.doc_lens[doc_idx]
+                numerator = f * (self.k1 + 1)
+                denominator = f + self.k1 * (1 - self.b + self.b * doc_len / self.avgdl)
+                scores[doc_idx] = scores.get(doc_idx, 0.0) + idf * numerator / denominator
+        return scores
 
     def search(self, query: str, top_k: int = 20) -> List[dict]:
         """
@@ -144,23 +209,174 @@ class BM25Index:
         if not query_tokens:
             return []
 
-        # 计算所有文档的分数
-        scores = []
-        for i in range(self.n_docs):
-            score = self._score(query_tokens, i)
-            if score > 0:
-                scores.append((i, score))
+        scores = [(i, score) for i, score in self._score_postings(query_tokens).items() if score > 0]
 
-        # 排序并返回 top-k
-        scores.sort(key=lambda x: x[1], reverse=True)
+        # 堆取 top-k：分数降序，同分按文档顺序
+        top = heapq.nsmallest(top_k, scores, key=lambda x: (-x[1], x[0]))
         results = []
-        for i, score in scores[:top_k]:
+        for i, score in top:
             api = self.documents[i].copy()
             api['_score'] = round(score, 4)
             results.append(api)
 
         return results
 
+    def _build_weights(self) -> None:
+        """构建 term x doc 的 BM25 权重矩阵（行即倒排表）"""
+        if isinstance(self.postings, CompiledPostings):
+            terms = self.postings.terms
+            ptr, docs, tfs = self.postings.arrays()
+            ptr = np.asarray(ptr, dtype=np.int64)
+            docs = np.asarray(docs, dtype=np.int32)
+            tfs = np.asarray(tfs, dtype=np.float64)
+        else:
+            terms = list(self.postings)
+            counts = [len(self.postings[t]) for t in terms]
+            ptr = np.zeros(len(terms) + 1, dtype=np.int64)
+            np.cumsum(counts, out=ptr[1:])
+            docs = np.fromiter((d for t in terms for d, _ in self.postings[t]), dtype=np.int32, count=int(ptr[-1]))
+            tfs = np.fromiter((f for t in terms for _, f in self.postings[t]), dtype=np.float64, count=int(ptr[-1]))
+
+        doc_lens = np.asarray(self.doc_lens, dtype=np.float64)
+        idf = np.array([self.idf[t] for t in terms], dtype=np.float64)
+        row_idf = np.repeat(idf, np.diff(ptr))
+        norm = self.k1 * (1 - self.b + self.b * doc_lens[docs] / self.avgdl)
+        data = row_idf * tfs * (self.k1 + 1) / (tfs + norm)
+
+        self._term_ids = {t: i for i, t in enumerate(terms)}
+        self._weights = sparse.csr_matrix((data, docs, ptr), shape=(len(terms), self.n_docs))
+
+    def search_batch(
+        self,
+        queries: List[str],
+        top_k: int = 20,
+        chunk_size: int = 256
+    ) -> List[List[dict]]:
+        """
+        批量搜索 API
+
+        安装了 numpy/scipy 时，每批查询用一次稀疏矩阵乘法打分、argpartition 取 top-k；
+        否则逐条调用 search。
+
+        Args:
+            queries: 查询文本列表
+            top_k: 每条查询的返回数量
+            chunk_size: 每次矩阵乘法的查询条数（控制内存）
+
+        Returns:
+            与 queries 对齐的结果列表
+        """
+        if not HAS_SPARSE or not self.documents:
+            return [self.search(q, top_k) for q in queries]
+
+        if self._weights is None:
+            self._build_weights()
+
+        results: List[List[dict]] = []
+        for start in range(0, len(queries), chunk_size):
+            chunk = queries[start:start + chunk_size]
+
+            # 查询向量：词项计数（重复词项与 search 一样重复计分）
+            rows, cols = [], []
+            for qi, query in enumerate(chunk):
+                for term in self._tokenize(query):
+                    col = self._term_ids.get(term)
+                    if col is not None:
+                        rows.append(qi)
+                        cols.append(col)
+            q_matrix = sparse.csr_matrix(
+                (np.ones(len(rows)), (rows, cols)),
+                shape=(len(chunk), len(self._term_ids))
+            )
+            scores = (q_matrix @ self._weights).tocsr()
+
+            for qi in range(len(chunk)):
+                row = scores.getrow(qi)
+                doc_ids, vals = row.indices, row.data
+                mask = vals > 0
+                doc_ids, vals = doc_ids[mask], vals[mask]
+                if len(vals) > top_k:
+                    part = np.argpartition(-vals, top_k - 1)[:top_k]
+                    # 边界同分的文档按文档顺序补齐，与 search 一致
+                    kth = vals[part].min()
+                    keep = np.concatenate([np.flatnonzero(vals > kth), np.flatnonzero(vals == kth)])
+                    doc_ids, vals = doc_ids[keep], vals[keep]
+                order = np.lexsort((doc_ids, -vals))[:top_k]
+
+                hits = []
+                for i in order:
+                    api = self.documents[int(doc_ids[i])].copy()
+                    api['_score'] = round(float(vals[i]), 4)
+                    hits.append(api)
+                results.append(hits)
+
+        return results
+
+
+def compile_api_index(
+    index_path: Union[str, Path],
+    out_path: Optional[Union[str, Path]] = None,
+    min_token_len: int = 2
+) -> Path:
+    """
+    把 API 索引 JSONL 编译为二进制产物（符号表 + 倒排 + 文档长度 + idf）
+
+    Args:
+        index_path: 源 JSONL 路径
+        out_path: 输出路径，默认与源文件同名 .bin
+        min_token_len: 分词最小长度
+
+    Returns:
+        编译产物路径
+    """
+    index_path = Path(index_path)
+    out_path = Path(out_path) if out_path else default_compiled_path(index_path)
+
+    apis: List[dict] = []
+    offsets: List[int] = []
+    symbols: List[str] = []
+    # 与 validator 的 loadApiIndex 统计口径一致
+    stats = {'total_lines': 0, 'parsed': 0, 'skipped': 0}
+
+    offset = 0
+    with open(index_path, 'rb') as f:
+        for raw in f:
+            line_offset = offset
+            offset += len(raw)
+            stats['total_lines'] += 1
+            line = raw.strip()
+            if not line:
+                continue
+            try:
+                api = json.loads(line)
+            except json.JSONDecodeError:
+                stats['skipped'] += 1
+                continue
+            if not isinstance(api, dict):
+                # 能解析但不是对象（数组、数字等）：与 loadApiIndex 一样跳过
+                stats['skipped'] += 1
+                continue
+            apis.append(api)
+            offsets.append(line_offset)
+            symbol_id = api.get('symbol_id')
+            if isinstance(symbol_id, str) and symbol_id:
+                symbols.append(symbol_id)
+                stats['parsed'] += 1
+            else:
+                stats['skipped'] += 1
+
+    bm25 = BM25Index(min_token_len=min_token_len)
+    bm25.build(apis)
+
+    header = source_key(index_path)
+    header.update(bm25.tokenizer_key())
+    header['avgdl'] = bm25.avgdl
+    header['stats'] = stats
+
+    write_compiled(out_path, header, symbols, offsets, bm25.doc_lens, bm25.postings, bm25.idf)
+    logger.info(f"Compiled API index to {out_path} ({len(apis)} documents, {len(bm25.postings)} terms)")
+    return out_path
+
 
 class APIRetriever:
     """
@@ -172,29 +388,71 @@ class APIRetriever:
     def __init__(
         self,
         api_index_path: Optional[str] = None,
-        lazy_load: bool = True
+        lazy_load: bool = True,
+        use_compiled: bool = True,
+        cache_size: int = 4096
     ):
         """
         Args:
             api_index_path: API 索引文件路径，默认使用 stage0 的索引
             lazy_load: 是否延迟加载索引
+            use_compiled: 是否使用（并按需重建）编译产物
+            cache_size: 检索结果与上下文文本的 LRU 缓存容量
         """
         self.api_index_path = Path(api_index_path) if api_index_path else \
             get_stage0_path('data/api_index/phaser_api.jsonl')
+        self.use_compiled = use_compiled
         self.bm25: Optional[BM25Index] = None
+        # (query_key, top_k) -> 检索结果
+        self._search_cache = LRUCache(cache_size)
+        # (symbol_ids, max_apis, include_params) -> 上下文文本
+        self._context_cache = LRUCache(cache_size)
+        # symbol_id -> 文档下标（get_apis 时按需构建）
+        self._symbol_index: Optional[Dict[str, int]] = None
+        # 已告警过的缺失 symbol_id（每个只告警一次）
+        self._missing_symbols: set = set()
+        self._lock = threading.Lock()
 
         if not lazy_load:
             self._load()
 
     def _load(self) -> None:
-        """加载索引"""
+        """加载索引（线程安全）"""
         if self.bm25 is not None:
             return
+        with self._lock:
+            if self.bm25 is None:
+                self._load_index()
+
+    def ensure_compiled(self) -> Optional[Path]:
+        """
+        编译产物缺失或过期时重建，返回产物路径（不使用编译产物时返回 None）
+
+        多进程场景应在父进程启动进程池前调用一次，worker 只需 mmap 打开。
+        """
+        if not (self.use_compiled and self.api_index_path.exists()):
+            return None
+        compiled_path = default_compiled_path(self.api_index_path)
+        if not is_fresh(compiled_path, self.api_index_path, BM25Index().tokenizer_key()):
+            logger.info(f"Compiled API index missing or stale, rebuilding {compiled_path}")
+            compile_api_index(self.api_index_path, compiled_path)
+        return compiled_path
+
+    def _load_index(self) -> None:
+        """优先加载编译产物（过期则重建），失败时回退解析 JSONL"""
+        if self.use_compiled and self.api_index_path.exists():
+            try:
+                compiled_path = self.ensure_compiled()
+                self.bm25 = BM25Index.from_compiled(compiled_path, self.api_index_path)
+                return
+            except (OSError, ValueError) as e:
+                logger.warning(f"Compiled API index unavailable ({e}), falling back to JSONL")
 
         logger.info(f"Loading API index from {self.api_index_path}")
-        apis = read_jsonl(self.api_index_path)
-        self.bm25 = BM25Index()
-        self.bm25.build(apis)
+        apis = [api for api in read_jsonl(self.api_index_path) if isinstance(api, dict)]
+        bm25 = BM25Index()
+        bm25.build(apis)
+        self.bm25 = bm25
 
     def search(self, query: str, top_k: int = 20) -> List[dict]:
         """
@@ -208,7 +466,12 @@ class APIRetriever:
             匹配的 API 列表
         """
         self._load()
-        return self.bm25.search(query, top_k)
+        key = (self.bm25.query_key(query), top_k)
+        cached = self._search_cache.get(key)
+        if cached is None:
+            cached = self.bm25.search(query, top_k)
+            self._search_cache.set(key, cached)
+        return [api.copy() for api in cached]
 
     def search_for_prompt(
         self,
@@ -227,6 +490,91 @@ class APIRetriever:
         Returns:
             匹配的 API 列表
         """
+        return self.search(self.build_prompt_query(prompt), top_k)
+
+    def search_for_prompts(
+        self,
+        prompts: List[dict],
+        top_k: int = 20
+    ) -> List[List[dict]]:
+        """
+        批量根据 Prompt 搜索相关 API（见 BM25Index.search_batch）
+
+        Args:
+            prompts: Prompt 字典列表
+            top_k: 每个 Prompt 的返回数量
+
+        Returns:
+            与 prompts 对齐的 API 列表
+        """
+        self._load()
+        keys = []
+        resolved: Dict[tuple, List[dict]] = {}
+        pending: Dict[tuple, str] = {}
+        for prompt in prompts:
+            query = self.build_prompt_query(prompt)
+            key = (self.bm25.query_key(query), top_k)
+            keys.append(key)
+            if key in resolved or key in pending:
+                # 同批次内重复的查询只检索一次，计为命中
+                self._search_cache.record_hit()
+                continue
+            cached = self._search_cache.get(key)
+            if cached is None:
+                pending[key] = query
+            else:
+                resolved[key] = cached
+
+        if pending:
+            for key, hits in zip(pending, self.bm25.search_batch(list(pending.values()), top_k)):
+                self._search_cache.set(key, hits)
+                resolved[key] = hits
+
+        return [[api.copy() for api in resolved[key]] for key in keys]
+
+    def get_apis(self, symbol_ids: List[str]) -> List[dict]:
+        """
+        按 symbol_id 取回 API 记录（保持输入顺序，找不到的跳过；每个缺失的 symbol_id 只告警一次）
+
+        用于从请求中的 api_context_injected 重建 API 上下文。
+        """
+        self._load()
+        if self._symbol_index is None:
+            with self._lock:
+                if self._symbol_index is None:
+                    index: Dict[str, int] = {}
+                    for i, api in enumerate(self.bm25.documents):
+                        symbol_id = api.get('symbol_id')
+                        if symbol_id and symbol_id not in index:
+                            index[symbol_id] = i
+                    self._symbol_index = index
+
+        apis = []
+        missing = []
+        for symbol_id in symbol_ids:
+            i = self._symbol_index.get(symbol_id)
+            if i is None:
+                missing.append(symbol_id)
+                continue
+            apis.append(self.bm25.documents[i])
+
+        if missing:
+            with self._lock:
+                new = [s for s in dict.fromkeys(missing) if s not in self._missing_symbols]
+                self._missing_symbols.update(new)
+            if new:
+                logger.warning(f"{len(new)} API(s) not found in index {self.api_index_path}: {', '.join(new)}")
+        return apis
+
+    def cache_stats(self) -> dict:
+        """检索/上下文缓存的命中统计"""
+        return {
+            'search': self._search_cache.stats(),
+            'context': self._context_cache.stats()
+        }
+
+    def build_prompt_query(self, prompt: dict) -> str:
+        """从 prompt 的 task、tags、must_use_apis、modules 字段拼接查询文本"""
         query_parts = []
 
         # 提取任务描述
@@ -248,8 +596,7 @@ class APIRetriever:
         if 'modules' in prompt:
             query_parts.extend(prompt['modules'])
 
-        query = ' '.join(query_parts)
-        return self.search(query, top_k)
+        return ' '.join(query_parts)
 
     def format_api_context(
         self,
@@ -268,6 +615,25 @@ class APIRetriever:
         Returns:
             格式化的 API 上下文文本
         """
+        symbol_ids = tuple(api.get('symbol_id') for api in apis[:max_apis])
+        key = (symbol_ids, max_apis, include_params) if all(symbol_ids) else None
+        if key is not None:
+            cached = self._context_cache.get(key)
+            if cached is not None:
+                return cached
+
+        context = self._format_api_context(apis, max_apis, include_params)
+        if key is not None:
+            self._context_cache.set(key, context)
+        return context
+
+    def _format_api_context(
+        self,
+        apis: List[dict],
+        max_apis: int,
+        include_params: bool
+    ) -> str:
+        """format_api_context 的实际格式化逻辑（不走缓存）"""
         lines = []
 
         # 按 owner 分组
@@ -338,11 +704,16 @@ if __name__ == '__main__':
     parser.add_argument('--top-k', '-k', type=int, default=10, help='返回数量')
     parser.add_argument('--index', type=str, help='API 索引路径')
     parser.add_argument('--pretty', action='store_true', help='美化输出')
+    parser.add_argument('--compile', action='store_true', help='编译 API 索引为二进制产物（.bin）后退出')
+    parser.add_argument('--no-compiled', action='store_true', help='不使用编译产物，直接解析 JSONL')
 
     args = parser.parse_args()
 
-    if args.query:
-        retriever = APIRetriever(args.index)
+    if args.compile:
+        index_path = args.index or get_stage0_path('data/api_index/phaser_api.jsonl')
+        print(compile_api_index(index_path))
+    elif args.query:
+        retriever = APIRetriever(args.index, use_compiled=not args.no_compiled)
         results = retriever.search(args.query, args.top_k)
 
         if args.pretty:
@@ -352,8 +723,7 @@ if __name__ == '__main__':
                 print(f"   {api.get('signature', '')}")
                 print()
         else:
-            import json
             print(json.dumps(results, ensure_ascii=False, indent=2))
     else:
-        print("请使用 --query 参数指定查询文本")
+        print("请使用 --query 参数指定查询文本，或 --compile 编译索引")
         print("示例: python api_bm25.py --query '拖拽精灵' --top-k 10 --pretty")
@@ -0,0 +1,323 @@
+"""
+API 索引编译产物读写模块
+
+把 stage0 的 `phaser_api.jsonl` 预编译为一个紧凑的二进制文件（默认 `phaser_api.bin`），
+Python 侧（BM25 检索）与 Node 侧（validator 符号存在性检查）都直接读取，避免每次逐行 JSON 解析。
+
+文件布局：
+    MAGIC(8B) | header_len(uint32 LE) | header JSON | 各 section（8 字节对齐）
+
+header 中记录 meta.json 的 build_time/phaser_version 与源文件大小/mtime，
+任一不一致即视为过期，由调用方重新编译。
+
+Sections:
+    symbols      排序去重后的 symbol_id，'\\n' 分隔（Node 侧只读这一段）
+    doc_offsets  uint64，每个文档在 JSONL 中的字节偏移（按需读取原始记录）
+    doc_lens     uint32，文档长度（token 数）
+    terms        排序后的词项，'\\n' 分隔
+    idf          float64，与 terms 对齐
+    post_ptr     uint32，长度 n_terms + 1，词项 i 的倒排为 [post_ptr[i], post_ptr[i+1])
+    post_docs    uint32，倒排文档 id
+    post_tfs     uint32，倒排词频
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from common import read_json, ensure_dir, get_logger
+
+logger = get_logger(__name__)
+
+MAGIC = b'PAPIIDX1'
+FORMAT_VERSION = 1
+
+# section 名 -> array typecode（None 表示 '\n' 分隔的字符串表）
+SECTION_TYPES = {
+    'symbols': None,
+    'doc_offsets': 'Q',
+    'doc_lens': 'I',
+    'terms': None,
+    'idf': 'd',
+    'post_ptr': 'I',
+    'post_docs': 'I',
+    'post_tfs': 'I',
+}
+
+
+def default_compiled_path(index_path: Union[str, Path]) -> Path:
+    """编译产物默认路径：与 JSONL 同目录同名，后缀 .bin"""
+    return Path(index_path).with_suffix('.bin')
+
+
+def source_key(index_path: Union[str, Path]) -> dict:
+    """
+    计算源索引的版本键
+
+    使用同目录 meta.json 的 build_time/phaser_version，以及 JSONL 的大小与 mtime。
+    """
+    index_path = Path(index_path)
+    meta = read_json(index_path.parent / 'meta.json')
+    stat = index_path.stat()
+    return {
+        'phaser_version': meta.get('phaser_version', ''),
+        'build_time': meta.get('build_time', ''),
+        'source_size': stat.st_size,
+        'source_mtime_ns': str(stat.st_mtime_ns),
+    }
+
+
+def _pack_strings(items: List[str]) -> bytes:
+    return '\n'.join(items).encode('utf-8')
+
+
+def _pack_array(typecode: str, values) -> bytes:
+    arr = array(typecode, values)
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def write_compiled(
+    out_path: Union[str, Path],
+    header: dict,
+    symbols: List[str],
+    doc_offsets: List[int],
+    doc_lens: List[int],
+    postings: Dict[str, List[Tuple[int, int]]],
+    idf: Dict[str, float]
+) -> Path:
+    """
+    写入编译产物（先写临时文件再原子替换）
+
+    Args:
+        out_path: 输出路径
+        header: 额外 header 字段（版本键、分词参数、统计等）
+        symbols: symbol_id 列表（内部排序去重）
+        doc_offsets: 文档在 JSONL 中的字节偏移
+        doc_lens: 文档长度
+        postings: 词项 -> [(doc_id, tf), ...]（doc_id 升序）
+        idf: 词项 -> idf
+
+    Returns:
+        输出路径
+    """
+    out_path = Path(out_path)
+    ensure_dir(out_path.parent)
+
+    terms = sorted(postings)
+    post_ptr = [0]
+    post_docs: List[int] = []
+    post_tfs: List[int] = []
+    for term in terms:
+        for doc_id, tf in postings[term]:
+            post_docs.append(doc_id)
+            post_tfs.append(tf)
+        post_ptr.append(len(post_docs))
+
+    payloads = {
+        'symbols': _pack_strings(sorted(set(symbols))),
+        'doc_offsets': _pack_array('Q', doc_offsets),
+        'doc_lens': _pack_array('I', doc_lens),
+        'terms': _pack_strings(terms),
+        'idf': _pack_array('d', [idf[t] for t in terms]),
+        'post_ptr': _pack_array('I', post_ptr),
+        'post_docs': _pack_array('I', post_docs),
+        'post_tfs': _pack_array('I', post_tfs),
+    }
+
+    # section 偏移相对于数据区起点，header 长度不影响偏移
+    sections = {}
+    offset = 0
+    for name, data in payloads.items():
+        sections[name] = [offset, len(data)]
+        offset += len(data)
+        offset += (-offset) % 8
+
+    full_header = dict(header)
+    full_header.update({
+        'format_version': FORMAT_VERSION,
+        'n_docs': len(doc_lens),
+        'n_terms': len(terms),
+        'sections': sections,
+    })
+    header_bytes = json.dumps(full_header, ensure_ascii=False).encode('utf-8')
+    prefix_len = len(MAGIC) + 4 + len(header_bytes)
+    header_bytes += b' ' * ((-prefix_len) % 8)
+
+    # 临时文件名唯一，并发编译互不覆盖；最后一次 replace 胜出，产物总是完整的
+    fd, tmp_name = tempfile.mkstemp(prefix=out_path.name + '.', suffix='.tmp', dir=out_path.parent)
+    tmp_path = Path(tmp_name)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header_bytes)))
+            f.write(header_bytes)
+            written = 0
+            for name, data in payloads.items():
+                f.write(data)
+                written += len(data)
+                pad = (-written) % 8
+                f.write(b'\0' * pad)
+                written += pad
+        # mkstemp 创建的文件权限为 0600，改回按 umask 的默认权限
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        tmp_path.replace(out_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return out_path
+
+
+class CompiledIndex:
+    """
+    只读的编译产物视图（mmap）
+
+    数组 section 以 memoryview.cast 直接映射，不做整体拷贝。
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._file = open(self.path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"Not a compiled API index: {self.path}")
+        (header_len,) = struct.unpack_from('<I', self._mm, len(MAGIC))
+        start = len(MAGIC) + 4
+        self.header: dict = json.loads(bytes(self._mm[start:start + header_len]))
+        self._data_start = start + header_len
+
+    def _raw(self, name: str) -> memoryview:
+        offset, length = self.header['sections'][name]
+        begin = self._data_start + offset
+        return memoryview(self._mm)[begin:begin + length]
+
+    def strings(self, name: str) -> List[str]:
+        """读取字符串表 section"""
+        raw = bytes(self._raw(name))
+        return raw.decode('utf-8').split('\n') if raw else []
+
+    def numbers(self, name: str):
+        """读取数值 section（小端机器上零拷贝）"""
+        typecode = SECTION_TYPES[name]
+        raw = self._raw(name)
+        if sys.byteorder == 'little':
+            return raw.cast(typecode)
+        arr = array(typecode, bytes(raw))
+        arr.byteswap()
+        return arr
+
+    def close(self) -> None:
+        try:
+            self._mm.close()
+        except (BufferError, ValueError):
+            # 仍有 memoryview 引用时无法关闭，交给 GC
+            pass
+        self._file.close()
+
+
+def is_fresh(
+    compiled_path: Union[str, Path],
+    index_path: Union[str, Path],
+    expected: Optional[dict] = None
+) -> bool:
+    """
+    判断编译产物是否与源索引匹配
+
+    Args:
+        compiled_path: 编译产物路径
+        index_path: 源 JSONL 路径
+        expected: 额外需要匹配的 header 字段（如分词参数）
+    """
+    compiled_path = Path(compiled_path)
+    if not compiled_path.exists() or not Path(index_path).exists():
+        return False
+    try:
+        compiled = CompiledIndex(compiled_path)
+    except (OSError, ValueError):
+        return False
+    try:
+        header = compiled.header
+        if header.get('format_version') != FORMAT_VERSION:
+            return False
+        wanted = source_key(index_path)
+        if expected:
+            wanted.update(expected)
+        return all(header.get(k) == v for k, v in wanted.items())
+    finally:
+        compiled.close()
+
+
+class CompiledPostings:
+    """
+    编译产物中的倒排表视图：term -> [(doc_id, tf), ...]
+
+    只在查询命中某个词项时才切片对应区间。
+    """
+
+    def __init__(self, compiled: CompiledIndex, terms: List[str]):
+        self.terms = terms
+        self._term_ids = {term: i for i, term in enumerate(terms)}
+        self._ptr = compiled.numbers('post_ptr')
+        self._docs = compiled.numbers('post_docs')
+        self._tfs = compiled.numbers('post_tfs')
+
+    def __contains__(self, term: str) -> bool:
+        return term in self._term_ids
+
+    def __len__(self) -> int:
+        return len(self._term_ids)
+
+    def arrays(self):
+        """返回 (post_ptr, post_docs, post_tfs) 原始数组"""
+        return self._ptr, self._docs, self._tfs
+
+    def get(self, term: str, default=None):
+        i = self._term_ids.get(term)
+        if i is None:
+            return default
+        start, end = self._ptr[i], self._ptr[i + 1]
+        return list(zip(self._docs[start:end], self._tfs[start:end]))
+
+
+class LazyDocuments:
+    """
+    按字节偏移从 JSONL 读取原始 API 记录的只读序列
+
+    检索只需要 top-k 记录，加载索引时无需解析整个 JSONL。
+    """
+
+    def __init__(self, index_path: Union[str, Path], offsets):
+        self.index_path = Path(index_path)
+        self._offsets = offsets
+        self._cache: Dict[int, dict] = {}
+        self._file = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, i: int) -> dict:
+        doc = self._cache.get(i)
+        if doc is None:
+            with self._lock:
+                if self._file is None:
+                    self._file = open(self.index_path, 'rb')
+                self._file.seek(self._offsets[i])
+                doc = json.loads(self._file.readline())
+            self._cache[i] = doc
+        return doc
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -5,13 +5,18 @@
 """
 
 import argparse
+import json
+import multiprocessing
+import os
 from pathlib import Path
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Union
 
 from common import (
-    read_jsonl, write_jsonl, write_json,
+    iter_jsonl, write_json,
     get_stage0_path, get_data_path, get_reports_path, ensure_dir,
-    get_logger, generate_report_summary, print_progress
+    get_logger, generate_report_summary, print_progress,
+    load_prompt_template, save_template_snapshot, repair_jsonl_tail
 )
 from api_bm25 import APIRetriever
 
@@ -24,7 +29,7 @@ TEACHER_PROMPT_TEMPLATE_PATH = Path(__file__).parent.parent / 'prompts' / 'teach
 def load_teacher_system_prompt() -> str:
     """加载教师系统提示词模板"""
     if TEACHER_PROMPT_TEMPLATE_PATH.exists():
-        return TEACHER_PROMPT_TEMPLATE_PATH.read_text(encoding='utf-8')
+        return load_prompt_template(TEACHER_PROMPT_TEMPLATE_PATH)
     else:
         logger.warning(f"Teacher prompt template not found at {TEACHER_PROMPT_TEMPLATE_PATH}")
         return "你是一个 Phaser3 游戏开发专家。\n\n{API_CONTEXT}"
@@ -86,42 +91,140 @@ def build_distill_request(
     api_retriever: APIRetriever,
     teacher_system_prompt: str,
     version: int,
-    top_k_apis: int = 20
+    top_k_apis: int = 20,
+    relevant_apis: list = None,
+    system_prompt_hash: str = None,
+    embed_system_prompt: bool = False
 ) -> dict:
     """
     构建单条蒸馏请求
 
+    默认只记录模板哈希与 api_context_injected（symbol_id 列表），
+    教师脚本据此从模板快照与 API 索引重建系统提示词。
+
     Args:
         prompt: Prompt 种子数据
         api_retriever: API 检索器
         teacher_system_prompt: 教师系统提示词模板
         version: 版本号 (1, 2, 3...)
         top_k_apis: 检索的 API 数量
+        relevant_apis: 已检索好的 API 列表（批量检索时传入，为 None 则单独检索）
+        system_prompt_hash: 模板哈希（见 save_template_snapshot）
+        embed_system_prompt: 是否额外写入完整的 system_prompt（旧格式）
 
     Returns:
         蒸馏请求字典
     """
     # 检索相关 API
-    relevant_apis = api_retriever.search_for_prompt(prompt, top_k_apis)
-    api_context = api_retriever.format_api_context(relevant_apis, top_k_apis)
-
-    # 构建系统提示词
-    system_prompt = teacher_system_prompt.replace('{API_CONTEXT}', api_context)
+    if relevant_apis is None:
+        relevant_apis = api_retriever.search_for_prompt(prompt, top_k_apis)
 
     # 构建用户提示词
     user_prompt = format_user_prompt(prompt)
 
-    return {
+    request = {
         'id': f"distill_{prompt['id']}_v{version}",
         'prompt_id': prompt['id'],
         'version': version,
-        'system_prompt': system_prompt,
+        'system_prompt_hash': system_prompt_hash,
         'user_prompt': user_prompt,
         'prompt_meta': prompt,
         'api_context_injected': [api.get('symbol_id', '') for api in relevant_apis],
         'created_at': datetime.now().isoformat()
     }
 
+    if embed_system_prompt:
+        api_context = api_retriever.format_api_context(relevant_apis, top_k_apis)
+        request['system_prompt'] = teacher_system_prompt.replace('{API_CONTEXT}', api_context)
+
+    return request
+
+
+# 进程池 worker 的只读状态（由 _init_worker 初始化）
+_worker_state: dict = {}
+
+
+def _init_worker(
+    api_index_path: Optional[str],
+    teacher_system_prompt: str,
+    system_prompt_hash: str,
+    embed_system_prompt: bool,
+    versions_per_prompt: int,
+    top_k_apis: int
+) -> None:
+    """
+    初始化 worker：每个进程加载一次检索器
+
+    编译后的 API 索引通过 mmap 打开，多个 worker 共享同一份只读页缓存。
+    """
+    retriever = APIRetriever(api_index_path)
+    retriever._load()
+    _worker_state.update({
+        'retriever': retriever,
+        'teacher_system_prompt': teacher_system_prompt,
+        'system_prompt_hash': system_prompt_hash,
+        'embed_system_prompt': embed_system_prompt,
+        'versions_per_prompt': versions_per_prompt,
+        'top_k_apis': top_k_apis
+    })
+
+
+def _build_chunk(prompts: List[dict]) -> Tuple[int, List[dict], dict]:
+    """
+    为一批 Prompt 构建所有版本的请求
+
+    Returns:
+        (worker pid, 请求列表, 该 worker 检索缓存的累计统计)
+    """
+    retriever = _worker_state['retriever']
+    top_k_apis = _worker_state['top_k_apis']
+    requests = []
+    for prompt, relevant_apis in zip(prompts, retriever.search_for_prompts(prompts, top_k_apis)):
+        for v in range(1, _worker_state['versions_per_prompt'] + 1):
+            requests.append(build_distill_request(
+                prompt=prompt,
+                api_retriever=retriever,
+                teacher_system_prompt=_worker_state['teacher_system_prompt'],
+                version=v,
+                top_k_apis=top_k_apis,
+                relevant_apis=relevant_apis,
+                system_prompt_hash=_worker_state['system_prompt_hash'],
+                embed_system_prompt=_worker_state['embed_system_prompt']
+            ))
+    return os.getpid(), requests, retriever.cache_stats()
+
+
+def _merge_cache_stats(per_worker: List[dict]) -> dict:
+    """合并各 worker 的检索缓存统计"""
+    merged = {}
+    for name in ('search', 'context'):
+        hits = sum(s[name]['hits'] for s in per_worker)
+        misses = sum(s[name]['misses'] for s in per_worker)
+        lookups = hits + misses
+        merged[name] = {
+            'lookups': lookups,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+            'size': sum(s[name]['size'] for s in per_worker),
+            'workers': len(per_worker)
+        }
+    return merged
+
+
+def collect_existing_request_ids(output_path: Union[str, Path]) -> set:
+    """
+    收集输出文件中已存在的请求 id（用于断点续跑）
+
+    若文件末尾是被中断写入的半行，先将其截掉，避免续写时与新记录粘连。
+    """
+    path = Path(output_path)
+    if not path.exists():
+        return set()
+
+    repair_jsonl_tail(path)
+    return {item['id'] for item in iter_jsonl(path) if isinstance(item, dict) and item.get('id')}
+
 
 def build_all_requests(
     prompts_path: str,
@@ -129,10 +232,17 @@ def build_all_requests(
     api_index_path: str = None,
     versions_per_prompt: int = 3,
     top_k_apis: int = 20,
-    report_path: str = None
+    report_path: str = None,
+    workers: int = 1,
+    chunk_size: int = 64,
+    resume: bool = False,
+    embed_system_prompt: bool = False
 ) -> dict:
     """
-    为所有 Prompt 构建蒸馏请求
+    为所有 Prompt 构建蒸馏请求（流式）
+
+    逐行读取 Prompt 种子库，按 chunk 交给进程池构建，结果按输入顺序边到边追加写入，
+    内存占用与 Prompt 总数无关。
 
     Args:
         prompts_path: Prompt 种子库路径
@@ -141,66 +251,123 @@ def build_all_requests(
         versions_per_prompt: 每个 Prompt 生成的版本数
         top_k_apis: 每个请求检索的 API 数量
         report_path: 报告输出路径
+        workers: 构建进程数（1 表示在当前进程内构建）
+        chunk_size: 每个任务包含的 Prompt 数
+        resume: 是否跳过输出文件中已存在的请求 id 并续写
+        embed_system_prompt: 是否在每条请求中写入完整 system_prompt（旧格式）
 
     Returns:
         构建报告
     """
-    logger.info(f"Loading prompts from {prompts_path}")
-    prompts = read_jsonl(prompts_path)
-    logger.info(f"Loaded {len(prompts)} prompts")
-
-    # 加载 API 检索器
-    api_retriever = APIRetriever(api_index_path)
+    existing_ids = collect_existing_request_ids(output_path) if resume else set()
+    if existing_ids:
+        logger.info(f"Resume: {len(existing_ids)} requests already in {output_path}")
 
-    # 加载教师提示词模板
+    # 加载教师提示词模板，并按内容哈希保存快照供教师脚本引用
     teacher_system_prompt = load_teacher_system_prompt()
+    template_dir = Path(output_path).parent / 'templates'
+    system_prompt_hash = save_template_snapshot(teacher_system_prompt, template_dir)
+    logger.info(f"Teacher prompt template {system_prompt_hash} saved to {template_dir}")
+
+    # 流式读取 Prompt，边读边统计；所有版本都已存在的 Prompt 不再检索
+    with open(prompts_path, 'r', encoding='utf-8') as f:
+        total_prompts = sum(1 for line in f if line.strip())
+    total = total_prompts * versions_per_prompt
+    logger.info(f"Streaming {total_prompts} prompts from {prompts_path}")
+
+    stats = {'prompts': 0, 'skipped_prompts': 0}
+    difficulty_dist: Dict[str, int] = {}
+    module_dist: Dict[str, int] = {}
+
+    def iter_chunks():
+        chunk = []
+        for prompt in iter_jsonl(prompts_path):
+            stats['prompts'] += 1
+            diff = prompt.get('difficulty', 'unknown')
+            difficulty_dist[diff] = difficulty_dist.get(diff, 0) + versions_per_prompt
+            for mod in prompt.get('modules', []):
+                module_dist[mod] = module_dist.get(mod, 0) + versions_per_prompt
+
+            if existing_ids and all(
+                f"distill_{prompt['id']}_v{v}" in existing_ids
+                for v in range(1, versions_per_prompt + 1)
+            ):
+                stats['skipped_prompts'] += 1
+                continue
+            chunk.append(prompt)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    init_args = (
+        api_index_path, teacher_system_prompt, system_prompt_hash,
+        embed_system_prompt, versions_per_prompt, top_k_apis
+    )
+    pool = None
+    if workers > 1:
+        # 编译产物只在父进程检查/重建一次，避免各 worker 同时编译同一个文件
+        try:
+            APIRetriever(api_index_path).ensure_compiled()
+        except (OSError, ValueError) as e:
+            logger.warning(f"Compiled API index unavailable ({e}), workers will fall back to JSONL")
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=init_args)
+        results = pool.imap(_build_chunk, iter_chunks())
+    else:
+        _init_worker(*init_args)
+        results = map(_build_chunk, iter_chunks())
 
-    # 构建请求
-    requests = []
-    total = len(prompts) * versions_per_prompt
-
-    for i, prompt in enumerate(prompts):
-        for v in range(1, versions_per_prompt + 1):
-            request = build_distill_request(
-                prompt=prompt,
-                api_retriever=api_retriever,
-                teacher_system_prompt=teacher_system_prompt,
-                version=v,
-                top_k_apis=top_k_apis
-            )
-            requests.append(request)
-
-        print_progress(
-            (i + 1) * versions_per_prompt,
-            total,
-            prefix='Building requests'
-        )
-
-    # 保存请求
+    # 构建并追加写入
     ensure_dir(Path(output_path).parent)
-    write_jsonl(output_path, requests)
-    logger.info(f"Saved {len(requests)} requests to {output_path}")
+    written = 0
+    skipped_existing = len(existing_ids)
+    worker_cache_stats: Dict[int, dict] = {}
+    try:
+        with open(output_path, 'a' if resume else 'w', encoding='utf-8') as out:
+            for pid, requests, cache_stats in results:
+                worker_cache_stats[pid] = cache_stats
+                for request in requests:
+                    if request['id'] in existing_ids:
+                        continue
+                    out.write(json.dumps(request, ensure_ascii=False) + '\n')
+                    written += 1
+                out.flush()
+                print_progress(written + skipped_existing, total, prefix='Building requests')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    logger.info(f"Wrote {written} requests to {output_path}")
+
+    cache_stats = _merge_cache_stats(list(worker_cache_stats.values()))
+    logger.info(
+        f"Retrieval cache: search hit rate {cache_stats['search']['hit_rate']:.1%} "
+        f"({cache_stats['search']['misses']} distinct queries), "
+        f"context hit rate {cache_stats['context']['hit_rate']:.1%}"
+    )
 
     # 生成报告
-    difficulty_dist = {}
-    module_dist = {}
-    for prompt in prompts:
-        diff = prompt.get('difficulty', 'unknown')
-        difficulty_dist[diff] = difficulty_dist.get(diff, 0) + versions_per_prompt
-
-        for mod in prompt.get('modules', []):
-            module_dist[mod] = module_dist.get(mod, 0) + versions_per_prompt
-
+    total_requests = stats['prompts'] * versions_per_prompt
     report = generate_report_summary(
         name='distill_requests',
-        total=len(requests),
-        passed=len(requests),
+        total=total_requests,
+        passed=total_requests,
         details={
-            'prompts_count': len(prompts),
+            'prompts_count': stats['prompts'],
             'versions_per_prompt': versions_per_prompt,
             'top_k_apis': top_k_apis,
+            'written': written,
+            'skipped_existing': skipped_existing,
+            'skipped_prompts': stats['skipped_prompts'],
+            'workers': workers,
+            'system_prompt_hash': system_prompt_hash,
+            'template_snapshot': str(template_dir / f'{system_prompt_hash}.txt'),
+            'embed_system_prompt': embed_system_prompt,
             'difficulty_distribution': difficulty_dist,
             'module_distribution': module_dist,
+            'retrieval_cache': cache_stats,
             'output_path': str(output_path)
         }
     )
@@ -250,6 +417,28 @@ def main():
         default=str(get_reports_path('distill_requests_report.json')),
         help='报告输出路径'
     )
+    parser.add_argument(
+        '--workers', '-w',
+        type=int,
+        default=1,
+        help='构建进程数（1 表示单进程）'
+    )
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=64,
+        help='每个任务包含的 Prompt 数'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='断点续跑：跳过输出文件中已存在的请求 id，追加写入'
+    )
+    parser.add_argument(
+        '--embed-system-prompt',
+        action='store_true',
+        help='在每条请求中写入完整 system_prompt（旧格式，文件体积大）'
+    )
 
     args = parser.parse_args()
 
@@ -259,11 +448,15 @@ def main():
         api_index_path=args.api_index,
         versions_per_prompt=args.versions,
         top_k_apis=args.top_k,
-        report_path=args.report
+        report_path=args.report,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        resume=args.resume,
+        embed_system_prompt=args.embed_system_prompt
     )
 
     print(f"\n构建完成！")
-    print(f"  - 总请求数: {report['total']}")
+    print(f"  - 总请求数: {report['total']}（本次写入 {report['details']['written']}）")
     print(f"  - 输出路径: {report['details']['output_path']}")
     print(f"  - 报告路径: {args.report}")
 
@@ -6,9 +6,13 @@ Stage1 公共工具函数模块
 
 import json
 import os
+import re
+import time
 import hashlib
 import logging
+import sqlite3
 import threading
+from collections import OrderedDict
 from pathlib import Path
 from typing import Any, Dict, Iterator, List, Optional, Union
 from datetime import datetime
@@ -142,6 +146,42 @@ def append_jsonl(path: Union[str, Path], item: dict) -> None:
         f.write(json.dumps(item, ensure_ascii=False) + '\n')
 
 
+def repair_jsonl_tail(path: Union[str, Path]) -> int:
+    """
+    截掉 JSONL 末尾被中断写入的半行（进程崩溃时可能留下）
+
+    Returns:
+        截掉的字节数
+    """
+    path = Path(path)
+    if not path.exists():
+        return 0
+
+    with open(path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return 0
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return 0
+        # 从尾部向前找最后一个换行
+        pos = size
+        while pos > 0:
+            step = min(65536, pos)
+            f.seek(pos - step)
+            chunk = f.read(step)
+            idx = chunk.rfind(b'\n')
+            if idx >= 0:
+                keep = pos - step + idx + 1
+                break
+            pos -= step
+        else:
+            keep = 0
+        f.truncate(keep)
+    logging.warning(f"Truncated partial last line in {path} ({size - keep} bytes)")
+    return size - keep
+
+
 def read_json(path: Union[str, Path]) -> dict:
     """读取 JSON 文件"""
     path = Path(path)
@@ -219,6 +259,245 @@ class JsonlCache:
         return True
 
 
+class LRUCache:
+    """
+    内存 LRU 缓存（线程安全），记录命中统计
+
+    用于缓存检索结果等纯函数计算。
+    """
+
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Any) -> Optional[Any]:
+        """获取缓存项（计入命中/未命中）"""
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+            return None
+
+    def record_hit(self) -> None:
+        """记录一次调用方自行复用结果的命中（如批次内重复的键），不访问缓存项"""
+        with self._lock:
+            self.hits += 1
+
+    def set(self, key: Any, value: Any) -> None:
+        """设置缓存项，超出容量时淘汰最久未使用的项"""
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def stats(self) -> dict:
+        """命中统计"""
+        lookups = self.hits + self.misses
+        return {
+            'lookups': lookups,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'size': len(self._cache),
+            'max_size': self.max_size
+        }
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+
+class ResponseCache:
+    """
+    基于 SQLite 的 API 响应缓存（按内容寻址，跨运行、跨输出文件复用）
+
+    - 键由调用方对 (模型, 提示词, 采样参数, 采样序号) 计算哈希
+    - ttl_seconds > 0 时过期条目在读取时失效，并在打开/关闭时清理
+    - max_entries > 0 时按最近访问时间淘汰多余条目
+    """
+
+    # 每写入多少条检查一次条目上限
+    TRIM_EVERY = 256
+
+    def __init__(self, path: Union[str, Path], ttl_seconds: float = 0, max_entries: int = 0):
+        self.path = Path(path)
+        ensure_dir(self.path.parent)
+        self.ttl_seconds = max(0.0, float(ttl_seconds))
+        self.max_entries = max(0, int(max_entries))
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, model TEXT, text TEXT NOT NULL, usage TEXT, '
+            'created_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed_at)')
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evicted = 0
+        self.evict()
+
+    def get(self, key: str) -> Optional[dict]:
+        """读取缓存项 {'text', 'usage', 'model', 'created_at'}，未命中或已过期返回 None"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT text, usage, model, created_at FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is not None and self.ttl_seconds and now - row[3] > self.ttl_seconds:
+                self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.evicted += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return {
+            'text': row[0],
+            'usage': json.loads(row[1]) if row[1] else None,
+            'model': row[2],
+            'created_at': row[3]
+        }
+
+    def set(self, key: str, text: str, usage: Optional[dict] = None, model: str = '') -> None:
+        """写入缓存项（线程安全）"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses (key, model, text, usage, created_at, accessed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, model, text, json.dumps(usage) if usage else None, now, now)
+            )
+            self.writes += 1
+            if self.max_entries and self.writes % self.TRIM_EVERY == 0:
+                self._trim_locked()
+
+    def _trim_locked(self) -> None:
+        (count,) = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                'DELETE FROM responses WHERE key IN '
+                '(SELECT key FROM responses ORDER BY accessed_at LIMIT ?)', (excess,)
+            )
+            self.evicted += excess
+
+    def evict(self) -> None:
+        """清理过期条目并裁剪到 max_entries"""
+        with self._lock:
+            if self.ttl_seconds:
+                cursor = self._conn.execute(
+                    'DELETE FROM responses WHERE created_at < ?', (time.time() - self.ttl_seconds,)
+                )
+                self.evicted += max(0, cursor.rowcount)
+            if self.max_entries:
+                self._trim_locked()
+
+    def stats(self) -> dict:
+        """命中统计"""
+        with self._lock:
+            (size,) = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'lookups': lookups,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'writes': self.writes,
+            'evicted': self.evicted,
+            'size': size
+        }
+
+    def close(self) -> None:
+        self.evict()
+        with self._lock:
+            self._conn.close()
+
+    def __bool__(self) -> bool:
+        return True
+
+
+# ============ 提示词模板 ============
+
+# 进程内模板缓存：路径 -> 文本，hash -> 文本
+_template_cache: Dict[str, str] = {}
+_template_lock = threading.Lock()
+
+
+def load_prompt_template(path: Union[str, Path]) -> str:
+    """读取提示词模板（进程内缓存，同一路径只读一次磁盘）"""
+    key = str(Path(path).resolve())
+    template = _template_cache.get(key)
+    if template is None:
+        template = Path(path).read_text(encoding='utf-8')
+        with _template_lock:
+            _template_cache[key] = template
+    return template
+
+
+def compute_template_hash(template: str) -> str:
+    """模板内容哈希（用作请求中的模板引用）"""
+    return compute_short_hash(template, 16)
+
+
+def save_template_snapshot(template: str, snapshot_dir: Union[str, Path]) -> str:
+    """
+    把模板按内容哈希保存为 <snapshot_dir>/<hash>.txt（已存在则跳过）
+
+    Returns:
+        模板哈希
+    """
+    template_hash = compute_template_hash(template)
+    path = ensure_dir(snapshot_dir) / f'{template_hash}.txt'
+    if not path.exists():
+        tmp_path = path.with_name(path.name + '.tmp')
+        tmp_path.write_text(template, encoding='utf-8')
+        tmp_path.replace(path)
+    with _template_lock:
+        _template_cache[f'hash:{template_hash}'] = template
+    return template_hash
+
+
+def load_template_by_hash(template_hash: str, snapshot_dirs: List[Union[str, Path]]) -> str:
+    """
+    按哈希加载模板快照（进程内缓存）
+
+    Args:
+        template_hash: 模板哈希
+        snapshot_dirs: 依次查找的快照目录
+
+    Raises:
+        FileNotFoundError: 所有目录中都没有匹配的快照
+    """
+    key = f'hash:{template_hash}'
+    template = _template_cache.get(key)
+    if template is not None:
+        return template
+
+    for snapshot_dir in snapshot_dirs:
+        path = Path(snapshot_dir) / f'{template_hash}.txt'
+        if not path.exists():
+            continue
+        template = path.read_text(encoding='utf-8')
+        if compute_template_hash(template) != template_hash:
+            logging.warning(f"Template snapshot {path} does not match its hash, skipped")
+            continue
+        with _template_lock:
+            _template_cache[key] = template
+        return template
+
+    raise FileNotFoundError(f"Template snapshot {template_hash} not found in {[str(d) for d in snapshot_dirs]}")
+
+
 # ============ 检查点 ============
 
 class Checkpoint:
@@ -259,6 +538,225 @@ class Checkpoint:
         return len(self.processed)
 
 
+class OutputJournal:
+    """
+    追加写入的输出日志（write-ahead）
+
+    - 整个运行期间只打开一次文件句柄
+    - 每条记录写入后 flush 到 OS 缓冲（进程崩溃不丢）
+    - 按 fsync_interval 秒批量 fsync（掉电时最多丢失一个间隔内的记录；0 表示每条都 fsync）
+    - 打开时修复上次中断留下的半行
+
+    已完成的 id 从日志本身推导，无需每条记录都重写检查点文件。
+    传入 index 时同步维护 id 侧车索引（见 OutputIndex）。
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        fsync_interval: float = 1.0,
+        index: Optional['OutputIndex'] = None
+    ):
+        self.path = Path(path)
+        ensure_dir(self.path.parent)
+        repair_jsonl_tail(self.path)
+        self.fsync_interval = max(0.0, float(fsync_interval))
+        self.index = index
+        self._file = open(self.path, 'ab')
+        self._offset = self._file.seek(0, os.SEEK_END)
+        self._lock = threading.Lock()
+        self._last_sync = time.monotonic()
+        self._unsynced = 0
+        self.count = 0
+
+    def append(self, item: dict) -> None:
+        """追加一条记录（线程安全）"""
+        line = (json.dumps(item, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            # 先写日志再写索引：崩溃时索引最多落后，加载时补扫即可
+            if self.index is not None:
+                self.index.add(item.get('id') or '', self._offset, len(line), 'ok' if item.get('id') else 'noid')
+            self._offset += len(line)
+            self._unsynced += 1
+            self.count += 1
+            if time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync_locked()
+
+    def _sync_locked(self) -> None:
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def sync(self) -> None:
+        """立即 fsync 未落盘的记录"""
+        with self._lock:
+            self._file.flush()
+            self._sync_locked()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.flush()
+            self._sync_locked()
+            self._file.close()
+            if self.index is not None:
+                self.index.close()
+
+    def __enter__(self) -> 'OutputJournal':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+# 输出记录由 json.dumps 生成且 id 为首个字段，扫描时只解析行首即可取到 id
+_LEADING_ID_RE = re.compile(rb'^\{"id": ("(?:[^"\\]|\\.)*")')
+
+
+class OutputIndex:
+    """
+    输出 JSONL 的 id 侧车索引（默认 `<output>.idx`）
+
+    每行一条：`offset\tlength\tstatus\tid`，status 为 ok / noid（无 id）/ other（非对象 JSON）/ invalid（无法解析）。
+    索引按输出文件的行顺序追加，最后一条的 offset + length 即已覆盖的字节数：
+    - 输出文件更长：只扫描未覆盖的尾部并补写索引
+    - 输出文件更短或末条记录对不上：视为输出被改写，整体重建
+
+    断点续跑与去重只需读取索引，不再逐行解析数 GB 的 raw_output。
+    """
+
+    HEADER = '#output-index v1\n'
+
+    def __init__(self, output_path: Union[str, Path], index_path: Optional[Union[str, Path]] = None):
+        self.output_path = Path(output_path)
+        self.index_path = Path(index_path) if index_path else self.output_path.with_name(self.output_path.name + '.idx')
+        # (id, offset, length, status)
+        self.entries: List[tuple] = []
+        self._file = None
+
+    @property
+    def covered(self) -> int:
+        """索引已覆盖的输出字节数"""
+        if not self.entries:
+            return 0
+        _, offset, length, _ = self.entries[-1]
+        return offset + length
+
+    def load(self) -> 'OutputIndex':
+        """读取侧车索引并与输出文件对齐"""
+        self.close()
+        self.entries = self._read_index()
+        size = self.output_path.stat().st_size if self.output_path.exists() else 0
+
+        if self.entries and (size < self.covered or not self._last_entry_matches()):
+            logging.warning(f"Output index out of date, rebuilding: {self.index_path}")
+            self.entries = []
+
+        if not self.entries:
+            self._rewrite([])
+
+        if size > self.covered:
+            new_entries = list(self._scan(self.covered))
+            self._append_lines(new_entries)
+            self.entries.extend(new_entries)
+        return self
+
+    def _read_index(self) -> List[tuple]:
+        if not self.index_path.exists():
+            return []
+        repair_jsonl_tail(self.index_path)
+        entries = []
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            if f.readline() != self.HEADER:
+                return []
+            for line in f:
+                parts = line.rstrip('\n').split('\t', 3)
+                if len(parts) != 4:
+                    return []
+                offset, length, status, item_id = parts
+                entries.append((item_id, int(offset), int(length), status))
+        return entries
+
+    def _last_entry_matches(self) -> bool:
+        item_id, offset, length, status = self.entries[-1]
+        with open(self.output_path, 'rb') as f:
+            f.seek(offset)
+            line = f.read(length)
+        if len(line) != length or not line.endswith(b'\n'):
+            return False
+        return self._parse_line(line) == (item_id, status)
+
+    @staticmethod
+    def _parse_line(line: bytes) -> tuple:
+        """返回 (id, status)；能从行首取到 id 时不解析整行"""
+        match = _LEADING_ID_RE.match(line)
+        if match and line.rstrip().endswith(b'}'):
+            item_id = json.loads(match.group(1))
+            return (item_id, 'ok') if item_id else ('', 'noid')
+        try:
+            obj = json.loads(line)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return '', 'invalid'
+        if not isinstance(obj, dict):
+            return '', 'other'
+        item_id = obj.get('id')
+        return (item_id, 'ok') if item_id else ('', 'noid')
+
+    def _scan(self, start: int) -> Iterator[tuple]:
+        """从字节偏移 start 开始扫描输出文件"""
+        with open(self.output_path, 'rb') as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # 残缺尾行不入索引（由 repair_jsonl_tail 处理）
+                    break
+                if line.strip():
+                    item_id, status = self._parse_line(line)
+                    yield item_id, offset, len(line), status
+                offset += len(line)
+
+    @staticmethod
+    def _format(entry: tuple) -> str:
+        item_id, offset, length, status = entry
+        return f"{offset}\t{length}\t{status}\t{item_id}\n"
+
+    def _rewrite(self, entries: List[tuple]) -> None:
+        ensure_dir(self.index_path.parent)
+        tmp_path = self.index_path.with_name(self.index_path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.HEADER)
+            f.writelines(self._format(e) for e in entries)
+        os.replace(tmp_path, self.index_path)
+
+    def _append_lines(self, entries: List[tuple]) -> None:
+        if self._file is None:
+            self._file = open(self.index_path, 'a', encoding='utf-8')
+        self._file.writelines(self._format(e) for e in entries)
+        self._file.flush()
+
+    def add(self, item_id: str, offset: int, length: int, status: str = 'ok') -> None:
+        """登记一条新追加的输出记录"""
+        entry = (item_id, offset, length, status)
+        self._append_lines([entry])
+        self.entries.append(entry)
+
+    def replace(self, entries: List[tuple]) -> None:
+        """输出文件被整体改写后替换索引"""
+        self.close()
+        self._rewrite(entries)
+        self.entries = list(entries)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
 # ============ 文本处理 ============
 
 def normalize_code(code: str) -> str:
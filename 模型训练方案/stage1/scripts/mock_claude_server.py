@@ -0,0 +1,440 @@
+"""
+本地 Claude Messages API 模拟服务
+
+用于在不消耗额度的情况下联调 run_teacher_claude.py（配合 --base-url 使用）。
+可模拟响应延迟、并发容量上限（超出返回 429 + retry-after）、随机过载（529），
+以及 system block 上 cache_control 断点的 prompt caching（usage 中返回缓存读写 token）。
+同时提供 Message Batches API（/v1/messages/batches），batch 在 --batch-latency 秒后结束；
+请求带 stream=true 时按 SSE 逐段返回，--bad-output-rate 可混入格式错误的输出。
+
+示例：
+    python mock_claude_server.py --port 8765 --latency 0.5 --capacity 8
+    python run_teacher_claude.py --api-key test --base-url http://127.0.0.1:8765 --async
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from common import get_logger
+
+logger = get_logger(__name__)
+
+MOCK_OUTPUT = """[PLAN]
+需求：{task}
+API：Phaser.Scene, Phaser.GameObjects.Graphics
+步骤：
+1. 创建场景并绘制图形
+2. 在 update 中更新状态
+[/PLAN]
+
+```javascript
+class MainScene extends Phaser.Scene {{
+  constructor() {{
+    super('MainScene');
+  }}
+
+  create() {{
+    this.box = this.add.graphics();
+    this.box.fillStyle(0x00ff00, 1);
+    this.box.fillRect(100, 100, 80, 80);
+  }}
+
+  update(time, delta) {{
+    this.box.x = (this.box.x + delta * 0.05) % 800;
+  }}
+}}
+
+const config = {{
+  type: Phaser.AUTO,
+  width: 800,
+  height: 600,
+  scene: MainScene
+}};
+
+new Phaser.Game(config);
+```
+"""
+
+# 格式错误的输出：没有 [PLAN]；代码块缺少 new Phaser.Game
+MOCK_BAD_OUTPUTS = [
+    "好的，我来详细分析一下这个需求。" + "首先需要理解场景的结构与交互流程，然后再考虑实现细节。" * 80,
+    "[PLAN]\n需求：{task}\n[/PLAN]\n\n```javascript\nconst box = {{ x: 0 }};\nbox.x += 1;\n```\n\n"
+    + "补充说明：以上代码展示了核心逻辑。" * 80,
+]
+
+
+class MockState:
+    """服务端共享状态：在途请求数与统计"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.stats = {
+            'requests': 0, 'ok': 0, 'rate_limited': 0, 'overloaded': 0, 'max_in_flight': 0,
+            'streamed': 0, 'stream_disconnects': 0, 'bad_outputs': 0,
+            'cache_read_input_tokens': 0, 'cache_creation_input_tokens': 0
+        }
+        # 前缀哈希 -> 过期时间
+        self.prompt_cache: dict = {}
+        # batch id -> {'created': monotonic, 'created_at': datetime, 'requests': [...], 'results': [...] | None}
+        self.batches: dict = {}
+        self.batch_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数（约 4 字符 / token）"""
+    return max(1, len(text) // 4)
+
+
+def cache_breakpoints(body: dict, min_tokens: int = 0) -> tuple:
+    """
+    计算 system 与 messages 中各 cache_control 断点处的累计前缀
+
+    Returns:
+        (总提示词 token 数, [(累计 token 数, 前缀哈希), ...])
+    """
+    system = body.get('system', '')
+    blocks = system if isinstance(system, list) else [{'type': 'text', 'text': system}]
+    for message in body.get('messages', []):
+        content = message.get('content', '')
+        blocks = blocks + (content if isinstance(content, list) else [{'type': 'text', 'text': content}])
+    digest = hashlib.sha256(body.get('model', '').encode('utf-8'))
+    tokens = 0
+    points = []
+    for block in blocks:
+        text = block.get('text', '')
+        digest.update(text.encode('utf-8'))
+        tokens += estimate_tokens(text) if text else 0
+        if block.get('cache_control') and tokens >= min_tokens:
+            points.append((tokens, digest.copy().hexdigest()))
+    return tokens, points
+
+
+def lookup_prompt_cache(state: MockState, points: list) -> tuple:
+    """
+    按最长命中断点计算缓存读写量
+
+    Returns:
+        (cache_read_tokens, cache_creation_tokens)
+    """
+    if not points:
+        return 0, 0
+    now = time.monotonic()
+    read = 0
+    with state.lock:
+        for tokens, key in reversed(points):
+            expires = state.prompt_cache.get(key)
+            if expires and expires > now:
+                read = tokens
+                break
+        write = points[-1][0] - read
+        state.stats['cache_read_input_tokens'] += read
+        state.stats['cache_creation_input_tokens'] += write
+    return read, write
+
+
+def store_prompt_cache(state: MockState, points: list) -> None:
+    """写入（或刷新）断点处的缓存条目"""
+    expires = time.monotonic() + state.args.cache_ttl
+    with state.lock:
+        for _, key in points:
+            state.prompt_cache[key] = expires
+
+
+def build_message_response(
+    body: dict,
+    cache_read: int = 0,
+    cache_write: int = 0,
+    bad_output: bool = False
+) -> dict:
+    """按请求内容构造 Messages API 格式的响应"""
+    system = body.get('system', '')
+    if isinstance(system, list):
+        system = ''.join(block.get('text', '') for block in system)
+    user_text = ''.join(
+        m['content'] if isinstance(m.get('content'), str) else
+        ''.join(block.get('text', '') for block in m.get('content', []))
+        for m in body.get('messages', [])
+    )
+    task = user_text.split('## 任务描述', 1)[-1].strip().split('\n', 1)[0] if user_text else ''
+    text = (random.choice(MOCK_BAD_OUTPUTS) if bad_output else MOCK_OUTPUT).format(task=task)
+    return {
+        'id': f'msg_mock_{uuid.uuid4().hex[:24]}',
+        'type': 'message',
+        'role': 'assistant',
+        'model': body.get('model', 'mock'),
+        'content': [{'type': 'text', 'text': text}],
+        'stop_reason': 'end_turn',
+        'stop_sequence': None,
+        'usage': {
+            'input_tokens': max(0, estimate_tokens(system) + estimate_tokens(user_text) - cache_read - cache_write),
+            'output_tokens': estimate_tokens(text),
+            'cache_creation_input_tokens': cache_write,
+            'cache_read_input_tokens': cache_read
+        }
+    }
+
+
+def _iso(dt: datetime) -> str:
+    return dt.isoformat().replace('+00:00', 'Z')
+
+
+def finish_batch(state: MockState, batch: dict) -> None:
+    """batch 到期后一次性生成全部结果（调用方需持有 state.batch_lock）"""
+    results = []
+    for item in batch['requests']:
+        params = item.get('params', {})
+        if state.args.batch_error_rate > 0 and random.random() < state.args.batch_error_rate:
+            result = {
+                'type': 'errored',
+                'error': {'type': 'error', 'error': {'type': 'api_error', 'message': 'mock batch item error'}}
+            }
+        else:
+            _, points = cache_breakpoints(params, state.args.cache_min_tokens)
+            cache_read, cache_write = lookup_prompt_cache(state, points)
+            store_prompt_cache(state, points)
+            result = {'type': 'succeeded', 'message': build_message_response(params, cache_read, cache_write)}
+        results.append({'custom_id': item['custom_id'], 'result': result})
+    batch['results'] = results
+    batch['ended_at'] = datetime.now(timezone.utc)
+
+
+def batch_object(batch: dict, base_url: str) -> dict:
+    """构造 MessageBatch 响应体"""
+    results = batch['results']
+    counts = {'processing': 0, 'succeeded': 0, 'errored': 0, 'canceled': 0, 'expired': 0}
+    if results is None:
+        counts['processing'] = len(batch['requests'])
+    else:
+        for item in results:
+            counts[item['result']['type']] += 1
+    ended = results is not None
+    return {
+        'id': batch['id'],
+        'type': 'message_batch',
+        'processing_status': 'ended' if ended else 'in_progress',
+        'request_counts': counts,
+        'created_at': _iso(batch['created_at']),
+        'expires_at': _iso(batch['created_at'] + timedelta(hours=24)),
+        'ended_at': _iso(batch['ended_at']) if ended else None,
+        'archived_at': None,
+        'cancel_initiated_at': None,
+        'results_url': f"{base_url}/v1/messages/batches/{batch['id']}/results" if ended else None
+    }
+
+
+def make_handler(state: MockState):
+    args = state.args
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *log_args):
+            if args.verbose:
+                logger.info(format % log_args)
+
+        def _send_json(self, status: int, payload: dict, headers: dict = None) -> None:
+            data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_stream(self, response: dict, duration: float) -> None:
+            """按 SSE 事件逐段返回；客户端提前断开时停止生成"""
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+
+            def event(name: str, data: dict) -> None:
+                payload = json.dumps(dict(data, type=name), ensure_ascii=False)
+                self.wfile.write(f"event: {name}\ndata: {payload}\n\n".encode('utf-8'))
+                self.wfile.flush()
+
+            text = response['content'][0]['text']
+            usage = response['usage']
+            chunks = [text[i:i + 16] for i in range(0, len(text), 16)]
+            # 首 token 前占 30% 时间，其余均摊到各片段
+            ttft = duration * 0.3
+            per_chunk = (duration - ttft) / max(1, len(chunks))
+            start_message = dict(response, content=[], stop_reason=None, usage=dict(usage, output_tokens=1))
+            try:
+                event('message_start', {'message': start_message})
+                time.sleep(ttft)
+                event('content_block_start', {'index': 0, 'content_block': {'type': 'text', 'text': ''}})
+                for chunk in chunks:
+                    event('content_block_delta', {'index': 0, 'delta': {'type': 'text_delta', 'text': chunk}})
+                    time.sleep(per_chunk)
+                event('content_block_stop', {'index': 0})
+                event('message_delta', {
+                    'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                    'usage': {'output_tokens': usage['output_tokens']}
+                })
+                event('message_stop', {})
+            except (BrokenPipeError, ConnectionResetError):
+                with state.lock:
+                    state.stats['stream_disconnects'] += 1
+
+        def _send_error(self, status: int, error_type: str, message: str, headers: dict = None) -> None:
+            self._send_json(status, {'type': 'error', 'error': {'type': error_type, 'message': message}}, headers)
+
+        def _get_batch(self, batch_id: str):
+            with state.lock:
+                batch = state.batches.get(batch_id)
+            if batch is None:
+                self._send_error(404, 'not_found_error', f'batch {batch_id} not found')
+                return None
+            with state.batch_lock:
+                if batch['results'] is None and time.monotonic() - batch['created'] >= args.batch_latency:
+                    finish_batch(state, batch)
+            return batch
+
+        def do_GET(self):
+            path = self.path.split('?')[0].rstrip('/')
+            if path == '/stats':
+                with state.lock:
+                    self._send_json(200, dict(state.stats, in_flight=state.in_flight, batches=len(state.batches)))
+            elif path.startswith('/v1/messages/batches/'):
+                parts = path[len('/v1/messages/batches/'):].split('/')
+                batch = self._get_batch(parts[0])
+                if batch is None:
+                    return
+                if len(parts) == 1:
+                    self._send_json(200, batch_object(batch, f"http://{self.headers.get('Host')}"))
+                elif parts[1:] == ['results'] and batch['results'] is not None:
+                    data = ''.join(json.dumps(item, ensure_ascii=False) + '\n' for item in batch['results'])
+                    data = data.encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/binary')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                else:
+                    self._send_error(404, 'not_found_error', self.path)
+            else:
+                self._send_error(404, 'not_found_error', self.path)
+
+        def _create_batch(self, body: dict) -> None:
+            batch = {
+                'id': f'msgbatch_mock_{uuid.uuid4().hex[:24]}',
+                'created': time.monotonic(),
+                'created_at': datetime.now(timezone.utc),
+                'requests': body.get('requests', []),
+                'results': None
+            }
+            with state.lock:
+                state.batches[batch['id']] = batch
+                state.stats['requests'] += 1
+            self._send_json(200, batch_object(batch, f"http://{self.headers.get('Host')}"))
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+
+            path = self.path.split('?')[0].rstrip('/')
+            if path == '/v1/messages/batches':
+                self._create_batch(body)
+                return
+            if path != '/v1/messages':
+                self._send_error(404, 'not_found_error', self.path)
+                return
+
+            with state.lock:
+                state.stats['requests'] += 1
+                over_capacity = args.capacity > 0 and state.in_flight >= args.capacity
+                if over_capacity:
+                    state.stats['rate_limited'] += 1
+                else:
+                    state.in_flight += 1
+                    state.stats['max_in_flight'] = max(state.stats['max_in_flight'], state.in_flight)
+
+            if over_capacity:
+                self._send_error(
+                    429, 'rate_limit_error', 'mock capacity exceeded',
+                    headers={'retry-after': str(args.retry_after)}
+                )
+                return
+
+            try:
+                if args.overload_rate > 0 and random.random() < args.overload_rate:
+                    with state.lock:
+                        state.stats['overloaded'] += 1
+                    self._send_error(529, 'overloaded_error', 'mock overloaded')
+                    return
+
+                _, points = cache_breakpoints(body, args.cache_min_tokens)
+                cache_read, cache_write = lookup_prompt_cache(state, points)
+                bad_output = args.bad_output_rate > 0 and random.random() < args.bad_output_rate
+                response = build_message_response(body, cache_read, cache_write, bad_output)
+                duration = max(0.0, args.latency + random.uniform(-args.jitter, args.jitter))
+                with state.lock:
+                    state.stats['ok'] += 1
+                    state.stats['bad_outputs'] += int(bad_output)
+                if body.get('stream'):
+                    with state.lock:
+                        state.stats['streamed'] += 1
+                    # 流式：message_start 之后缓存即可用
+                    store_prompt_cache(state, points)
+                    self._send_stream(response, duration)
+                else:
+                    time.sleep(duration)
+                    # 与真实服务一致：首个响应开始返回后缓存才可用，同时发出的相同前缀都会写缓存
+                    store_prompt_cache(state, points)
+                    self._send_json(200, response)
+            finally:
+                with state.lock:
+                    state.in_flight -= 1
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地 Claude Messages API 模拟服务')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='监听地址')
+    parser.add_argument('--port', type=int, default=8765, help='监听端口')
+    parser.add_argument('--latency', type=float, default=0.5, help='每个请求的基础延迟（秒）')
+    parser.add_argument('--jitter', type=float, default=0.1, help='延迟抖动（秒）')
+    parser.add_argument('--capacity', type=int, default=8, help='并发容量，超出返回 429（0 表示不限）')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='429 响应的 retry-after（秒）')
+    parser.add_argument('--overload-rate', type=float, default=0.0, help='随机返回 529 overloaded 的概率')
+    parser.add_argument('--cache-ttl', type=float, default=300.0, help='prompt cache 条目存活时间（秒）')
+    parser.add_argument('--cache-min-tokens', type=int, default=0, help='断点前缀低于该 token 数时不缓存')
+    parser.add_argument('--batch-latency', type=float, default=3.0, help='batch 从提交到结束的时间（秒）')
+    parser.add_argument('--batch-error-rate', type=float, default=0.0, help='batch 中单条请求返回 errored 的概率')
+    parser.add_argument('--bad-output-rate', type=float, default=0.0, help='返回格式错误输出（无 [PLAN] / 缺少 new Phaser.Game）的概率')
+    parser.add_argument('--verbose', action='store_true', help='打印每个请求的访问日志')
+
+    args = parser.parse_args()
+
+    state = MockState(args)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    server.daemon_threads = True
+    logger.info(
+        f"Mock Claude API listening on http://{args.host}:{args.port} "
+        f"(latency={args.latency}s, capacity={args.capacity})"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info(f"Mock stats: {state.stats}")
+
+
+if __name__ == '__main__':
+    main()
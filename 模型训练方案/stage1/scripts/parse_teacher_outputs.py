@@ -17,6 +17,9 @@ from common import (
 
 logger = get_logger(__name__)
 
+# 第一个围栏代码块（```javascript / ```js / 无语言标记）
+CODE_FENCE_RE = re.compile(r'```(?:javascript|js|JavaScript|JS)?\s*\n?(.*?)```', re.DOTALL)
+
 
 def parse_plan(raw_output: str) -> Tuple[Optional[dict], List[str]]:
     """
@@ -93,11 +96,7 @@ def parse_code(raw_output: str) -> Tuple[Optional[str], List[str]]:
     errors = []
 
     # 尝试提取 ```javascript...``` 或 ```js...```
-    code_match = re.search(
-        r'```(?:javascript|js|JavaScript|JS)?\s*\n?(.*?)```',
-        raw_output,
-        re.DOTALL
-    )
+    code_match = CODE_FENCE_RE.search(raw_output)
 
     if code_match:
         code = code_match.group(1).strip()
@@ -168,6 +167,50 @@ def parse_teacher_output(raw_output: str) -> dict:
     return result
 
 
+class StreamingOutputChecker:
+    """
+    流式生成时增量检查教师输出，尽早判定明显不可用的结果
+
+    判定与 parse_plan / parse_code / validate_code 保持一致，只在结论已不可能改变时中止：
+    - 前 plan_deadline_chars 个字符内没有出现 [PLAN] / ```plan：parse_plan 必然失败
+    - 第一个围栏代码块已闭合且不含 Phaser.Game：parse_code 取的就是第一个围栏块，
+      validate_code 必然报 missing_game_instantiation
+
+    用法：每收到一段文本调用 feed()，返回非 None 时即为中止原因。
+    """
+
+    PLAN_MARKERS = ('[plan]', '```plan')
+
+    def __init__(self, plan_deadline_chars: int = 1500):
+        self.plan_deadline_chars = plan_deadline_chars
+        self.text = ''
+        self.plan_seen = False
+        self.fence_checked = False
+        self.abort_reason: Optional[str] = None
+
+    def feed(self, delta: str) -> Optional[str]:
+        if self.abort_reason or not delta:
+            return self.abort_reason
+        # 标记可能跨越两段 delta，从上一段末尾回看几个字符
+        start = max(0, len(self.text) - 8)
+        self.text += delta
+        window = self.text[start:].lower()
+
+        if not self.plan_seen:
+            self.plan_seen = any(marker in window for marker in self.PLAN_MARKERS)
+            if not self.plan_seen and len(self.text) >= self.plan_deadline_chars:
+                self.abort_reason = 'plan_block_not_found'
+                return self.abort_reason
+
+        if not self.fence_checked and '```' in window and self.text.count('```') >= 2:
+            self.fence_checked = True
+            match = CODE_FENCE_RE.search(self.text)
+            code = match.group(1).strip() if match else ''
+            if code and 'Phaser.Game' not in code:
+                self.abort_reason = 'missing_game_instantiation'
+        return self.abort_reason
+
+
 def validate_code(code: str) -> Tuple[bool, List[str]]:
     """
     基础代码验证（不调用 validator）
@@ -207,7 +250,8 @@ def process_raw_outputs(
     raw_outputs_path: str,
     output_path: str,
     codes_dir: str = None,
-    report_path: str = None
+    report_path: str = None,
+    restore_order: bool = False
 ) -> dict:
     """
     处理所有原始输出，生成候选数据
@@ -217,6 +261,7 @@ def process_raw_outputs(
         output_path: 候选数据输出路径
         codes_dir: 代码文件输出目录
         report_path: 报告输出路径
+        restore_order: 按 request_index 恢复请求顺序（并发蒸馏按完成顺序写出）
 
     Returns:
         处理报告
@@ -225,6 +270,10 @@ def process_raw_outputs(
     raw_outputs = read_jsonl(raw_outputs_path)
     logger.info(f"Loaded {len(raw_outputs)} raw outputs")
 
+    if restore_order:
+        # 稳定排序：没有 request_index 的旧记录保持原相对顺序并排在最后
+        raw_outputs.sort(key=lambda item: item.get('request_index', float('inf')))
+
     candidates = []
     stats = {
         'total': len(raw_outputs),
@@ -243,6 +292,9 @@ def process_raw_outputs(
 
         # 解析输出
         parsed = parse_teacher_output(raw_output)
+        if item.get('stream_abort'):
+            # 流式生成被提前中止，输出不完整
+            parsed['parse_errors'].append(f"stream_aborted:{item['stream_abort']}")
 
         # 统计
         if parsed['plan']:
@@ -350,6 +402,11 @@ def main():
         default=str(get_reports_path('parse_report.json')),
         help='报告输出路径'
     )
+    parser.add_argument(
+        '--restore-order',
+        action='store_true',
+        help='按 request_index 恢复请求顺序（教师输出按完成顺序写入）'
+    )
 
     args = parser.parse_args()
 
@@ -357,7 +414,8 @@ def main():
         raw_outputs_path=args.input,
         output_path=args.output,
         codes_dir=args.codes_dir,
-        report_path=args.report
+        report_path=args.report,
+        restore_order=args.restore_order
     )
 
     print(f"\n解析完成！")
@@ -7,38 +7,53 @@
 import json
 import os
 import time
+import asyncio
 import argparse
 import threading
+import statistics
+from collections import deque
+from types import SimpleNamespace
 from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple, Union
 from pathlib import Path
 
 try:
-    from anthropic import Anthropic, APIError, RateLimitError
+    from anthropic import Anthropic, AsyncAnthropic, APIError, APIStatusError, RateLimitError
 except ImportError:
     print("错误：未安装 anthropic 库")
     print("请运行：pip install anthropic")
     exit(1)
 
 from common import (
-    read_jsonl, iter_jsonl, append_jsonl,
-    get_data_path, get_stage1_root,
-    get_logger, print_progress, Checkpoint
+    read_jsonl, read_json, write_json,
+    get_data_path, get_reports_path, get_stage1_root, get_stage0_path,
+    get_logger, generate_report_summary, print_progress, Checkpoint, OutputJournal, OutputIndex, repair_jsonl_tail,
+    ResponseCache, compute_hash,
+    load_prompt_template, load_template_by_hash
 )
+from api_bm25 import APIRetriever
+from parse_teacher_outputs import StreamingOutputChecker
 
 logger = get_logger(__name__)
 
 _thread_local = threading.local()
 
+# 教师采样参数（同时计入响应缓存键）
+DEFAULT_MAX_TOKENS = 4000
+DEFAULT_TEMPERATURE = 0.7
 
-def get_thread_client(api_key: str) -> Anthropic:
+# 没有可注入的 API 时 {API_CONTEXT} 的占位文本
+NO_API_CONTEXT = "（无相关 API 参考）"
+
+
+def get_thread_client(api_key: str, base_url: Optional[str] = None) -> Anthropic:
     """
     获取线程内复用的 Anthropic 客户端
     """
     client = getattr(_thread_local, "client", None)
     if client is None:
-        client = Anthropic(api_key=api_key)
+        client = Anthropic(api_key=api_key, base_url=base_url)
         _thread_local.client = client
     return client
 
@@ -46,26 +61,498 @@ def get_thread_client(api_key: str) -> Anthropic:
 class RateLimiter:
     """
     简单全局速率限制器：保证请求起始间隔 >= min_interval
+
+    在锁内只预约下一个起始时刻，等待在锁外进行。
     """
 
     def __init__(self, min_interval: float):
         self.min_interval = max(0.0, float(min_interval))
         self._lock = threading.Lock()
-        self._last_time = 0.0
+        self._next_time = 0.0
 
     def wait(self) -> None:
         if self.min_interval <= 0:
             return
         with self._lock:
             now = time.monotonic()
-            sleep_for = self.min_interval - (now - self._last_time)
-            if sleep_for > 0:
-                time.sleep(sleep_for)
-                now = time.monotonic()
-            self._last_time = now
+            start_at = max(now, self._next_time)
+            self._next_time = start_at + self.min_interval
+        sleep_for = start_at - now
+        if sleep_for > 0:
+            time.sleep(sleep_for)
 
 
-def load_system_prompt(api_context: List[str]) -> str:
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：ASCII 约 4 字符 / token，中文等其余字符约 1 字符 / token"""
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+class TokenBucket:
+    """
+    令牌桶：容量为每分钟额度，按秒匀速补充
+
+    余额允许为负（实际用量超过预估时记为欠账，后续请求等待补足）。
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """额度不足时需要等待的秒数（单次超过容量时只等到桶满）"""
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class TokenBucketLimiter:
+    """
+    按 RPM / 输入 TPM / 输出 TPM 三个预算限流（任一为 0 表示不限）
+
+    - 发送前预扣：输入按提示词估算（乘以自适应校正系数，即按未命中缓存计），输出按近期实际输出的滑动平均
+    - 返回后用 usage 校正差额（读缓存不计入输入 TPM，多扣的退还）；请求失败时退还预扣的 token（请求数不退）
+    - 锁只保护桶状态，等待在锁外进行，worker 之间不会串行排队
+
+    吞吐因此取决于实际最紧的那项预算，而不是固定的请求间隔。
+    """
+
+    def __init__(
+        self,
+        rpm: float = 0,
+        input_tpm: float = 0,
+        output_tpm: float = 0,
+        max_tokens: int = 4000
+    ):
+        self.buckets: Dict[str, TokenBucket] = {}
+        for name, per_minute in (('requests', rpm), ('input_tokens', input_tpm), ('output_tokens', output_tpm)):
+            if per_minute and per_minute > 0:
+                self.buckets[name] = TokenBucket(per_minute)
+        self._lock = threading.Lock()
+        # 实际提示词 token（含读缓存）/ 估算值（EWMA）
+        self.input_ratio = 1.0
+        # 预计输出 token（EWMA，初始按 max_tokens 保守估计）
+        self.expected_output = float(max_tokens)
+        self.stats = {'acquired': 0, 'waits': 0, 'wait_seconds': 0.0}
+
+    def __bool__(self) -> bool:
+        return bool(self.buckets)
+
+    def _reserve(self, cost: Dict[str, float]) -> float:
+        """额度足够则扣减并返回 0，否则返回需要等待的秒数（不扣减）"""
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            for name, bucket in self.buckets.items():
+                bucket.refill(now)
+                wait = max(wait, bucket.wait_time(cost[name]))
+            if wait <= 0:
+                for name, bucket in self.buckets.items():
+                    bucket.tokens -= cost[name]
+                self.stats['acquired'] += 1
+            else:
+                self.stats['waits'] += 1
+                self.stats['wait_seconds'] += wait
+            return wait
+
+    def _cost(self, estimated_input_tokens: int) -> Dict[str, float]:
+        return {
+            'requests': 1.0,
+            'input_tokens': estimated_input_tokens * self.input_ratio,
+            'output_tokens': self.expected_output,
+            'raw_input_estimate': float(estimated_input_tokens)
+        }
+
+    def acquire(self, estimated_input_tokens: int) -> Dict[str, float]:
+        """阻塞直到三个预算都有额度，返回预扣记录（交给 settle 校正）"""
+        cost = self._cost(estimated_input_tokens)
+        while True:
+            wait = self._reserve(cost)
+            if wait <= 0:
+                return cost
+            time.sleep(wait)
+
+    async def acquire_async(self, estimated_input_tokens: int) -> Dict[str, float]:
+        """acquire 的 asyncio 版本"""
+        cost = self._cost(estimated_input_tokens)
+        while True:
+            wait = self._reserve(cost)
+            if wait <= 0:
+                return cost
+            await asyncio.sleep(wait)
+
+    def settle(self, cost: Dict[str, float], usage=None) -> None:
+        """
+        用实际 usage 校正预扣额度；usage 为 None 表示请求失败，退还预扣的 token
+        """
+        with self._lock:
+            if usage is None:
+                actual_input = 0.0
+                actual_output = 0.0
+            else:
+                # 计入 ITPM 的部分：未命中缓存 + 写缓存（读缓存不计入）
+                actual_input = float(
+                    (getattr(usage, 'input_tokens', 0) or 0) +
+                    (getattr(usage, 'cache_creation_input_tokens', 0) or 0)
+                )
+                actual_output = float(getattr(usage, 'output_tokens', 0) or 0)
+                # 估算系数按完整提示词校准（含读缓存），否则缓存命中会把系数压低，
+                # 之后未命中缓存的请求只预扣一小部分
+                prompt_tokens = actual_input + float(getattr(usage, 'cache_read_input_tokens', 0) or 0)
+                if cost['raw_input_estimate'] > 0 and prompt_tokens > 0:
+                    ratio = prompt_tokens / cost['raw_input_estimate']
+                    self.input_ratio = 0.8 * self.input_ratio + 0.2 * ratio
+                self.expected_output = 0.8 * self.expected_output + 0.2 * actual_output
+
+            if 'input_tokens' in self.buckets:
+                self.buckets['input_tokens'].tokens += cost['input_tokens'] - actual_input
+            if 'output_tokens' in self.buckets:
+                self.buckets['output_tokens'].tokens += cost['output_tokens'] - actual_output
+
+
+# 模型价格（USD / 百万 token：input, output），按子串顺序匹配，先匹配更具体的型号
+MODEL_PRICING = (
+    ('opus-4-5', 5.0, 25.0),
+    ('opus', 15.0, 75.0),
+    ('sonnet', 3.0, 15.0),
+    ('haiku-4-5', 1.0, 5.0),
+    ('3-5-haiku', 0.8, 4.0),
+    ('haiku', 0.25, 1.25),
+)
+# 写缓存 / 读缓存相对 input 单价的倍率；Message Batches API 整体半价
+CACHE_WRITE_MULTIPLIER = 1.25
+CACHE_READ_MULTIPLIER = 0.1
+BATCH_DISCOUNT = 0.5
+
+# usage.input_tokens 只含未命中缓存的部分；命中与写入缓存分别计入后两项
+USAGE_FIELDS = ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens')
+
+
+def get_model_pricing(model: str) -> Optional[Tuple[float, float]]:
+    """返回模型的 (input, output) 单价（USD / 百万 token），未知模型返回 None"""
+    name = model.lower()
+    for key, input_price, output_price in MODEL_PRICING:
+        if key in name:
+            return input_price, output_price
+    return None
+
+
+def estimate_cost(usage: Dict[str, int], pricing: Tuple[float, float], batch: bool = False) -> Dict[str, float]:
+    """
+    按 usage 计算费用（USD）
+
+    Returns:
+        {'input', 'output', 'cache_write', 'cache_read', 'total'}
+    """
+    input_price, output_price = pricing
+    scale = (BATCH_DISCOUNT if batch else 1.0) / 1e6
+    cost = {
+        'input': usage.get('input_tokens', 0) * input_price * scale,
+        'output': usage.get('output_tokens', 0) * output_price * scale,
+        'cache_write': usage.get('cache_creation_input_tokens', 0) * input_price * CACHE_WRITE_MULTIPLIER * scale,
+        'cache_read': usage.get('cache_read_input_tokens', 0) * input_price * CACHE_READ_MULTIPLIER * scale,
+    }
+    cost['total'] = sum(cost.values())
+    return cost
+
+
+def _percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[int(q * (len(sorted_values) - 1))]
+
+
+def _distribution(values: List[float]) -> Dict[str, Optional[float]]:
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': round(statistics.fmean(values), 3),
+        'p50': round(_percentile(values, 0.5), 3),
+        'p95': round(_percentile(values, 0.95), 3),
+        'p99': round(_percentile(values, 0.99), 3),
+        'max': round(values[-1], 3),
+    }
+
+
+class RunStats:
+    """
+    运行统计：按输出记录中的 usage / latency_s / retries 累计 token、费用、吞吐与延迟
+
+    只由写入输出的回调调用（单线程），提供进度行后缀与最终报告。
+    吞吐与进度行中的延迟分位数取最近的滑动窗口，报告中的分位数基于全部请求。
+    """
+
+    WINDOW_SECONDS = 60.0
+    LATENCY_WINDOW = 200
+
+    def __init__(self, model: str, batch: bool = False):
+        self.model = model
+        self.batch = batch
+        self.pricing = get_model_pricing(model)
+        self.totals = {name: 0 for name in USAGE_FIELDS}
+        self.cost = {'input': 0.0, 'output': 0.0, 'cache_write': 0.0, 'cache_read': 0.0, 'total': 0.0}
+        self.pending = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.api_calls = 0
+        self.cached = 0
+        self.retries = 0
+        self.retried_requests = 0
+        self.latencies: List[float] = []
+        self.ttfts: List[float] = []
+        self.stream_aborts: Dict[str, int] = {}
+        self._recent_latencies: deque = deque(maxlen=self.LATENCY_WINDOW)
+        self._window: deque = deque()  # (完成时刻, 输出 token 数)
+        self.started_at = datetime.now().isoformat()
+        self._start = time.monotonic()
+
+    def begin(self, pending: int) -> None:
+        """开始计时（pending 为本次需要生成的请求数，用于 ETA）"""
+        self.pending = pending
+        self.started_at = datetime.now().isoformat()
+        self._start = time.monotonic()
+
+    def record(self, output: Optional[Dict]) -> None:
+        """记录一条结果（None 表示失败）"""
+        now = time.monotonic()
+        if not output:
+            self.failed += 1
+            self._window.append((now, 0))
+            return
+
+        self.succeeded += 1
+        output_tokens = 0
+        usage = output.get('usage')
+        if output.get('response_cache_hit'):
+            self.cached += 1
+        elif usage:
+            self.api_calls += 1
+            for name in USAGE_FIELDS:
+                self.totals[name] += usage.get(name, 0)
+            output_tokens = usage.get('output_tokens', 0)
+            if self.pricing:
+                for name, value in estimate_cost(usage, self.pricing, self.batch).items():
+                    self.cost[name] += value
+
+        if output.get('latency_s') is not None:
+            self.latencies.append(output['latency_s'])
+            self._recent_latencies.append(output['latency_s'])
+        if output.get('retries'):
+            self.retries += output['retries']
+            self.retried_requests += 1
+        if output.get('ttft_s') is not None:
+            self.ttfts.append(output['ttft_s'])
+        if output.get('stream_abort'):
+            self.stream_aborts[output['stream_abort']] = self.stream_aborts.get(output['stream_abort'], 0) + 1
+        self._window.append((now, output_tokens))
+
+    @property
+    def completed(self) -> int:
+        return self.succeeded + self.failed
+
+    def _rates(self) -> Tuple[float, float]:
+        """滑动窗口内的 (req/s, 输出 tok/s)；运行不足一个窗口时按实际时长计算"""
+        now = time.monotonic()
+        while self._window and now - self._window[0][0] > self.WINDOW_SECONDS:
+            self._window.popleft()
+        span = min(self.WINDOW_SECONDS, now - self._start)
+        if not self._window or span <= 0:
+            return 0.0, 0.0
+        return len(self._window) / span, sum(tokens for _, tokens in self._window) / span
+
+    def dashboard(self) -> str:
+        """进度行后缀：成功/失败、req/s、tok/s、p50/p95 延迟、已花费、ETA"""
+        req_rate, token_rate = self._rates()
+        parts = [f'✓ {self.succeeded} | ✗ {self.failed}', f'{req_rate:.2f} req/s', f'{token_rate:.0f} tok/s']
+        if self._recent_latencies:
+            recent = sorted(self._recent_latencies)
+            parts.append(f'p50 {_percentile(recent, 0.5):.1f}s p95 {_percentile(recent, 0.95):.1f}s')
+        if self.pricing:
+            parts.append(f'${self.cost["total"]:.2f}')
+        remaining = self.pending - self.completed
+        if remaining > 0 and req_rate > 0:
+            eta = int(remaining / req_rate)
+            if eta >= 3600:
+                parts.append(f'ETA {eta // 3600}h{eta % 3600 // 60:02d}m')
+            else:
+                parts.append(f'ETA {eta // 60}m{eta % 60:02d}s')
+        return ' | '.join(parts)
+
+    def report(self) -> Dict:
+        """最终统计（写入 JSON 报告，也供下次运行前的预估使用）"""
+        wall_time = time.monotonic() - self._start
+        prompt_tokens = (
+            self.totals['input_tokens'] + self.totals['cache_creation_input_tokens']
+            + self.totals['cache_read_input_tokens']
+        )
+        all_tokens = prompt_tokens + self.totals['output_tokens']
+        per_request = {}
+        if self.api_calls:
+            per_request = {name: round(value / self.api_calls, 1) for name, value in self.totals.items()}
+            per_request['cost_usd'] = round(self.cost['total'] / self.api_calls, 6) if self.pricing else None
+        return {
+            'model': self.model,
+            'backend': 'batch' if self.batch else 'messages',
+            'pricing_per_mtok': (
+                {'input': self.pricing[0], 'output': self.pricing[1], 'batch_discount': self.batch}
+                if self.pricing else None
+            ),
+            'started_at': self.started_at,
+            'wall_time_s': round(wall_time, 2),
+            'requests': {
+                'pending': self.pending,
+                'succeeded': self.succeeded,
+                'failed': self.failed,
+                'api_calls': self.api_calls,
+                'response_cache_hits': self.cached,
+                'stream_aborted': sum(self.stream_aborts.values()),
+            },
+            'tokens': dict(
+                self.totals,
+                prompt_tokens=prompt_tokens,
+                cache_hit_rate=round(self.totals['cache_read_input_tokens'] / prompt_tokens, 4) if prompt_tokens else 0.0
+            ),
+            'cost_usd': {name: round(value, 4) for name, value in self.cost.items()} if self.pricing else None,
+            'per_request': per_request,
+            'throughput': {
+                'requests_per_s': round(self.completed / wall_time, 4) if wall_time > 0 else 0.0,
+                'output_tokens_per_s': round(self.totals['output_tokens'] / wall_time, 1) if wall_time > 0 else 0.0,
+                'tokens_per_s': round(all_tokens / wall_time, 1) if wall_time > 0 else 0.0,
+            },
+            'latency_s': _distribution(self.latencies),
+            'ttft_s': _distribution(self.ttfts),
+            'retries': {'total': self.retries, 'requests_retried': self.retried_requests},
+            'stream_aborts': dict(self.stream_aborts),
+        }
+
+
+class AIMDController:
+    """
+    自适应并发控制器（AIMD，asyncio 模式使用）
+
+    - 启动阶段（尚未遇到限流）每次成功 +1，快速爬升（类似 TCP 慢启动）
+    - 请求成功且延迟没有明显高于基线：并发上限加性增长（约每轮 +1）
+    - 遇到 429 / 529：并发上限乘性下降，并按 retry-after 暂停发起新请求
+      （同一波限流只下降一次）
+
+    基线延迟取观测到的最小延迟，并缓慢上浮，避免个别极快响应长期压低基线。
+    """
+
+    def __init__(
+        self,
+        initial: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        decrease_factor: float = 0.5,
+        latency_tolerance: float = 3.0,
+        default_backoff: float = 1.0
+    ):
+        self.max_limit = max(1, int(max_limit))
+        self.min_limit = max(1, min(int(min_limit), self.max_limit))
+        self.limit = float(min(max(int(initial), self.min_limit), self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.default_backoff = default_backoff
+
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self._base_latency: Optional[float] = None
+        self._last_decrease = 0.0
+        self._slow_start = True
+        self._cond = asyncio.Condition()
+
+        self.stats = {'rate_limited': 0, 'decreases': 0, 'peak_limit': int(self.limit)}
+
+    async def acquire(self) -> None:
+        """等待一个并发名额（并遵守 retry-after 暂停）"""
+        async with self._cond:
+            while True:
+                delay = self.blocked_until - time.monotonic()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                await self._cond.wait()
+
+    async def release(self) -> None:
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self, latency: float) -> None:
+        if self._base_latency is None:
+            self._base_latency = latency
+        else:
+            self._base_latency = min(latency, self._base_latency * 1.01)
+
+        if latency <= self._base_latency * self.latency_tolerance:
+            step = 1.0 if self._slow_start else 1.0 / self.limit
+            self.limit = min(float(self.max_limit), self.limit + step)
+            self.stats['peak_limit'] = max(self.stats['peak_limit'], int(self.limit))
+
+    def on_rate_limit(self, retry_after: Optional[float]) -> None:
+        now = time.monotonic()
+        self.stats['rate_limited'] += 1
+        self.blocked_until = max(self.blocked_until, now + (retry_after or self.default_backoff))
+
+        window = max(self._base_latency or 0.0, retry_after or 0.0, self.default_backoff)
+        self._slow_start = False
+        if now - self._last_decrease >= window:
+            self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+            self._last_decrease = now
+            self.stats['decreases'] += 1
+            logger.info(f"Rate limited, concurrency limit -> {int(self.limit)}")
+
+
+def parse_retry_after(error: Exception) -> Optional[float]:
+    """从 API 错误响应头中解析 retry-after（秒）"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    try:
+        retry_after_ms = headers.get('retry-after-ms')
+        if retry_after_ms is not None:
+            return float(retry_after_ms) / 1000.0
+        retry_after = headers.get('retry-after')
+        if retry_after is not None:
+            return float(retry_after)
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def split_system_prompt(template: str, context_text: str) -> Tuple[str, str]:
+    """
+    把模板拆成静态前缀与 API 上下文部分
+
+    前缀只取决于模板，所有请求相同；上下文部分随检索结果变化。
+    两段拼接后与 template.replace("{API_CONTEXT}", context_text) 完全一致。
+
+    Returns:
+        (静态前缀, API 上下文部分)
+    """
+    head, sep, tail = template.partition("{API_CONTEXT}")
+    if not sep:
+        return template, ""
+    return head, context_text + tail.replace("{API_CONTEXT}", context_text)
+
+
+def load_system_prompt_parts(api_context: List[str]) -> Tuple[str, str]:
     """
     加载教师系统提示词并注入 API 上下文
 
@@ -73,20 +560,143 @@ def load_system_prompt(api_context: List[str]) -> str:
         api_context: API 上下文列表
 
     Returns:
-        完整的系统提示词
+        (静态前缀, API 上下文部分)
     """
     prompt_path = get_stage1_root() / "prompts" / "teacher_system_prompt.txt"
-
-    with open(prompt_path, 'r', encoding='utf-8') as f:
-        template = f.read()
+    template = load_prompt_template(prompt_path)
 
     # 格式化 API 上下文
     if api_context:
         context_text = "\n\n".join(api_context)
     else:
-        context_text = "（无相关 API 参考）"
+        context_text = NO_API_CONTEXT
 
-    return template.replace("{API_CONTEXT}", context_text)
+    return split_system_prompt(template, context_text)
+
+
+def load_system_prompt(api_context: List[str]) -> str:
+    """加载教师系统提示词并注入 API 上下文，返回完整字符串"""
+    return "".join(load_system_prompt_parts(api_context))
+
+
+class SystemPromptResolver:
+    """
+    根据请求重建系统提示词
+
+    - 请求带完整 system_prompt（--embed-system-prompt 生成）时直接使用
+    - 带 system_prompt_hash 时，模板从快照目录按哈希加载（进程内缓存），
+      API 上下文由 api_context_injected 的 symbol_id 从索引取回后重新格式化
+    - 都没有时回退 load_system_prompt（旧请求格式）
+    """
+
+    def __init__(self, snapshot_dirs: List[Path], api_index_path: Optional[str] = None):
+        self.snapshot_dirs = snapshot_dirs
+        self.retriever = APIRetriever(api_index_path)
+
+    def resolve(self, request: Dict) -> str:
+        return "".join(self.resolve_parts(request))
+
+    def resolve_parts(self, request: Dict) -> Tuple[str, str]:
+        """返回 (静态前缀, API 上下文部分)，供 prompt caching 分块"""
+        template_hash = request.get('system_prompt_hash')
+        system_prompt = request.get('system_prompt')
+        if system_prompt:
+            # 内嵌的完整提示词：能确认以模板前缀开头时同样拆分，否则整段作为前缀
+            if template_hash:
+                try:
+                    head = load_template_by_hash(template_hash, self.snapshot_dirs).partition("{API_CONTEXT}")[0]
+                except FileNotFoundError:
+                    head = ""
+                if head and system_prompt.startswith(head):
+                    return head, system_prompt[len(head):]
+            return system_prompt, ""
+
+        api_context = request.get('api_context_injected', [])
+        if not template_hash:
+            return load_system_prompt_parts(api_context)
+
+        template = load_template_by_hash(template_hash, self.snapshot_dirs)
+        apis = self.retriever.get_apis(api_context)
+        # 索引缺失或符号都找不到时与旧格式一致，使用占位文本
+        context_text = self.retriever.format_api_context(apis, len(apis)) if apis else NO_API_CONTEXT
+        return split_system_prompt(template, context_text)
+
+
+def build_system_blocks(
+    parts: Tuple[str, str],
+    prompt_cache: bool = True
+) -> Union[str, List[Dict]]:
+    """
+    构建 messages.create 的 system 参数
+
+    开启 prompt caching 时拆成两个 text block，各带一个 cache_control 断点：
+    - 静态前缀：所有请求共享（需达到模型的最小缓存长度才会实际缓存）
+    - 前缀 + API 上下文：检索到相同 API 的请求共享
+    关闭时退回单个字符串。
+    """
+    prefix, context = parts
+    if not prompt_cache:
+        return prefix + context
+
+    blocks = [{"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}}]
+    if context:
+        blocks.append({"type": "text", "text": context, "cache_control": {"type": "ephemeral"}})
+    return blocks
+
+
+def prompt_group_key(request: Dict) -> tuple:
+    """请求的提示词分组键：模板哈希 + 注入的 API 集合（决定 system 是否逐字相同）"""
+    return (
+        request.get('system_prompt_hash') or '',
+        tuple(request.get('api_context_injected') or ())
+    )
+
+
+def group_pending_by_prompt(pending: List[tuple]) -> List[tuple]:
+    """
+    按提示词分组重排待处理请求，让相同 system 的请求相邻调度以命中缓存
+
+    组按首次出现的顺序排列，组内保持原顺序；order_index 不变，输出顺序仍可恢复。
+    """
+    groups: Dict[tuple, List[tuple]] = {}
+    for item in pending:
+        groups.setdefault(prompt_group_key(item[1]), []).append(item)
+    return [item for group in groups.values() for item in group]
+
+
+def version_group_key(request: Dict) -> tuple:
+    """同一 prompt 的各版本（v1..vk）只差采样序号：prompt_id + 提示词分组键相同即完整提示词逐字相同"""
+    return (request.get('prompt_id') or request.get('id', ''),) + prompt_group_key(request)
+
+
+def group_pending_by_versions(pending: List[tuple], enabled: bool = True) -> List[List[tuple]]:
+    """
+    把同一 prompt 的各版本合并为一个调度单元
+
+    单元内的请求由同一个 worker 依次发出：第一个版本写入缓存后，其余版本整段提示词（含用户消息）
+    都从缓存读取，而不是同时发出、各自写一遍缓存。单元按首次出现的顺序排列；未开启时每个请求单独成为一个单元。
+
+    Returns:
+        [[(order_index, request), ...], ...]
+    """
+    if not enabled:
+        return [[item] for item in pending]
+    units: Dict[tuple, List[tuple]] = {}
+    for item in pending:
+        units.setdefault(version_group_key(item[1]), []).append(item)
+    return list(units.values())
+
+
+def build_user_content(user_message: str, cache: bool = False) -> Union[str, List[Dict]]:
+    """
+    构建 messages 中用户消息的 content
+
+    cache=True 时改为带 cache_control 的 text block（与 system 的两个断点合计 3 个，不超过上限 4 个），
+    同一 prompt 的后续版本连同用户消息一起命中缓存。
+    """
+    if not cache:
+        return user_message
+    return [{"type": "text", "text": user_message, "cache_control": {"type": "ephemeral"}}]
 
 
 def build_user_message(request: Dict) -> str:
@@ -134,25 +744,25 @@ def build_user_message(request: Dict) -> str:
 
 def call_claude_api(
     client: Anthropic,
-    system_prompt: str,
-    user_message: str,
+    system_prompt: Union[str, List[Dict]],
+    user_message: Union[str, List[Dict]],
     model: str = "claude-sonnet-4-5-20250929",
-    max_tokens: int = 4000,
-    temperature: float = 0.7
-) -> str:
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    temperature: float = DEFAULT_TEMPERATURE
+):
     """
     调用 Claude API
 
     Args:
         client: Anthropic 客户端
-        system_prompt: 系统提示词
-        user_message: 用户消息
+        system_prompt: 系统提示词（字符串，或带 cache_control 的 text block 列表）
+        user_message: 用户消息（字符串，或带 cache_control 的 text block 列表）
         model: 模型名称
         max_tokens: 最大生成 token 数
         temperature: 温度参数
 
     Returns:
-        模型输出文本
+        API 响应（文本在 response.content[0].text，用量在 response.usage）
     """
     response = client.messages.create(
         model=model,
@@ -167,15 +777,188 @@ def call_claude_api(
         ]
     )
 
-    # 提取文本内容
-    return response.content[0].text
+    return response
+
+
+def _partial_stream_usage(stream, text: str):
+    """中止的流拿不到最终 usage：输入取 message_start 的快照，输出按已生成文本估算"""
+    usage = usage_to_dict(stream.current_message_snapshot.usage) or {}
+    usage['output_tokens'] = estimate_tokens(text)
+    return SimpleNamespace(**usage)
+
+
+def call_claude_api_stream(
+    client: Anthropic,
+    system_prompt: Union[str, List[Dict]],
+    user_message: Union[str, List[Dict]],
+    model: str = "claude-sonnet-4-5-20250929",
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    temperature: float = DEFAULT_TEMPERATURE,
+    checker: Optional[StreamingOutputChecker] = None
+) -> Dict:
+    """
+    流式调用 Claude API
+
+    文本逐段交给 checker 检查；判定输出不可用时立即断开连接，剩余 token 不再生成和计费。
+
+    Returns:
+        {'text', 'usage', 'ttft', 'abort_reason'}，ttft 为首个文本片段到达的秒数
+    """
+    start = time.monotonic()
+    ttft = None
+    parts = []
+    abort_reason = None
+    with client.messages.stream(
+        model=model,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        system=system_prompt,
+        messages=[{"role": "user", "content": user_message}]
+    ) as stream:
+        for delta in stream.text_stream:
+            if ttft is None:
+                ttft = time.monotonic() - start
+            parts.append(delta)
+            if checker is not None and checker.feed(delta):
+                abort_reason = checker.abort_reason
+                break
+        text = "".join(parts)
+        usage = _partial_stream_usage(stream, text) if abort_reason else stream.get_final_message().usage
+    return {'text': text, 'usage': usage, 'ttft': ttft, 'abort_reason': abort_reason}
+
+
+async def call_claude_api_stream_async(
+    client: AsyncAnthropic,
+    system_prompt: Union[str, List[Dict]],
+    user_message: Union[str, List[Dict]],
+    model: str = "claude-sonnet-4-5-20250929",
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    temperature: float = DEFAULT_TEMPERATURE,
+    checker: Optional[StreamingOutputChecker] = None
+) -> Dict:
+    """call_claude_api_stream 的 asyncio 版本"""
+    start = time.monotonic()
+    ttft = None
+    parts = []
+    abort_reason = None
+    async with client.messages.stream(
+        model=model,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        system=system_prompt,
+        messages=[{"role": "user", "content": user_message}]
+    ) as stream:
+        async for delta in stream.text_stream:
+            if ttft is None:
+                ttft = time.monotonic() - start
+            parts.append(delta)
+            if checker is not None and checker.feed(delta):
+                abort_reason = checker.abort_reason
+                break
+        text = "".join(parts)
+        usage = _partial_stream_usage(stream, text) if abort_reason else (await stream.get_final_message()).usage
+    return {'text': text, 'usage': usage, 'ttft': ttft, 'abort_reason': abort_reason}
+
+
+def resolve_system_prompt(
+    request: Dict,
+    prompt_resolver: Optional[SystemPromptResolver] = None
+) -> Optional[Tuple[str, str]]:
+    """构建请求的系统提示词 (静态前缀, API 上下文部分)，模板快照缺失时返回 None"""
+    try:
+        if prompt_resolver is not None:
+            return prompt_resolver.resolve_parts(request)
+        return load_system_prompt_parts(request.get('api_context_injected', []))
+    except FileNotFoundError as e:
+        logger.error(f"Cannot build system prompt for {request.get('id', '')}: {e}")
+        return None
+
+
+def build_output_record(request: Dict, model: str, raw_output: str) -> Dict:
+    """构建写入输出 JSONL 的记录"""
+    return {
+        'id': request.get('id', ''),
+        'prompt_id': request.get('prompt_id', ''),
+        'version': request.get('version', 1),
+        'prompt_meta': request.get('prompt_meta', {}),
+        'raw_output': raw_output,
+        'output': raw_output,
+        'teacher_model': model,
+        'system_prompt_hash': request.get('system_prompt_hash'),
+        'api_context_injected': request.get('api_context_injected', []),
+        'timestamp': datetime.now().isoformat()
+    }
+
+
+def response_cache_key(
+    request: Dict,
+    model: str,
+    system_text: str,
+    user_message: str,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    temperature: float = DEFAULT_TEMPERATURE
+) -> str:
+    """
+    响应缓存键：模型 + 完整提示词 + 采样参数 + 采样序号
+
+    同一 prompt 的多个版本（v1..vN）提示词完全相同，version 作为采样序号计入键，
+    否则后续版本会直接命中 v1 的结果。
+    """
+    payload = [model, system_text, user_message, max_tokens, temperature, request.get('version', 1)]
+    return compute_hash(json.dumps(payload, ensure_ascii=False))
+
+
+def usage_to_dict(usage) -> Optional[Dict[str, int]]:
+    """把 SDK 的 usage 对象转成可序列化的 dict"""
+    if usage is None:
+        return None
+    return {name: getattr(usage, name, 0) or 0 for name in USAGE_FIELDS}
+
+
+def finish_generation(
+    request: Dict,
+    model: str,
+    result: Dict,
+    cache_key: Optional[str] = None,
+    response_cache: Optional[ResponseCache] = None,
+    latency: Optional[float] = None,
+    retries: int = 0
+) -> Dict:
+    """
+    写入响应缓存，并构建带 usage / 延迟 / 重试次数的输出记录
+
+    Args:
+        result: {'text', 'usage', 'ttft', 'abort_reason'}（非流式时 ttft/abort_reason 为 None）
+        latency: 成功那次调用的耗时（秒，不含重试等待）
+        retries: 成功前的重试次数（含限流）
+    """
+    # 中止的输出不完整，不进缓存（重跑时重新采样）
+    if response_cache is not None and not result.get('abort_reason'):
+        response_cache.set(cache_key, result['text'], usage_to_dict(result['usage']), model)
+
+    output = build_output_record(request, model, result['text'])
+    output['usage'] = usage_to_dict(result['usage'])
+    if latency is not None:
+        output['latency_s'] = round(latency, 3)
+    output['retries'] = retries
+    if result.get('ttft') is not None:
+        output['ttft_s'] = round(result['ttft'], 3)
+    if result.get('abort_reason'):
+        output['stream_abort'] = result['abort_reason']
+    return output
 
 
 def generate_claude_output(
     request: Dict,
     client: Anthropic,
     model: str,
-    max_retries: int = 3
+    max_retries: int = 3,
+    prompt_resolver: Optional[SystemPromptResolver] = None,
+    limiter: Optional[TokenBucketLimiter] = None,
+    prompt_cache: bool = True,
+    response_cache: Optional[ResponseCache] = None,
+    stream: bool = False,
+    cache_user_message: bool = False
 ) -> Optional[Dict]:
     """
     使用 Claude API 生成教师模型输出
@@ -185,40 +968,64 @@ def generate_claude_output(
         client: Anthropic 客户端
         model: 模型名称
         max_retries: 最大重试次数
+        prompt_resolver: 系统提示词重建器（为 None 时按旧格式拼接）
+        limiter: RPM/TPM 令牌桶限流器（可选）
+        prompt_cache: 是否为 system 设置 cache_control 断点
+        response_cache: 本地响应缓存（命中时不调用 API）
+        stream: 流式生成，边收边检查，明显不可用时提前中止
+        cache_user_message: 用户消息也设 cache_control（同一 prompt 还有其他版本待发时）
 
     Returns:
         输出数据，失败返回 None
     """
     # 构建提示词
-    api_context = request.get('api_context_injected', [])
-    system_prompt = load_system_prompt(api_context)
+    system_parts = resolve_system_prompt(request, prompt_resolver)
+    if system_parts is None:
+        return None
+    system_prompt = build_system_blocks(system_parts, prompt_cache)
     user_message = build_user_message(request)
+    user_content = build_user_content(user_message, prompt_cache and cache_user_message)
+    estimated_input = estimate_tokens("".join(system_parts)) + estimate_tokens(user_message)
+
+    cache_key = None
+    if response_cache is not None:
+        cache_key = response_cache_key(request, model, "".join(system_parts), user_message)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return dict(build_output_record(request, model, cached['text']), response_cache_hit=True)
 
     # 重试逻辑
     for attempt in range(max_retries):
+        reservation = limiter.acquire(estimated_input) if limiter else None
+        usage = None
+        start = time.monotonic()
         try:
-            raw_output = call_claude_api(
-                client=client,
-                system_prompt=system_prompt,
-                user_message=user_message,
-                model=model
-            )
+            if stream:
+                result = call_claude_api_stream(
+                    client=client,
+                    system_prompt=system_prompt,
+                    user_message=user_content,
+                    model=model,
+                    checker=StreamingOutputChecker()
+                )
+            else:
+                response = call_claude_api(
+                    client=client,
+                    system_prompt=system_prompt,
+                    user_message=user_content,
+                    model=model
+                )
+                result = {'text': response.content[0].text, 'usage': response.usage}
+            usage = result['usage']
 
             # 构建输出数据
-            return {
-                'id': request.get('id', ''),
-                'prompt_id': request.get('prompt_id', ''),
-                'version': request.get('version', 1),
-                'prompt_meta': request.get('prompt_meta', {}),
-                'raw_output': raw_output,
-                'output': raw_output,
-                'teacher_model': model,
-                'api_context_injected': api_context,
-                'timestamp': datetime.now().isoformat()
-            }
+            return finish_generation(
+                request, model, result, cache_key, response_cache,
+                latency=time.monotonic() - start, retries=attempt
+            )
 
         except RateLimitError as e:
-            wait_time = 60 * (attempt + 1)
+            wait_time = parse_retry_after(e) or 60 * (attempt + 1)
             logger.warning(f"Rate limit reached, waiting {wait_time}s... ({attempt + 1}/{max_retries})")
             time.sleep(wait_time)
 
@@ -233,35 +1040,399 @@ def generate_claude_output(
             logger.error(f"Unexpected error: {e}")
             return None
 
+        finally:
+            if reservation is not None:
+                limiter.settle(reservation, usage)
+
+    return None
+
+
+async def generate_claude_output_async(
+    request: Dict,
+    client: AsyncAnthropic,
+    model: str,
+    controller: AIMDController,
+    max_retries: int = 3,
+    max_rate_limit_retries: int = 20,
+    prompt_resolver: Optional[SystemPromptResolver] = None,
+    limiter: Optional[TokenBucketLimiter] = None,
+    prompt_cache: bool = True,
+    response_cache: Optional[ResponseCache] = None,
+    stream: bool = False,
+    cache_user_message: bool = False
+) -> Optional[Dict]:
+    """
+    asyncio 版本的教师输出生成
+
+    并发名额由 controller 分配；429/529 反馈给 controller（降并发并按 retry-after 暂停），
+    不计入普通错误的重试次数。
+
+    Args:
+        request: 蒸馏请求
+        client: AsyncAnthropic 客户端（应关闭 SDK 自带重试）
+        model: 模型名称
+        controller: 自适应并发控制器
+        max_retries: 非限流错误的最大重试次数
+        max_rate_limit_retries: 限流的最大重试次数
+        prompt_resolver: 系统提示词重建器
+        limiter: RPM/TPM 令牌桶限流器（可选，先于并发名额获取）
+        prompt_cache: 是否为 system 设置 cache_control 断点
+        response_cache: 本地响应缓存（命中时不调用 API）
+        stream: 流式生成，边收边检查，明显不可用时提前中止
+        cache_user_message: 用户消息也设 cache_control（同一 prompt 还有其他版本待发时）
+
+    Returns:
+        输出数据，失败返回 None
+    """
+    system_parts = resolve_system_prompt(request, prompt_resolver)
+    if system_parts is None:
+        return None
+    system_prompt = build_system_blocks(system_parts, prompt_cache)
+    user_message = build_user_message(request)
+    user_content = build_user_content(user_message, prompt_cache and cache_user_message)
+    estimated_input = estimate_tokens("".join(system_parts)) + estimate_tokens(user_message)
+
+    cache_key = None
+    if response_cache is not None:
+        cache_key = response_cache_key(request, model, "".join(system_parts), user_message)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return dict(build_output_record(request, model, cached['text']), response_cache_hit=True)
+
+    errors = 0
+    rate_limits = 0
+    while errors < max_retries and rate_limits < max_rate_limit_retries:
+        reservation = await limiter.acquire_async(estimated_input) if limiter else None
+        usage = None
+        await controller.acquire()
+        start = time.monotonic()
+        try:
+            if stream:
+                result = await call_claude_api_stream_async(
+                    client, system_prompt, user_content, model,
+                    checker=StreamingOutputChecker()
+                )
+            else:
+                response = await client.messages.create(
+                    model=model,
+                    max_tokens=DEFAULT_MAX_TOKENS,
+                    temperature=DEFAULT_TEMPERATURE,
+                    system=system_prompt,
+                    messages=[{"role": "user", "content": user_content}]
+                )
+                result = {'text': response.content[0].text, 'usage': response.usage}
+            latency = time.monotonic() - start
+            controller.on_success(latency)
+            usage = result['usage']
+            return finish_generation(
+                request, model, result, cache_key, response_cache,
+                latency=latency, retries=errors + rate_limits
+            )
+
+        except RateLimitError as e:
+            rate_limits += 1
+            controller.on_rate_limit(parse_retry_after(e))
+
+        except APIStatusError as e:
+            if e.status_code in (503, 529):
+                # overloaded：与限流同样处理
+                rate_limits += 1
+                controller.on_rate_limit(parse_retry_after(e))
+            else:
+                errors += 1
+                logger.error(f"API error: {e} (attempt {errors}/{max_retries})")
+                if errors < max_retries:
+                    await asyncio.sleep(5)
+
+        except APIError as e:
+            errors += 1
+            logger.error(f"API error: {e} (attempt {errors}/{max_retries})")
+            if errors < max_retries:
+                await asyncio.sleep(5)
+
+        except Exception as e:
+            logger.error(f"Unexpected error: {e}")
+            return None
+
+        finally:
+            await controller.release()
+            if reservation is not None:
+                limiter.settle(reservation, usage)
+
     return None
 
 
+async def run_async_requests(
+    units: List[List[tuple]],
+    api_key: str,
+    model: str,
+    on_result,
+    initial_concurrency: int = 4,
+    max_concurrency: int = 32,
+    base_url: Optional[str] = None,
+    prompt_resolver: Optional[SystemPromptResolver] = None,
+    limiter: Optional[TokenBucketLimiter] = None,
+    prompt_cache: bool = True,
+    response_cache: Optional[ResponseCache] = None,
+    stream: bool = False
+) -> dict:
+    """
+    asyncio 模式执行待处理请求
+
+    启动 max_concurrency 个协程从 units 中取任务，实际在途数由 AIMDController 控制；
+    同一单元内的请求由同一个协程依次发出。
+
+    Args:
+        units: 调度单元 [[(order_index, request), ...], ...]，order_index 为请求在 requests 文件中的位置
+        on_result: 回调 on_result(order_index, request_id, output)
+        initial_concurrency: 初始并发上限
+        max_concurrency: 并发上限的上界
+
+    Returns:
+        控制器统计
+    """
+    controller = AIMDController(initial=initial_concurrency, max_limit=max_concurrency)
+    # 关闭 SDK 内置重试，让 429/retry-after 信号交给控制器处理
+    client = AsyncAnthropic(api_key=api_key, base_url=base_url, max_retries=0)
+    units_iter = iter(units)
+
+    async def worker() -> None:
+        for unit in units_iter:
+            for order_index, request in unit:
+                try:
+                    output = await generate_claude_output_async(
+                        request, client, model, controller,
+                        prompt_resolver=prompt_resolver, limiter=limiter,
+                        prompt_cache=prompt_cache, response_cache=response_cache, stream=stream,
+                        cache_user_message=len(unit) > 1
+                    )
+                except Exception as e:
+                    logger.error(f"Unexpected error for request {request.get('id', '')}: {e}")
+                    output = None
+                on_result(order_index, request.get('id', ''), output)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(min(controller.max_limit, len(units)))))
+    finally:
+        await client.close()
+
+    stats = dict(controller.stats, final_limit=int(controller.limit))
+    logger.info(f"Async runner stats: {stats}")
+    return stats
+
+
+def build_message_params(
+    request: Dict,
+    model: str,
+    prompt_resolver: Optional[SystemPromptResolver] = None,
+    prompt_cache: bool = True,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    temperature: float = DEFAULT_TEMPERATURE,
+    cache_user_message: bool = False
+) -> Optional[Dict]:
+    """构建 Messages API 请求参数（batch 的 params 字段），模板快照缺失时返回 None"""
+    system_parts = resolve_system_prompt(request, prompt_resolver)
+    if system_parts is None:
+        return None
+    return {
+        "model": model,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "system": build_system_blocks(system_parts, prompt_cache),
+        "messages": [{
+            "role": "user",
+            "content": build_user_content(build_user_message(request), prompt_cache and cache_user_message)
+        }]
+    }
+
+
+def load_batch_state(state_path: Union[str, Path]) -> Dict:
+    """读取 batch 状态文件：{"batches": [{"id", "status", "created_at", "requests": {custom_id: request_id}}]}"""
+    if Path(state_path).exists():
+        return read_json(state_path)
+    return {"batches": []}
+
+
+def save_batch_state(state_path: Union[str, Path], state: Dict) -> None:
+    """原子写入 batch 状态文件（丢失已提交的 batch id 会导致重复提交、重复计费）"""
+    tmp_path = Path(str(state_path) + '.tmp')
+    write_json(tmp_path, state)
+    os.replace(tmp_path, state_path)
+
+
+def run_batch_requests(
+    units: List[List[tuple]],
+    requests_by_id: Dict[str, tuple],
+    done_ids: set,
+    client: Anthropic,
+    model: str,
+    on_result,
+    state_path: Union[str, Path],
+    batch_size: int = 10000,
+    poll_interval: float = 60.0,
+    prompt_resolver: Optional[SystemPromptResolver] = None,
+    prompt_cache: bool = True,
+    response_cache: Optional[ResponseCache] = None
+) -> Dict:
+    """
+    Message Batches API 模式执行待处理请求
+
+    1. 状态文件中未收取的 batch 视为在途（上次运行提交的），其中的请求不重复提交
+    2. 其余请求按 batch_size 分批提交（同一单元的请求相邻提交），每提交一个 batch 立即写状态文件
+    3. 轮询直到所有在途 batch 结束，逐条收取结果写入输出；已在输出中的 id 跳过
+       （上次收取到一半中断的情况）
+
+    失败 / 过期 / 取消的请求按失败计，下次运行会重新提交。
+
+    Args:
+        units: 调度单元 [[(order_index, request), ...], ...]
+        requests_by_id: request_id -> (order_index, request)，用于收取上次运行提交的 batch
+        done_ids: 已写入输出的 id（收取时跳过）
+        on_result: 回调 on_result(order_index, request_id, output)
+        state_path: batch 状态文件路径
+        batch_size: 每个 batch 的请求数（API 上限 100000 条 / 256MB）
+        poll_interval: 轮询间隔（秒）
+        response_cache: 本地响应缓存（命中的请求不提交，收取的结果写入缓存）
+
+    Returns:
+        统计信息
+    """
+    def cache_key_for(request: Dict, params: Dict) -> str:
+        system = params['system']
+        system_text = system if isinstance(system, str) else "".join(block['text'] for block in system)
+        return response_cache_key(
+            request, model, system_text, build_user_message(request),
+            params['max_tokens'], params['temperature']
+        )
+
+    state = load_batch_state(state_path)
+    active = [b for b in state['batches'] if b.get('status') != 'collected']
+    in_flight_ids = {req_id for b in active for req_id in b['requests'].values()}
+    if active:
+        logger.info(f"Resuming {len(active)} in-flight batches ({len(in_flight_ids)} requests)")
+
+    stats = {'submitted_batches': 0, 'submitted_requests': 0, 'succeeded': 0, 'failed': 0}
+
+    to_submit = [
+        (order_index, request, len(unit) > 1)
+        for unit in units for order_index, request in unit
+        if request.get('id', '') not in in_flight_ids
+    ]
+    for start in range(0, len(to_submit), batch_size):
+        batch_requests = []
+        mapping = {}
+        for order_index, request, cache_user_message in to_submit[start:start + batch_size]:
+            req_id = request.get('id', '')
+            params = build_message_params(
+                request, model, prompt_resolver, prompt_cache, cache_user_message=cache_user_message
+            )
+            if params is None:
+                on_result(order_index, req_id, None)
+                continue
+            if response_cache is not None:
+                cached = response_cache.get(cache_key_for(request, params))
+                if cached is not None:
+                    output = dict(build_output_record(request, model, cached['text']), response_cache_hit=True)
+                    on_result(order_index, req_id, output)
+                    continue
+            # custom_id 限 64 个 [a-zA-Z0-9_-] 字符，用顺序键生成并记录映射
+            custom_id = f"req-{order_index}"
+            batch_requests.append({"custom_id": custom_id, "params": params})
+            mapping[custom_id] = req_id
+        if not batch_requests:
+            continue
+
+        batch = client.messages.batches.create(requests=batch_requests)
+        entry = {
+            'id': batch.id,
+            'status': 'in_progress',
+            'created_at': datetime.now().isoformat(),
+            'requests': mapping
+        }
+        state['batches'].append(entry)
+        save_batch_state(state_path, state)
+        active.append(entry)
+        stats['submitted_batches'] += 1
+        stats['submitted_requests'] += len(batch_requests)
+        logger.info(f"Submitted batch {batch.id} with {len(batch_requests)} requests")
+
+    while active:
+        for entry in list(active):
+            batch = client.messages.batches.retrieve(entry['id'])
+            if batch.processing_status != 'ended':
+                continue
+
+            for item in client.messages.batches.results(entry['id']):
+                req_id = entry['requests'].get(item.custom_id)
+                if req_id is None or req_id in done_ids:
+                    continue
+                if req_id not in requests_by_id:
+                    logger.warning(f"Batch {entry['id']}: request {req_id} not in current requests file, skipped")
+                    continue
+                order_index, request = requests_by_id[req_id]
+
+                output = None
+                if item.result.type == 'succeeded':
+                    message = item.result.message
+                    text = message.content[0].text
+                    if response_cache is not None:
+                        params = build_message_params(request, model, prompt_resolver, prompt_cache)
+                        if params is not None:
+                            response_cache.set(
+                                cache_key_for(request, params), text, usage_to_dict(message.usage), model
+                            )
+                    output = build_output_record(request, model, text)
+                    output['usage'] = usage_to_dict(message.usage)
+                    stats['succeeded'] += 1
+                else:
+                    stats['failed'] += 1
+                    logger.warning(f"Batch {entry['id']}: request {req_id} {item.result.type}")
+                on_result(order_index, req_id, output)
+
+            entry['status'] = 'collected'
+            entry['request_counts'] = batch.request_counts.model_dump()
+            save_batch_state(state_path, state)
+            active.remove(entry)
+            logger.info(f"Collected batch {entry['id']}: {entry['request_counts']}")
+
+        if active:
+            logger.info(f"Waiting for {len(active)} batches, next poll in {poll_interval}s")
+            time.sleep(poll_interval)
+
+    logger.info(f"Batch runner stats: {stats}")
+    return stats
+
+
 def collect_done_ids_from_output(
     output_path: str,
-    request_id_scope: Optional[set[str]] = None
+    request_id_scope: Optional[set[str]] = None,
+    index: Optional[OutputIndex] = None
 ) -> tuple[set[str], int, dict[str, int]]:
     """
     从既有 output JSONL 中收集已完成的 request id（用于断点续跑/去重）。
 
+    只读取 id 侧车索引，不解析 raw_output。
+
     Args:
         output_path: 输出 JSONL 路径
         request_id_scope: 可选的 scope，仅统计在该集合内的 id
+        index: 已加载的侧车索引（为 None 时自动加载/重建）
 
     Returns:
         (done_ids, total_lines, duplicate_counts)
     """
-    path = Path(output_path)
-    if not path.exists():
+    if not Path(output_path).exists():
         return set(), 0, {}
+    if index is None:
+        index = OutputIndex(output_path).load()
 
     counts: dict[str, int] = {}
     total_lines = 0
 
-    for item in iter_jsonl(path):
-        if not isinstance(item, dict):
+    for item_id, _, _, status in index.entries:
+        if status in ('invalid', 'other'):
             continue
         total_lines += 1
-        item_id = item.get('id')
         if not item_id:
             continue
         if request_id_scope is not None and item_id not in request_id_scope:
@@ -273,10 +1444,13 @@ def collect_done_ids_from_output(
     return done_ids, total_lines, dupes
 
 
-def dedupe_output_jsonl_inplace(output_path: str) -> dict:
+def dedupe_output_jsonl_inplace(output_path: str, index: Optional[OutputIndex] = None) -> dict:
     """
     按 id 对 output JSONL 去重（保留第一次出现），并生成备份文件。
 
+    根据侧车索引判断重复；没有重复时不改写文件（backup_path 为空），
+    有重复时按字节区间拷贝保留的行，不解析 JSON。
+
     Returns:
         {
           "backup_path": str,
@@ -288,44 +1462,45 @@ def dedupe_output_jsonl_inplace(output_path: str) -> dict:
     src = Path(output_path)
     if not src.exists():
         return {"backup_path": "", "kept": 0, "removed": 0, "invalid_json_lines": 0}
-
-    ts = datetime.now().strftime("%Y%m%d-%H%M%S")
-    backup_path = str(src) + f".bak-{ts}"
-    tmp_path = str(src) + f".tmp-{ts}"
+    if index is None:
+        index = OutputIndex(output_path).load()
 
     seen: set[str] = set()
-    kept = 0
+    kept_entries: list[tuple] = []
     removed = 0
     invalid = 0
 
-    with open(src, "r", encoding="utf-8") as fin, open(tmp_path, "w", encoding="utf-8") as fout:
-        for line in fin:
-            if not line.strip():
-                continue
-            try:
-                obj = json.loads(line)
-            except json.JSONDecodeError:
-                invalid += 1
-                fout.write(line if line.endswith("\n") else line + "\n")
+    for entry in index.entries:
+        item_id, _, _, status = entry
+        if status == 'invalid':
+            invalid += 1
+        elif status == 'ok':
+            if item_id in seen:
+                removed += 1
                 continue
+            seen.add(item_id)
+        kept_entries.append(entry)
 
-            if not isinstance(obj, dict):
-                fout.write(line if line.endswith("\n") else line + "\n")
-                kept += 1
-                continue
+    kept = len(kept_entries) - invalid
+    if not removed:
+        return {"backup_path": "", "kept": kept, "removed": 0, "invalid_json_lines": invalid}
 
-            item_id = obj.get("id")
-            if item_id and item_id in seen:
-                removed += 1
-                continue
-            if item_id:
-                seen.add(item_id)
+    ts = datetime.now().strftime("%Y%m%d-%H%M%S")
+    backup_path = str(src) + f".bak-{ts}"
+    tmp_path = str(src) + f".tmp-{ts}"
 
-            fout.write(line if line.endswith("\n") else line + "\n")
-            kept += 1
+    new_entries = []
+    offset = 0
+    with open(src, "rb") as fin, open(tmp_path, "wb") as fout:
+        for item_id, old_offset, length, status in kept_entries:
+            fin.seek(old_offset)
+            fout.write(fin.read(length))
+            new_entries.append((item_id, offset, length, status))
+            offset += length
 
     os.replace(str(src), backup_path)
     os.replace(tmp_path, str(src))
+    index.replace(new_entries)
 
     return {
         "backup_path": backup_path,
@@ -346,7 +1521,25 @@ def run_claude_distill(
     resume_from: str = "auto",
     dedupe_output: bool = False,
     concurrency: int = 1,
-    max_in_flight: Optional[int] = None
+    max_in_flight: Optional[int] = None,
+    api_index_path: Optional[str] = None,
+    async_mode: bool = False,
+    max_concurrency: int = 32,
+    base_url: Optional[str] = None,
+    rpm: float = 0,
+    input_tpm: float = 0,
+    output_tpm: float = 0,
+    fsync_interval: float = 1.0,
+    prompt_cache: bool = True,
+    group_versions: bool = False,
+    run_stats: Optional[RunStats] = None,
+    report_path: Optional[str] = None,
+    backend: str = "messages",
+    batch_size: int = 10000,
+    poll_interval: float = 60.0,
+    batch_state_path: Optional[str] = None,
+    response_cache: Optional[ResponseCache] = None,
+    stream: bool = False
 ) -> int:
     """
     运行 Claude API 蒸馏
@@ -361,6 +1554,24 @@ def run_claude_distill(
         rate_limit_delay: 请求间隔（秒），并发时为全局请求起始间隔
         concurrency: 并发请求数（>1 可加速）
         max_in_flight: 最大在途任务数（默认=concurrency）
+        api_index_path: API 索引路径（按 symbol_id 重建 API 上下文）
+        async_mode: 使用 asyncio + 自适应并发（concurrency 为初始并发）
+        max_concurrency: asyncio 模式下并发上限的上界
+        base_url: API 地址（可指向本地 mock_claude_server.py）
+        rpm: 每分钟请求数预算（0 表示不限）
+        input_tpm: 每分钟输入 token 预算（0 表示不限）
+        output_tpm: 每分钟输出 token 预算（0 表示不限）
+        fsync_interval: 输出日志批量 fsync 的间隔（秒，0 表示每条 fsync）
+        prompt_cache: 开启 prompt caching（system 分块 + 按提示词分组调度）
+        group_versions: 同一 prompt 的各版本合并为一个调度单元依次发出（配合 prompt caching 时用户消息也进缓存）
+        run_stats: 运行统计（为 None 时内部创建；token/费用/吞吐/延迟，进度行实时显示）
+        report_path: 运行报告 JSON 路径（为 None 时不写）
+        backend: messages=逐条调用 Messages API；batch=Message Batches API（离线、半价）
+        batch_size: batch 模式每个 batch 的请求数
+        poll_interval: batch 模式轮询间隔（秒）
+        batch_state_path: batch 状态文件（默认 <output>.batches.json）
+        response_cache: 本地响应缓存（相同模型/提示词/采样参数/版本直接复用）
+        stream: 流式生成并增量检查输出，明显不可用时提前中止（batch 后端不支持）
 
     Returns:
         成功生成的数量
@@ -379,18 +1590,45 @@ def run_claude_distill(
     else:
         max_in_flight = max(1, int(max_in_flight))
 
-    logger.info(
-        f"Using model: {model} | concurrency={concurrency} | "
-        f"rate_limit_delay={rate_limit_delay}s | max_in_flight={max_in_flight}"
+    if backend not in {"messages", "batch"}:
+        raise ValueError("backend must be one of: messages, batch")
+
+    if backend == "batch":
+        logger.info(f"Using model: {model} | Message Batches API | batch_size={batch_size}")
+        if stream:
+            logger.warning("--stream is ignored by the batch backend")
+    elif async_mode:
+        logger.info(
+            f"Using model: {model} | async adaptive concurrency "
+            f"initial={concurrency} max={max(concurrency, max_concurrency)}"
+        )
+    else:
+        logger.info(
+            f"Using model: {model} | concurrency={concurrency} | "
+            f"rate_limit_delay={rate_limit_delay}s | max_in_flight={max_in_flight}"
+        )
+
+    # RPM/TPM 预算限流（设置任一预算时取代固定的 rate_limit_delay）
+    limiter = TokenBucketLimiter(rpm=rpm, input_tpm=input_tpm, output_tpm=output_tpm) or None
+    if limiter:
+        logger.info(f"Token bucket limits: rpm={rpm or '-'} input_tpm={input_tpm or '-'} output_tpm={output_tpm or '-'}")
+
+    # 模板快照优先在请求文件旁查找
+    prompt_resolver = SystemPromptResolver(
+        snapshot_dirs=[Path(requests_path).parent / 'templates', get_data_path('sft_distill/templates')],
+        api_index_path=api_index_path
     )
 
     # 确保输出文件存在
     Path(output_path).parent.mkdir(parents=True, exist_ok=True)
     if not Path(output_path).exists():
         Path(output_path).touch()
+    # 上次运行被中断时，日志末尾可能残留半行
+    repair_jsonl_tail(output_path)
+    output_index = OutputIndex(output_path).load()
 
     if dedupe_output:
-        dedupe_stats = dedupe_output_jsonl_inplace(output_path)
+        dedupe_stats = dedupe_output_jsonl_inplace(output_path, index=output_index)
         logger.info(
             "Deduped output file (keep first per id): "
             f"kept={dedupe_stats['kept']}, removed={dedupe_stats['removed']}, "
@@ -400,7 +1638,7 @@ def run_claude_distill(
 
     # 检查点
     checkpoint = Checkpoint(checkpoint_path) if checkpoint_path else None
-    if checkpoint:
+    if checkpoint is not None:
         logger.info(f"Resuming from checkpoint: {len(checkpoint)} processed")
 
     # 为确保断点续跑不重复计费/重复写入：优先从 output 文件同步已完成 id
@@ -411,9 +1649,10 @@ def run_claude_distill(
     request_id_scope = {r['id'] for r in requests if r.get('id')}
     output_done_ids, output_lines, output_dupes = collect_done_ids_from_output(
         output_path=output_path,
-        request_id_scope=request_id_scope
+        request_id_scope=request_id_scope,
+        index=output_index
     )
-    checkpoint_done_ids = set(checkpoint.processed) & request_id_scope if checkpoint else set()
+    checkpoint_done_ids = set(checkpoint.processed) & request_id_scope if checkpoint is not None else set()
 
     if output_dupes:
         logger.warning(
@@ -433,7 +1672,7 @@ def run_claude_distill(
         done_ids = output_done_ids if output_done_ids else checkpoint_done_ids
 
     # 同步 checkpoint，避免 output 已写入但 checkpoint 丢失导致重复生成
-    if checkpoint and done_ids != checkpoint_done_ids and resume_from in {"auto", "output"}:
+    if checkpoint is not None and done_ids != checkpoint_done_ids and resume_from in {"auto", "output"}:
         added = len(done_ids - checkpoint_done_ids)
         removed = len(checkpoint_done_ids - done_ids)
         logger.info(f"Sync checkpoint from output: +{added}, -{removed}, total={len(done_ids)}")
@@ -463,98 +1702,185 @@ def run_claude_distill(
                            suffix=f'✓ {success_count} | ✗ {failed_count}')
             continue
 
-        pending.append((len(pending), request))
-
-    if concurrency <= 1:
-        # 串行模式
-        client = Anthropic(api_key=api_key)
-        for idx, item in enumerate(pending):
-            _, request = item
-            req_id = request.get('id', '')
-
-            # 调用 API
-            output = generate_claude_output(request, client, model)
-
-            if output:
-                append_jsonl(output_path, output)
-                success_count += 1
-                done_ids.add(req_id)
+        # 以请求在 requests 文件中的位置作为顺序键（跨续跑稳定）
+        pending.append((i, request))
 
-                if checkpoint:
-                    checkpoint.mark_done(req_id)
-                    checkpoint.save()  # 每条成功后立即保存，支持真正的断点续传
-            else:
-                failed_count += 1
-                logger.error(f"Failed to generate output for request {req_id}")
-
-            completed_count += 1
-            print_progress(completed_count, len(requests), prefix='Claude distill',
-                           suffix=f'✓ {success_count} | ✗ {failed_count}')
-
-            # 速率限制
-            if idx < len(pending) - 1:
-                time.sleep(rate_limit_delay)
-    else:
-        # 并发模式
-        rate_limiter = RateLimiter(rate_limit_delay)
-
-        def worker(req: dict) -> Optional[dict]:
-            rate_limiter.wait()
-            client = get_thread_client(api_key)
-            return generate_claude_output(req, client, model)
-
-        with ThreadPoolExecutor(max_workers=concurrency) as executor:
-            pending_iter = iter(pending)
-            futures: dict = {}
-            ordered_buffer: dict[int, tuple[Optional[dict], str]] = {}
-            next_write_index = 0
-
-            def submit_one() -> bool:
-                try:
-                    order_index, req = next(pending_iter)
-                except StopIteration:
-                    return False
-                req_id = req.get('id', '')
-                futures[executor.submit(worker, req)] = (order_index, req_id)
-                return True
-
-            for _ in range(min(max_in_flight, len(pending))):
-                submit_one()
-
-            while futures:
-                done, _ = wait(futures, return_when=FIRST_COMPLETED)
-                for future in done:
-                    order_index, req_id = futures.pop(future)
+    if prompt_cache:
+        pending = group_pending_by_prompt(pending)
+        logger.info(
+            f"Prompt caching on: {len(pending)} pending requests in "
+            f"{len({prompt_group_key(r) for _, r in pending})} prompt groups"
+        )
+    units = group_pending_by_versions(pending, enabled=group_versions)
+    if group_versions:
+        logger.info(f"Version grouping on: {len(pending)} pending requests in {len(units)} scheduling units")
+    if run_stats is None:
+        run_stats = RunStats(model, batch=backend == "batch")
+    run_stats.begin(len(pending))
+
+    def record_output(output: Optional[dict], req_id: str) -> None:
+        """写入单条结果并更新统计/检查点"""
+        nonlocal success_count, failed_count, completed_count
+        run_stats.record(output)
+        if output:
+            # 输出日志即断点：续跑时从 output 推导已完成 id，检查点只在退出时保存
+            journal.append(output)
+            success_count += 1
+            done_ids.add(req_id)
+
+            if checkpoint is not None:
+                checkpoint.mark_done(req_id)
+        else:
+            failed_count += 1
+            logger.error(f"Failed to generate output for request {req_id}")
+
+        completed_count += 1
+        print_progress(completed_count, len(requests), prefix='Claude distill', suffix=run_stats.dashboard())
+
+    def on_result(order_index: int, req_id: str, output: Optional[dict]) -> None:
+        """完成即写入，不等待前序请求；写入顺序由 request_index 记录，下游可按需恢复"""
+        if output:
+            output['request_index'] = order_index
+        record_output(output, req_id)
+
+    journal = OutputJournal(output_path, fsync_interval=fsync_interval, index=output_index)
+    try:
+        if backend == "batch":
+            # Message Batches API：提交后轮询收取，状态文件支持跨运行续收
+            run_batch_requests(
+                units,
+                requests_by_id={r['id']: (i, r) for i, r in enumerate(requests)},
+                done_ids=done_ids,
+                client=Anthropic(api_key=api_key, base_url=base_url),
+                model=model,
+                on_result=on_result,
+                state_path=batch_state_path or f"{output_path}.batches.json",
+                batch_size=max(1, int(batch_size)),
+                poll_interval=poll_interval,
+                prompt_resolver=prompt_resolver,
+                prompt_cache=prompt_cache,
+                response_cache=response_cache
+            )
+        elif async_mode:
+            # asyncio 模式：自适应并发，忽略 rate_limit_delay
+            asyncio.run(run_async_requests(
+                units,
+                api_key=api_key,
+                model=model,
+                on_result=on_result,
+                initial_concurrency=concurrency,
+                max_concurrency=max(concurrency, max_concurrency),
+                base_url=base_url,
+                prompt_resolver=prompt_resolver,
+                limiter=limiter,
+                prompt_cache=prompt_cache,
+                response_cache=response_cache,
+                stream=stream
+            ))
+        elif concurrency <= 1:
+            # 串行模式
+            client = Anthropic(api_key=api_key, base_url=base_url)
+            sent = 0
+            for unit in units:
+                for order_index, request in unit:
+                    req_id = request.get('id', '')
+
+                    # 调用 API
+                    output = generate_claude_output(
+                        request, client, model, prompt_resolver=prompt_resolver, limiter=limiter,
+                        prompt_cache=prompt_cache, response_cache=response_cache, stream=stream,
+                        cache_user_message=len(unit) > 1
+                    )
+                    on_result(order_index, req_id, output)
+                    sent += 1
+
+                    # 速率限制（命中响应缓存的请求没有调用 API，不需要等待）
+                    if not limiter and sent < len(pending) and not (output and output.get('response_cache_hit')):
+                        time.sleep(rate_limit_delay)
+        else:
+            # 并发模式
+            rate_limiter = RateLimiter(0 if limiter else rate_limit_delay)
+
+            def worker(unit: List[tuple]) -> List[Optional[dict]]:
+                """依次发出单元内的请求（同一 prompt 的后续版本命中前一个写入的缓存）"""
+                client = get_thread_client(api_key, base_url)
+                outputs = []
+                for _, req in unit:
+                    rate_limiter.wait()
+                    outputs.append(generate_claude_output(
+                        req, client, model, prompt_resolver=prompt_resolver, limiter=limiter,
+                        prompt_cache=prompt_cache, response_cache=response_cache, stream=stream,
+                        cache_user_message=len(unit) > 1
+                    ))
+                return outputs
+
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                units_iter = iter(units)
+                futures: dict = {}
+
+                def submit_one() -> bool:
                     try:
-                        output = future.result()
-                    except Exception as e:
-                        logger.error(f"Unexpected error for request {req_id}: {e}")
-                        output = None
-                    ordered_buffer[order_index] = (output, req_id)
-
-                    while next_write_index in ordered_buffer:
-                        buffered_output, buffered_id = ordered_buffer.pop(next_write_index)
-                        if buffered_output:
-                            append_jsonl(output_path, buffered_output)
-                            success_count += 1
-                            done_ids.add(buffered_id)
-
-                            if checkpoint:
-                                checkpoint.mark_done(buffered_id)
-                                checkpoint.save()
-                        else:
-                            failed_count += 1
-                            logger.error(f"Failed to generate output for request {buffered_id}")
-
-                        completed_count += 1
-                        print_progress(completed_count, len(requests), prefix='Claude distill',
-                                       suffix=f'✓ {success_count} | ✗ {failed_count}')
-                        next_write_index += 1
+                        unit = next(units_iter)
+                    except StopIteration:
+                        return False
+                    futures[executor.submit(worker, unit)] = unit
+                    return True
 
+                for _ in range(min(max_in_flight, len(units))):
                     submit_one()
 
-    if checkpoint:
-        checkpoint.save()
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        unit = futures.pop(future)
+                        try:
+                            outputs = future.result()
+                        except Exception as e:
+                            unit_ids = [r.get('id', '') for _, r in unit]
+                            logger.error(f"Unexpected error for requests {unit_ids}: {e}")
+                            outputs = [None] * len(unit)
+                        for (order_index, req), output in zip(unit, outputs):
+                            on_result(order_index, req.get('id', ''), output)
+                        submit_one()
+    finally:
+        journal.close()
+        if checkpoint is not None:
+            checkpoint.save()
+
+    if limiter:
+        logger.info(f"Token bucket stats: {limiter.stats}, input_ratio={limiter.input_ratio:.2f}, "
+                    f"expected_output={limiter.expected_output:.0f}")
+
+    summary = run_stats.report()
+    usage = summary['tokens']
+    logger.info(
+        f"Token usage: input={usage['input_tokens']}, output={usage['output_tokens']}, "
+        f"cache_write={usage['cache_creation_input_tokens']}, cache_read={usage['cache_read_input_tokens']}, "
+        f"cache_hit_rate={usage['cache_hit_rate']:.1%}"
+    )
+    if summary['cost_usd'] is not None:
+        logger.info(f"Cost: ${summary['cost_usd']['total']:.4f} ({summary['cost_usd']})")
+    logger.info(
+        f"Throughput: {summary['throughput']}, latency: {summary['latency_s']}, retries: {summary['retries']}"
+    )
+    if response_cache is not None:
+        logger.info(f"Response cache: {response_cache.stats()}")
+    if summary['ttft_s']['count']:
+        logger.info(
+            f"Streaming: ttft p50={summary['ttft_s']['p50']:.2f}s "
+            f"p95={summary['ttft_s']['p95']:.2f}s, early aborts={summary['stream_aborts'] or 0}"
+        )
+
+    if report_path:
+        summary['output_path'] = str(output_path)
+        report = generate_report_summary(
+            name='teacher_claude',
+            total=len(pending),
+            passed=run_stats.succeeded,
+            details=summary
+        )
+        write_json(report_path, report)
+        logger.info(f"Saved report to {report_path}")
 
     logger.info(f"Distillation complete: {success_count} success, {failed_count} failed")
     return success_count
@@ -628,7 +1954,7 @@ def main():
         '--checkpoint',
         type=str,
         default=str(get_data_path('sft_distill/checkpoint_claude.json')),
-        help='检查点文件路径'
+        help='检查点文件路径（仅在退出时保存，进度以输出日志为准）'
     )
     parser.add_argument(
         '--rate-limit-delay',
@@ -660,6 +1986,123 @@ def main():
         action='store_true',
         help='启动时对输出 JSONL 按 id 去重（保留第一次出现），并生成 .bak 备份'
     )
+    parser.add_argument(
+        '--api-index',
+        type=str,
+        default=str(get_stage0_path('data/api_index/phaser_api.jsonl')),
+        help='API 索引路径（按 api_context_injected 重建系统提示词中的 API 上下文）'
+    )
+    parser.add_argument(
+        '--async',
+        dest='async_mode',
+        action='store_true',
+        help='asyncio 模式：按延迟与 429/retry-after 自适应调整并发（--concurrency 为初始值，忽略 --rate-limit-delay）'
+    )
+    parser.add_argument(
+        '--max-concurrency',
+        type=int,
+        default=32,
+        help='asyncio 模式下的并发上限'
+    )
+    parser.add_argument(
+        '--rpm',
+        type=float,
+        default=0,
+        help='每分钟请求数预算（令牌桶，0 表示不限；设置任一预算时忽略 --rate-limit-delay）'
+    )
+    parser.add_argument(
+        '--itpm',
+        type=float,
+        default=0,
+        help='每分钟输入 token 预算（发送前按估算预扣，返回后按 usage 校正）'
+    )
+    parser.add_argument(
+        '--otpm',
+        type=float,
+        default=0,
+        help='每分钟输出 token 预算'
+    )
+    parser.add_argument(
+        '--fsync-interval',
+        type=float,
+        default=1.0,
+        help='输出日志批量 fsync 间隔（秒，0 表示每条 fsync）；检查点仅在退出时保存'
+    )
+    parser.add_argument(
+        '--no-prompt-cache',
+        dest='prompt_cache',
+        action='store_false',
+        help='关闭 prompt caching（system 不分块、不加 cache_control、不按提示词分组调度）'
+    )
+    parser.add_argument(
+        '--group-versions',
+        action='store_true',
+        help='同一 prompt 的 v1..vk 合并为一个调度单元依次发出：首个版本写缓存，其余版本整段提示词读缓存'
+    )
+    parser.add_argument(
+        '--backend',
+        choices=['messages', 'batch'],
+        default='messages',
+        help='messages=逐条调用（默认）；batch=Message Batches API（离线、半价，最长 24 小时出结果）'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=10000,
+        help='batch 模式每个 batch 的请求数'
+    )
+    parser.add_argument(
+        '--poll-interval',
+        type=float,
+        default=60.0,
+        help='batch 模式轮询间隔（秒）'
+    )
+    parser.add_argument(
+        '--batch-state',
+        type=str,
+        default=None,
+        help='batch 状态文件（记录已提交的 batch，用于续收；默认 <output>.batches.json）'
+    )
+    parser.add_argument(
+        '--response-cache',
+        type=str,
+        default=str(get_data_path('sft_distill/response_cache.sqlite')),
+        help='本地响应缓存（SQLite）；相同模型/提示词/采样参数/版本的请求直接复用，不再调用 API'
+    )
+    parser.add_argument(
+        '--no-response-cache',
+        action='store_true',
+        help='不读写本地响应缓存（需要重新采样时使用）'
+    )
+    parser.add_argument(
+        '--response-cache-ttl',
+        type=float,
+        default=0,
+        help='响应缓存有效期（天，0 表示不过期）'
+    )
+    parser.add_argument(
+        '--response-cache-max-entries',
+        type=int,
+        default=0,
+        help='响应缓存最大条目数，超出按最近访问时间淘汰（0 表示不限）'
+    )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='流式生成：边收边检查 [PLAN]/代码块，明显不可用时提前中止，并记录首 token 延迟'
+    )
+    parser.add_argument(
+        '--report',
+        type=str,
+        default=str(get_reports_path('teacher_claude_report.json')),
+        help='运行报告 JSON（实测 token/费用/吞吐/延迟；同模型再次运行时用于预估）'
+    )
+    parser.add_argument(
+        '--base-url',
+        type=str,
+        default=None,
+        help='API 地址（如 http://127.0.0.1:8765 指向本地 mock_claude_server.py）'
+    )
 
     args = parser.parse_args()
 
@@ -676,31 +2119,49 @@ def main():
     requests = read_jsonl(args.requests)
     total_requests = min(len(requests), args.max_items) if args.max_items else len(requests)
 
-    # 成本估算（粗略）
-    if 'sonnet-4-5' in args.model.lower():
-        cost_per_request = 0.015
-        model_name = "Sonnet 4.5"
-    elif 'sonnet' in args.model.lower():
-        cost_per_request = 0.015  # $0.015/请求（约 3000 input + 2000 output tokens）
-        model_name = "Sonnet 3.5"
-    elif 'opus' in args.model.lower():
-        cost_per_request = 0.075  # $0.075/请求
-        model_name = "Opus 4"
+    # 成本/时间估算：优先使用上次同模型运行报告中的实测值，否则按价格表与经验 token 数粗估
+    batch = args.backend == 'batch'
+    measured = None
+    if Path(args.report).exists():
+        details = read_json(args.report).get('details', {})
+        if details.get('model') == args.model and details.get('per_request'):
+            measured = details
+
+    pricing = get_model_pricing(args.model)
+    if measured:
+        # 上次的平均 usage（含缓存读写比例）按当前后端重新计价
+        per_request_usage = measured['per_request']
     else:
-        cost_per_request = 0.01
-        model_name = "Unknown"
+        per_request_usage = {'input_tokens': 3000, 'output_tokens': 2000}
+    estimated_cost = (
+        total_requests * estimate_cost(per_request_usage, pricing, batch)['total'] if pricing else None
+    )
 
-    estimated_cost = total_requests * cost_per_request
-    effective_concurrency = max(1, int(args.concurrency))
-    estimated_time = total_requests * (args.rate_limit_delay + 2) / effective_concurrency
+    measured_rate = None
+    if measured and measured.get('backend') == args.backend and not batch:
+        measured_rate = measured['throughput']['requests_per_s'] or None
+    if measured_rate:
+        estimated_time = total_requests / measured_rate
+    elif args.async_mode:
+        estimated_time = total_requests * 2 / max(1, args.max_concurrency, args.concurrency)
+    else:
+        effective_concurrency = max(1, int(args.concurrency))
+        estimated_time = total_requests * (args.rate_limit_delay + 2) / effective_concurrency
 
     print(f"\n{'='*60}")
     print(f"Claude API 蒸馏任务")
     print(f"{'='*60}")
-    print(f"模型：{model_name} ({args.model})")
+    print(f"模型：{args.model}")
     print(f"请求数量：{total_requests}")
-    print(f"预估成本：${estimated_cost:.2f} USD")
-    print(f"预估时间：{estimated_time/60:.1f} 分钟")
+    basis = f"基于上次实测：{measured['started_at']}" if measured else "按价格表与约 3000 input + 2000 output tokens 粗估"
+    if estimated_cost is not None:
+        print(f"预估成本：${estimated_cost:.2f} USD（{basis}）")
+    else:
+        print("预估成本：未知（价格表中没有该模型）")
+    if batch:
+        print("预估时间：取决于 batch 排队（通常 1 小时内，最长 24 小时）")
+    else:
+        print(f"预估时间：{estimated_time/60:.1f} 分钟{'（基于上次实测吞吐）' if measured_rate else ''}")
     print(f"{'='*60}\n")
 
     # 确认
@@ -712,6 +2173,14 @@ def main():
 
     # 开始蒸馏
     start_time = time.time()
+    run_stats = RunStats(args.model, batch=batch)
+    response_cache = None
+    if not args.no_response_cache:
+        response_cache = ResponseCache(
+            args.response_cache,
+            ttl_seconds=args.response_cache_ttl * 86400,
+            max_entries=args.response_cache_max_entries
+        )
 
     count = run_claude_distill(
         requests_path=args.requests,
@@ -724,7 +2193,25 @@ def main():
         resume_from=args.resume_from,
         dedupe_output=args.dedupe_output,
         concurrency=args.concurrency,
-        max_in_flight=args.max_in_flight
+        max_in_flight=args.max_in_flight,
+        api_index_path=args.api_index,
+        async_mode=args.async_mode,
+        max_concurrency=args.max_concurrency,
+        base_url=args.base_url,
+        rpm=args.rpm,
+        input_tpm=args.itpm,
+        output_tpm=args.otpm,
+        fsync_interval=args.fsync_interval,
+        prompt_cache=args.prompt_cache,
+        group_versions=args.group_versions,
+        run_stats=run_stats,
+        report_path=args.report,
+        backend=args.backend,
+        batch_size=args.batch_size,
+        poll_interval=args.poll_interval,
+        batch_state_path=args.batch_state,
+        response_cache=response_cache,
+        stream=args.stream
     )
 
     elapsed = time.time() - start_time
@@ -736,6 +2223,26 @@ def main():
     print(f"  - 耗时：{elapsed/60:.1f} 分钟")
     print(f"  - 输出路径：{args.output}")
     print(f"  - 检查点：{args.checkpoint}")
+    summary = run_stats.report()
+    usage = summary['tokens']
+    if summary['requests']['api_calls']:
+        print(f"  - 输入 token：未缓存 {usage['input_tokens']} | 写缓存 {usage['cache_creation_input_tokens']} "
+              f"| 读缓存 {usage['cache_read_input_tokens']}（命中率 {usage['cache_hit_rate']:.1%}）")
+        print(f"  - 输出 token：{usage['output_tokens']}")
+    if summary['cost_usd'] is not None:
+        print(f"  - 实际花费：${summary['cost_usd']['total']:.4f} USD"
+              f"（平均 ${summary['per_request'].get('cost_usd') or 0:.4f}/请求）")
+    if summary['latency_s']['count']:
+        print(f"  - 吞吐：{summary['throughput']['requests_per_s']:.2f} req/s，"
+              f"{summary['throughput']['output_tokens_per_s']:.0f} 输出 tok/s；"
+              f"延迟 p50 {summary['latency_s']['p50']:.1f}s / p95 {summary['latency_s']['p95']:.1f}s；"
+              f"重试 {summary['retries']['total']} 次")
+    print(f"  - 运行报告：{args.report}")
+    if response_cache is not None:
+        cache_stats = response_cache.stats()
+        print(f"  - 响应缓存：命中 {cache_stats['hits']} / 查询 {cache_stats['lookups']}"
+              f"（{args.response_cache}，共 {cache_stats['size']} 条）")
+        response_cache.close()
     print(f"{'='*60}\n")
 
 
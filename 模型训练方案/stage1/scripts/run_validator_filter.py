@@ -8,7 +8,11 @@
 
 import subprocess
 import json
+import queue
+import tempfile
 import argparse
+import threading
+import time
 from pathlib import Path
 from typing import Optional, Tuple, List
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -27,9 +31,172 @@ VALIDATOR_CLI = get_stage0_path('validator/src/cli.js')
 API_INDEX_PATH = get_stage0_path('data/api_index/phaser_api.jsonl')
 
 
+def _validator_flags(fail_fast: bool = False) -> List[str]:
+    """
+    validator 公共参数
+
+    Stage1 不做运行时验证，固定跳过 runtime。fail-fast 沿用默认阶段顺序 ast → eslint → api：
+    L1 只看 ast/eslint，它们失败时后续阶段的结论不影响 L1/L4 判定（见 check_l1/check_l4）。
+    """
+    flags = ['--skip-runtime']
+    if fail_fast:
+        flags.append('--fail-fast')
+    return flags
+
+
+def _error_result(message: str) -> dict:
+    """构造 validator 调用失败时的占位结果"""
+    return {
+        'error': message,
+        'parse_ok': False,
+        'lint_ok': False,
+        'api_ok': False,
+        'runtime_ok': False
+    }
+
+
+class ValidatorWorker:
+    """
+    常驻 validator 进程（`cli.js --serve`）
+
+    通过 stdin/stdout 按行收发 JSON，API 索引、ESLint、Babel 只在进程启动时加载一次。
+    """
+
+    def __init__(self, api_index_path: str, fail_fast: bool = False):
+        self.api_index_path = api_index_path
+        self.fail_fast = fail_fast
+        self.proc: Optional[subprocess.Popen] = None
+        self._lines: queue.Queue = queue.Queue()
+        self._seq = 0
+        self.start()
+
+    def start(self) -> None:
+        """启动 validator 进程"""
+        cmd = [
+            'node', str(VALIDATOR_CLI),
+            '--serve',
+            '--api-index', self.api_index_path,
+            *_validator_flags(self.fail_fast)
+        ]
+        self.proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            encoding='utf-8',
+            bufsize=1
+        )
+        self._lines = queue.Queue()
+        reader = threading.Thread(target=self._pump, args=(self.proc, self._lines), daemon=True)
+        reader.start()
+
+    @staticmethod
+    def _pump(proc: subprocess.Popen, lines: queue.Queue) -> None:
+        """后台读取进程输出，None 表示进程已退出"""
+        for line in proc.stdout:
+            lines.put(line)
+        lines.put(None)
+
+    def request(self, item: dict, timeout: float = 30) -> dict:
+        """
+        发送单条验证请求并等待结果
+
+        Raises:
+            queue.Empty: 超时
+            RuntimeError: 进程已退出
+        """
+        self._seq += 1
+        payload = dict(item, id=self._seq)
+        self.proc.stdin.write(json.dumps(payload, ensure_ascii=False) + '\n')
+        self.proc.stdin.flush()
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise queue.Empty()
+            line = self._lines.get(timeout=remaining)
+            if line is None:
+                raise RuntimeError('Validator worker exited')
+            message = json.loads(line)
+            if message.get('id') == self._seq:
+                return message.get('result') or {}
+
+    def restart(self) -> None:
+        """重启进程（超时或崩溃后调用）"""
+        self.close()
+        self.start()
+
+    def close(self) -> None:
+        """关闭进程"""
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+
+class ValidatorPool:
+    """
+    常驻 validator 进程池
+
+    维持 N 个热进程，验证吞吐只受 AST/Lint 计算限制，而非进程启动开销。
+    线程安全：每次调用独占一个空闲 worker。
+    """
+
+    def __init__(
+        self,
+        size: int = 4,
+        api_index_path: str = None,
+        timeout: float = 30,
+        fail_fast: bool = False
+    ):
+        self.api_index_path = api_index_path or str(API_INDEX_PATH)
+        self.timeout = timeout
+        self._workers = [ValidatorWorker(self.api_index_path, fail_fast) for _ in range(max(1, size))]
+        self._idle: queue.Queue = queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+
+    def validate(self, code_path: str) -> dict:
+        """验证单个代码文件"""
+        worker = self._idle.get()
+        try:
+            return worker.request({'code_file': code_path}, timeout=self.timeout)
+        except queue.Empty:
+            worker.restart()
+            return _error_result('Validator process timeout')
+        except Exception as e:
+            worker.restart()
+            return _error_result(str(e))
+        finally:
+            self._idle.put(worker)
+
+    def close(self) -> None:
+        """关闭所有 worker"""
+        for worker in self._workers:
+            worker.close()
+
+    def __enter__(self) -> 'ValidatorPool':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
 def call_validator(
     code_path: str,
-    api_index_path: str = None
+    api_index_path: str = None,
+    pool: Optional[ValidatorPool] = None,
+    fail_fast: bool = False
 ) -> dict:
     """
     调用 stage0 validator CLI
@@ -37,20 +204,23 @@ def call_validator(
     Args:
         code_path: 代码文件路径
         api_index_path: API 索引路径
+        pool: 常驻进程池，提供时复用热进程，否则每次启动新进程（fail-fast 由进程池的启动参数决定）
+        fail_fast: 首个阶段失败即停止，跳过后续阶段（仅对新启动的进程生效）
     Returns:
         Validator 输出结果
     """
+    if pool is not None:
+        return pool.validate(code_path)
+
     api_index_path = api_index_path or str(API_INDEX_PATH)
 
     cmd = [
         'node', str(VALIDATOR_CLI),
         '--code-file', code_path,
-        '--api-index', api_index_path
+        '--api-index', api_index_path,
+        *_validator_flags(fail_fast)
     ]
 
-    # Stage1 不做运行时验证，固定跳过 runtime
-    cmd.append('--skip-runtime')
-
     try:
         result = subprocess.run(
             cmd,
@@ -62,38 +232,86 @@ def call_validator(
         if result.stdout.strip():
             return json.loads(result.stdout)
         else:
-            return {
-                'error': result.stderr or 'No output from validator',
-                'parse_ok': False,
-                'lint_ok': False,
-                'api_ok': False,
-                'runtime_ok': False
-            }
+            return _error_result(result.stderr or 'No output from validator')
 
     except subprocess.TimeoutExpired:
-        return {
-            'error': 'Validator process timeout',
-            'parse_ok': False,
-            'lint_ok': False,
-            'api_ok': False,
-            'runtime_ok': False
-        }
+        return _error_result('Validator process timeout')
     except json.JSONDecodeError as e:
-        return {
-            'error': f'JSON decode error: {str(e)}',
-            'parse_ok': False,
-            'lint_ok': False,
-            'api_ok': False,
-            'runtime_ok': False
-        }
+        return _error_result(f'JSON decode error: {str(e)}')
     except Exception as e:
-        return {
-            'error': str(e),
-            'parse_ok': False,
-            'lint_ok': False,
-            'api_ok': False,
-            'runtime_ok': False
-        }
+        return _error_result(str(e))
+
+
+def call_validator_batch(
+    code_paths: List[str],
+    api_index_path: str = None,
+    timeout_per_item: float = 30,
+    fail_fast: bool = False
+) -> dict:
+    """
+    以 manifest 模式调用 validator：一个进程验证多个代码文件
+
+    API 索引、ESLint、Babel 在每个 batch 只加载一次。
+
+    Args:
+        code_paths: 代码文件路径列表
+        api_index_path: API 索引路径
+        timeout_per_item: 单条超时（秒），进程级超时按条数累加
+        fail_fast: 首个阶段失败即停止，跳过后续阶段
+
+    Returns:
+        {code_path: validator 输出结果}，缺失的条目填充错误结果
+    """
+    api_index_path = api_index_path or str(API_INDEX_PATH)
+    if not code_paths:
+        return {}
+
+    with tempfile.NamedTemporaryFile(
+        'w', suffix='.jsonl', encoding='utf-8', delete=False
+    ) as f:
+        for i, code_path in enumerate(code_paths):
+            f.write(json.dumps({'id': i, 'code_file': code_path}, ensure_ascii=False) + '\n')
+        manifest_path = f.name
+
+    cmd = [
+        'node', str(VALIDATOR_CLI),
+        '--manifest', manifest_path,
+        '--api-index', api_index_path,
+        *_validator_flags(fail_fast)
+    ]
+
+    results: dict = {}
+    error = 'No output from validator'
+    try:
+        proc = subprocess.run(
+            cmd,
+            capture_output=True,
+            text=True,
+            timeout=timeout_per_item * len(code_paths)
+        )
+        for line in proc.stdout.splitlines():
+            if not line.strip():
+                continue
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            idx = message.get('id')
+            if isinstance(idx, int) and 0 <= idx < len(code_paths):
+                results[code_paths[idx]] = message.get('result') or {}
+        if proc.stderr.strip():
+            error = proc.stderr
+    except subprocess.TimeoutExpired:
+        error = 'Validator process timeout'
+    except Exception as e:
+        error = str(e)
+    finally:
+        Path(manifest_path).unlink(missing_ok=True)
+
+    for code_path in code_paths:
+        if code_path not in results:
+            results[code_path] = _error_result(error)
+    return results
 
 
 def check_l1(validator_result: dict, code: str) -> Tuple[bool, List[str]]:
@@ -104,6 +322,8 @@ def check_l1(validator_result: dict, code: str) -> Tuple[bool, List[str]]:
     - lint_ok: ESLint 通过
     - 无危险用法
     - 代码非空（>100字符）
+
+    fail-fast 下 ESLint 可能因前序阶段失败被跳过（skipped_stages），结论未知，按未通过处理。
     """
     issues = []
 
@@ -117,7 +337,9 @@ def check_l1(validator_result: dict, code: str) -> Tuple[bool, List[str]]:
         issues.append('l1_parse_failed')
 
     # ESLint
-    if not validator_result.get('lint_ok', False):
+    if 'eslint' in validator_result.get('skipped_stages', []):
+        issues.append('l1_lint_skipped')
+    elif not validator_result.get('lint_ok', False):
         issues.append('l1_lint_failed')
         # 收集具体错误
         errors = validator_result.get('errors', [])
@@ -146,7 +368,7 @@ def check_l4(validator_result: dict, candidate: dict) -> Tuple[bool, List[str]]:
     - 结构完整性：has_new_phaser_game + has_scene_in_config
     - 生命周期完整：has_create
     - plan 存在
-    - plan-code 一致性：plan.apis 在代码中命中率 ≥ 60%
+    - plan-code 一致性：plan.apis 在代码中命中率 ≥ 60%（API 阶段被 fail-fast 跳过时不检查）
     """
     issues = []
 
@@ -178,7 +400,8 @@ def check_l4(validator_result: dict, candidate: dict) -> Tuple[bool, List[str]]:
 
     # Plan-Code 一致性
     plan_apis = plan.get('apis', [])
-    if plan_apis:
+    api_skipped = 'api' in validator_result.get('skipped_stages', [])
+    if plan_apis and not api_skipped:
         api_usage = validator_result.get('api_usage', {})
         code_apis = set()
         for hit in api_usage.get('hits', []):
@@ -209,50 +432,56 @@ def check_l4(validator_result: dict, candidate: dict) -> Tuple[bool, List[str]]:
     return passed, issues
 
 
-def validate_candidate(
-    candidate: dict,
-    codes_dir: str,
-    cache: Optional[JsonlCache] = None
-) -> dict:
+def _candidate_cache_key(code: str, fail_fast: bool = False) -> Tuple[str, str]:
     """
-    验证单个候选数据
+    计算 (code_hash, cache_key)
 
-    Returns:
-        包含验证结果的候选数据
+    validator 参数（跳过的阶段、fail-fast）决定结果里哪些阶段真正执行过，
+    一并写进 key，fail-fast 的结果不会被普通运行复用。
     """
-    code = candidate.get('code', '')
     code_hash = compute_hash(code) if code else ''
 
     cache_key = compute_hash(
         json.dumps(
             {
                 "code_hash": code_hash,
+                "validator_flags": _validator_flags(fail_fast),
             },
             ensure_ascii=False,
             sort_keys=True,
         )
     )
+    return code_hash, cache_key
 
-    # 检查缓存
-    if cache and cache.has(cache_key):
-        cached = cache.get(cache_key)
-        candidate['validator_result'] = cached.get('validator_result', {})
-        candidate['l1_passed'] = cached.get('l1_passed', False)
-        candidate['l4_passed'] = cached.get('l4_passed', False)
-        candidate['filter_issues'] = cached.get('filter_issues', [])
-        candidate['from_cache'] = True
-        return candidate
-
-    # 写入临时代码文件
+
+def _apply_cached(candidate: dict, cached: dict) -> dict:
+    """用缓存结果填充候选数据"""
+    candidate['validator_result'] = cached.get('validator_result', {})
+    candidate['l1_passed'] = cached.get('l1_passed', False)
+    candidate['l4_passed'] = cached.get('l4_passed', False)
+    candidate['filter_issues'] = cached.get('filter_issues', [])
+    candidate['from_cache'] = True
+    return candidate
+
+
+def _write_code_file(codes_dir: str, code_hash: str, code: str) -> Path:
+    """写入临时代码文件（按 hash 去重）"""
     code_path = Path(codes_dir) / f'{code_hash}.js'
     if not code_path.exists():
         ensure_dir(codes_dir)
         code_path.write_text(code, encoding='utf-8')
+    return code_path
 
-    # 调用 validator
-    validator_result = call_validator(
-        code_path=str(code_path)
-    )
+
+def _apply_validator_result(
+    candidate: dict,
+    validator_result: dict,
+    code_hash: str,
+    cache_key: str,
+    cache: Optional[JsonlCache] = None
+) -> dict:
+    """根据 validator 结果执行 L1/L4 检查并写入缓存"""
+    code = candidate.get('code', '')
 
     candidate['validator_result'] = validator_result
     candidate['filter_issues'] = []
@@ -280,13 +509,81 @@ def validate_candidate(
     return candidate
 
 
+def validate_candidate(
+    candidate: dict,
+    codes_dir: str,
+    cache: Optional[JsonlCache] = None,
+    pool: Optional[ValidatorPool] = None,
+    fail_fast: bool = False
+) -> dict:
+    """
+    验证单个候选数据
+
+    Returns:
+        包含验证结果的候选数据
+    """
+    code = candidate.get('code', '')
+    code_hash, cache_key = _candidate_cache_key(code, fail_fast)
+
+    # 检查缓存
+    if cache and cache.has(cache_key):
+        return _apply_cached(candidate, cache.get(cache_key))
+
+    code_path = _write_code_file(codes_dir, code_hash, code)
+
+    # 调用 validator
+    validator_result = call_validator(
+        code_path=str(code_path),
+        pool=pool,
+        fail_fast=fail_fast
+    )
+
+    return _apply_validator_result(candidate, validator_result, code_hash, cache_key, cache)
+
+
+def validate_batch(
+    candidates: List[dict],
+    codes_dir: str,
+    cache: Optional[JsonlCache] = None,
+    api_index_path: str = None,
+    fail_fast: bool = False
+) -> List[dict]:
+    """
+    以 manifest 方式批量验证一组候选数据（一个 validator 进程处理整组）
+
+    Returns:
+        包含验证结果的候选数据列表（与输入顺序一致）
+    """
+    pending = []
+    for candidate in candidates:
+        code = candidate.get('code', '')
+        code_hash, cache_key = _candidate_cache_key(code, fail_fast)
+        if cache and cache.has(cache_key):
+            _apply_cached(candidate, cache.get(cache_key))
+            continue
+        code_path = _write_code_file(codes_dir, code_hash, code)
+        pending.append((candidate, code_hash, cache_key, str(code_path)))
+
+    if pending:
+        # 同一 batch 内相同代码只验证一次
+        code_paths = list(dict.fromkeys(item[3] for item in pending))
+        results = call_validator_batch(code_paths, api_index_path=api_index_path, fail_fast=fail_fast)
+        for candidate, code_hash, cache_key, code_path in pending:
+            _apply_validator_result(candidate, results[code_path], code_hash, cache_key, cache)
+
+    return candidates
+
+
 def run_filter_pipeline(
     candidates_path: str,
     output_path: str,
     codes_dir: str = None,
     cache_path: str = None,
     report_path: str = None,
-    max_workers: int = 4
+    max_workers: int = 4,
+    validator_mode: str = 'serve',
+    batch_size: int = 100,
+    fail_fast: bool = False
 ) -> dict:
     """
     运行完整的 L1/L4 过滤管线
@@ -298,6 +595,10 @@ def run_filter_pipeline(
         cache_path: 缓存文件路径
         report_path: 报告输出路径
         max_workers: 并行 worker 数量
+        validator_mode: serve=常驻进程池（每个 worker 一个热进程），
+            batch=每 batch_size 条候选一个 manifest 进程，spawn=每条候选启动新进程
+        batch_size: batch 模式下每个 validator 进程处理的候选数
+        fail_fast: validator 在首个失败阶段停止（ast/eslint 失败时不再做 API 匹配）
 
     Returns:
         过滤报告
@@ -325,40 +626,58 @@ def run_filter_pipeline(
 
     validated = []
 
-    # 并行处理
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {
-            executor.submit(
-                validate_candidate,
-                candidate=candidate,
-                codes_dir=codes_dir,
-                cache=cache
-            ): i
-            for i, candidate in enumerate(candidates)
-        }
-
-        for future in as_completed(futures):
-            validated_candidate = future.result()
-            validated.append(validated_candidate)
-
-            # 统计
-            if validated_candidate.get('l1_passed'):
-                stats['l1_passed'] += 1
-            if validated_candidate.get('l4_passed'):
-                stats['l4_passed'] += 1
-
-            all_passed = (
-                validated_candidate.get('l1_passed') and
-                validated_candidate.get('l4_passed')
-            )
-            if all_passed:
-                stats['all_passed'] += 1
+    if validator_mode not in {'serve', 'batch', 'spawn'}:
+        raise ValueError("validator_mode must be one of: serve, batch, spawn")
+    pool = ValidatorPool(size=max_workers, fail_fast=fail_fast) if validator_mode == 'serve' else None
 
-            for issue in validated_candidate.get('filter_issues', []):
-                issue_key = issue.split(':')[0]  # 取主要类型
-                stats['issues'][issue_key] = stats['issues'].get(issue_key, 0) + 1
+    def validate_one(candidate: dict) -> List[dict]:
+        return [validate_candidate(
+            candidate=candidate, codes_dir=codes_dir, cache=cache, pool=pool, fail_fast=fail_fast
+        )]
 
-            print_progress(len(validated), len(candidates), prefix='Validating')
+    try:
+        # 并行处理
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            if validator_mode == 'batch':
+                batch_size = max(1, int(batch_size))
+                futures = [
+                    executor.submit(
+                        validate_batch,
+                        candidates=candidates[start:start + batch_size],
+                        codes_dir=codes_dir,
+                        cache=cache,
+                        fail_fast=fail_fast
+                    )
+                    for start in range(0, len(candidates), batch_size)
+                ]
+            else:
+                futures = [executor.submit(validate_one, candidate) for candidate in candidates]
+
+            for future in as_completed(futures):
+                for validated_candidate in future.result():
+                    validated.append(validated_candidate)
+
+                    # 统计
+                    if validated_candidate.get('l1_passed'):
+                        stats['l1_passed'] += 1
+                    if validated_candidate.get('l4_passed'):
+                        stats['l4_passed'] += 1
+
+                    all_passed = (
+                        validated_candidate.get('l1_passed') and
+                        validated_candidate.get('l4_passed')
+                    )
+                    if all_passed:
+                        stats['all_passed'] += 1
+
+                    for issue in validated_candidate.get('filter_issues', []):
+                        issue_key = issue.split(':')[0]  # 取主要类型
+                        stats['issues'][issue_key] = stats['issues'].get(issue_key, 0) + 1
+
+                print_progress(len(validated), len(candidates), prefix='Validating')
+    finally:
+        if pool:
+            pool.close()
 
     # 保存结果
     write_jsonl(output_path, validated)
@@ -424,6 +743,24 @@ def main():
         default=4,
         help='并行 worker 数量'
     )
+    parser.add_argument(
+        '--validator-mode',
+        type=str,
+        default='serve',
+        choices=['serve', 'batch', 'spawn'],
+        help='validator 调用方式：serve=常驻进程池（默认），batch=按 manifest 分批启动进程，spawn=每条候选启动新进程'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=100,
+        help='batch 模式下每个 validator 进程处理的候选数'
+    )
+    parser.add_argument(
+        '--fail-fast',
+        action='store_true',
+        help='validator 在首个失败阶段停止（解析/ESLint 失败的候选不再做 API 匹配），L1/L4 判定不变'
+    )
 
     args = parser.parse_args()
 
@@ -433,7 +770,10 @@ def main():
         codes_dir=args.codes_dir,
         cache_path=args.cache,
         report_path=args.report,
-        max_workers=args.workers
+        max_workers=args.workers,
+        validator_mode=args.validator_mode,
+        batch_size=args.batch_size,
+        fail_fast=args.fail_fast
     )
 
     print(f"\n过滤完成！")
@@ -46,8 +46,10 @@ def calculate_quality_score(candidate: dict) -> float:
         score += 0.2
 
         # 一致性检查
+        # fail-fast 跳过了 API 阶段时没有命中数据，不计一致性分
         plan = candidate.get('plan', {})
-        if plan:
+        skipped = candidate.get('validator_result', {}).get('skipped_stages', [])
+        if plan and 'api' not in skipped:
             plan_apis = plan.get('apis', [])
             if plan_apis:
                 validator_result = candidate.get('validator_result', {})
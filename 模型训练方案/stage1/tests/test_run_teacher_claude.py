@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+run_teacher_claude 的回归测试
+
+运行：python -m unittest discover -s stage1/tests
+"""
+
+import json
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+
+from run_teacher_claude import RunStats, run_claude_distill  # noqa: E402
+
+
+class SerialFailureTest(unittest.TestCase):
+    """串行模式下失败的请求应计为失败并继续，而不是中断整个运行"""
+
+    def test_failed_request_is_recorded(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            requests_path = tmp / 'requests.jsonl'
+            # 模板快照不存在：构建系统提示词失败，generate_claude_output 返回 None，不会调用 API
+            with open(requests_path, 'w', encoding='utf-8') as f:
+                for i in range(2):
+                    request = {
+                        'id': f'distill_missing_{i}_v1',
+                        'prompt_id': f'missing_{i}',
+                        'version': 1,
+                        'system_prompt_hash': 'missing-template',
+                        'user_prompt': 'test',
+                        'api_context_injected': []
+                    }
+                    f.write(json.dumps(request, ensure_ascii=False) + '\n')
+
+            run_stats = RunStats('claude-sonnet-4-5-20250929')
+            success = run_claude_distill(
+                requests_path=str(requests_path),
+                output_path=str(tmp / 'out.jsonl'),
+                api_key='test',
+                checkpoint_path=str(tmp / 'checkpoint.json'),
+                report_path=str(tmp / 'report.json'),
+                api_index_path=str(tmp / 'missing_index.jsonl'),
+                base_url='http://127.0.0.1:9',
+                rate_limit_delay=0,
+                concurrency=1,
+                run_stats=run_stats
+            )
+
+            self.assertEqual(success, 0)
+            self.assertEqual(run_stats.failed, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()